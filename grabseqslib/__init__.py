@@ -1,9 +1,11 @@
-__all__ = ["utils","sra","mgrast"]
+__all__ = ["utils","net","cache","compress","journal","verify","metrics","ena","sra","mgrast","api"]
 
-import os, sys, argparse, warnings, shutil
-import pandas as pd
+import os, sys, argparse
 
 from pathlib import Path
+from grabseqslib.cache import configure_cache, print_cache_stats, CacheMiss
+from grabseqslib.compress import configure_compression
+from grabseqslib.metrics import configure_metrics, get_metrics
 from grabseqslib.sra import process_sra, add_sra_subparser
 from grabseqslib.mgrast import process_mgrast, add_mgrast_subparser
 
@@ -32,36 +34,59 @@ def main():
         sys.exit(0)
 
     # Figure out which subparser was called
-    try:
-        if args.rastid:
-            repo = "MG-RAST"
-    except AttributeError:
+    if hasattr(args, "rastid"):
+        repo = "MG-RAST"
+        ids = args.rastid
+    else:
         repo = "SRA"
+        ids = args.id
+    if len(ids) == 0 and args.from_file == "":
+        parser.error("no identifiers given: pass one or more on the command line or use --from-file")
 
-    # Check deps
-    zip_func = "gzip"
-    if shutil.which("pigz"):
-        zip_func = "pigz"
-    else:
-        print("pigz not found, using gzip")
+    configure_cache(args)
+    configure_metrics(args)
+
+    # Pick a compressor (pigz, or the built-in multithreaded gzip without it)
+    zip_func = configure_compression(args)
 
     metadata_agg = None
+    failed = {}
 
     # Download samples
-    if repo == "SRA":
-        metadata_agg = process_sra(args, zip_func)
+    try:
+        if repo == "SRA":
+            metadata_agg, failed = process_sra(args, zip_func)
+
+        elif repo == "MG-RAST":
+            metadata_agg, failed = process_mgrast(args, zip_func)
+    except RuntimeError as e: # e.g. sra-tools missing
+        print(str(e))
+        sys.exit(1)
+    except CacheMiss as e: # --offline and an identifier was never looked up
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
 
-    elif repo == "MG-RAST":
-        metadata_agg = process_mgrast(args, zip_func)
+    print_cache_stats()
 
-    # Handle metadata
-    if args.metadata != "":
+    # Where the time went, with --metrics
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.print_summary()
+        metrics.close()
+
+    # Handle metadata (already written as it came in with --stream)
+    if args.metadata != "" and not args.stream:
         md_path = Path(args.outdir) / Path(args.metadata)
-        if not os.path.isfile(md_path):
-            metadata_agg.to_csv(md_path, index = False)
+        if type(metadata_agg) == type(None):
+            print("No metadata found to save to: " + str(md_path))
+        elif not os.path.isfile(md_path):
+            metadata_agg.to_csv(str(md_path))
             print("Metadata saved to new file: " + str(md_path))
         else:
-            metadata_i = pd.read_csv(md_path)
-            metadata_f = pd.concat([metadata_i,metadata_agg],sort=True)
-            metadata_f.to_csv(md_path, index = False)
+            # merges columns while streaming, without loading the existing file
+            metadata_agg.to_csv(str(md_path), append = True)
             print("Metadata appended to existing file: " + str(md_path))
+
+    # Per-accession failures are reported in the summary; still signal them
+    if len(failed) > 0:
+        sys.exit(1)
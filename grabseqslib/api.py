@@ -0,0 +1,196 @@
+"""
+Python API: resolve identifiers into a download plan with `plan`, then
+download it with `execute`, without going through the command line.
+
+    from grabseqslib.api import plan, execute
+    tasks = plan(["SRP057027"], outdir="reads")
+    results = execute(tasks, workers=4, threads=8, outdir="reads")
+
+Options are the command-line options' `dest` names (e.g. `outdir`,
+`retries`, `threads`, `pipe`, `verify`); anything not given takes its
+command-line default. Errors are raised rather than exiting.
+"""
+import os, argparse
+from dataclasses import dataclass, field
+from grabseqslib.cache import configure_cache, get_cache
+from grabseqslib.compress import configure_compression
+from grabseqslib.metrics import configure_metrics
+from grabseqslib.net import set_ncbi_api_key
+from grabseqslib.utils import FASTQ_SUFFIXES, shard_items
+from grabseqslib.sra import add_sra_subparser, resolve_sra_runs, run_size, find_sra_tools, SRARunner, _runinfo_int
+from grabseqslib.mgrast import add_mgrast_subparser, resolve_mgrast_ids, listing_size, MGRASTRunner, MGRAST_API
+
+REPOS = {"sra": "id", "mgrast": "rastid"}
+
+_cache_configured = False
+
+@dataclass
+class DownloadTask:
+    """
+    One run (SRA) or sample (MG-RAST) to download, as resolved by `plan`.
+    `size` is the compressed size in bytes (0 if unknown); `urls` are
+    where the reads come from, where the repository says.
+    """
+    repo: str
+    acc: str
+    layout: str = ""
+    size: int = 0
+    spots: int = 0
+    bases: int = 0
+    urls: list = field(default_factory=list)
+    metadata: dict = field(default_factory=dict)
+
+    def outputs(self, loc = ''):
+        """
+        Paths of the .fastq.gz files this task is expected to produce in `loc`.
+        """
+        suffixes = FASTQ_SUFFIXES[1:] if self.layout == "PAIRED" else FASTQ_SUFFIXES[:1]
+        return [os.path.join(loc, self.acc+s+".fastq.gz") for s in suffixes]
+
+@dataclass
+class TaskResult:
+    """
+    Outcome of one `DownloadTask`: whether it succeeded, the error if
+    not, and the files it left behind. `claimed` tasks were skipped
+    because another process (with `claim=True`) was downloading them;
+    they count as ok but weren't downloaded here.
+    """
+    task: DownloadTask
+    ok: bool
+    error: str = ""
+    files: list = field(default_factory=list)
+    claimed: bool = False
+
+def options(repo = "sra", **kwargs):
+    """
+    Builds the options namespace for `repo` ("sra" or "mgrast") from
+    the command-line defaults, overridden by `kwargs`. Raises
+    TypeError for unknown options.
+    """
+    if repo not in REPOS:
+        raise ValueError("Unknown repository: "+repo+". Should be one of: "+", ".join(REPOS))
+    parser = argparse.ArgumentParser(prog="grabseqs")
+    subparsers = parser.add_subparsers()
+    add_sra_subparser(subparsers)
+    add_mgrast_subparser(subparsers)
+    args = parser.parse_args([repo])
+    for k in kwargs:
+        if not hasattr(args, k):
+            raise TypeError("unknown option for "+repo+": "+k)
+        setattr(args, k, kwargs[k])
+    if args.outdir != "" and not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    return args
+
+def _configure(args):
+    """
+    Opens the metadata cache (once per process), sets the NCBI key and
+    turns metrics on or off.
+    """
+    global _cache_configured
+    if not _cache_configured or get_cache() is None:
+        configure_cache(args)
+        _cache_configured = True
+    configure_metrics(args)
+    if hasattr(args, "ncbi_api_key"):
+        set_ncbi_api_key(args.ncbi_api_key)
+
+def plan(ids, repo = "sra", **kwargs):
+    """
+    Resolves identifiers (`ids`: projects, samples or runs) from `repo`
+    into a list of `DownloadTask`s, one per run/sample, with layouts,
+    sizes and metadata filled in. Nothing is downloaded.
+    """
+    args = options(repo, **kwargs)
+    _configure(args)
+    ids = [i.strip() for i in ids if i.strip() != ""]
+    tasks = []
+    if repo == "sra":
+        acclist, run_info, metadata_agg = resolve_sra_runs(ids, args.batch_size, args.outdir, False,
+                                                           not args.SRR_parsing)
+        records = {}
+        for record in (metadata_agg.records if metadata_agg is not None else []):
+            records.setdefault(record.get("Run"), record)
+        for acc in acclist:
+            info = run_info.get(acc, {})
+            record = records.get(acc, {})
+            urls = [record["download_path"]] if record.get("download_path") else []
+            tasks.append(DownloadTask("sra", acc, info.get("LibraryLayout") or "", run_size(info),
+                                      _runinfo_int(info, "spots"), _runinfo_int(info, "bases"),
+                                      urls, dict(record)))
+    else:
+        targets, listings, records = resolve_mgrast_ids(ids, True)
+        for acc in list(dict.fromkeys(targets)):
+            stages = [s for s in listings.get(acc, {}).get("data", []) if s.get("file_id") in ("050.1", "050.2")]
+            stages = sorted(stages, key=lambda s: s["file_id"])
+            size = listing_size(listings.get(acc))
+            urls = [MGRAST_API+"download/"+acc+"?file="+s["file_id"] for s in stages]
+            tasks.append(DownloadTask("mgrast", acc, "PAIRED" if len(stages) == 2 else ("SINGLE" if len(stages) == 1 else ""),
+                                      size, 0, 0, urls, records.get(acc) or {}))
+    return tasks
+
+def shard(tasks, i, n):
+    """
+    Shard `i` of `n` (counting from 1) of a plan, balanced by task size.
+    Every process splitting the same plan gets the same shards.
+    """
+    sizes = dict((t.acc, t.size) for t in tasks)
+    accs = shard_items([t.acc for t in tasks], sizes, (i, n))
+    keep = set(accs)
+    return [t for t in tasks if t.acc in keep]
+
+def execute(tasks, workers = 1, progress = None, **kwargs):
+    """
+    Downloads a plan (a list of `DownloadTask`s from `plan`) with up to
+    `workers` tasks at once; other options (e.g. `outdir`, `threads`,
+    `retries`, `verify`) as for the command line; `workers` takes the
+    place of `jobs`. `progress(task, state, error)` is called as each
+    task is "started", and when it's "done", has "failed" or was
+    "claimed" by another process. Returns a `TaskResult` per task, in
+    plan order; failed tasks don't stop the others.
+    """
+    if "jobs" in kwargs:
+        raise TypeError("execute() takes the number of concurrent tasks as workers=, not jobs=")
+    by_acc = dict((t.acc, t) for t in tasks)
+    report = None
+    if progress is not None:
+        report = lambda acc, state, error: progress(by_acc[acc], state, error)
+    failed = {}
+    claimed = set()
+    for repo in REPOS:
+        repo_tasks = [t for t in tasks if t.repo == repo]
+        if len(repo_tasks) == 0:
+            continue
+        args = options(repo, jobs=workers, **kwargs)
+        _configure(args)
+        zip_func = configure_compression(args)
+        accs = [t.acc for t in repo_tasks]
+        if repo == "sra":
+            run_info = {}
+            for t in repo_tasks:
+                run_info[t.acc] = {"LibraryLayout": t.layout or None, "size_MB": str(t.size / 1000000.0),
+                                   "spots": str(t.spots), "bases": str(t.bases)}
+            runner = SRARunner(args, zip_func, find_sra_tools(args.fastqdump, args.prefetch))
+            results, failed_repo = runner.run(accs, run_info, report)
+        else:
+            listings = {}
+            for t in repo_tasks:
+                if len(t.urls) > 0:
+                    listings[t.acc] = {"data": [{"file_id": u.rsplit("file=", 1)[1]} for u in t.urls]}
+            records = dict((t.acc, t.metadata) for t in repo_tasks if len(t.metadata) > 0)
+            runner = MGRASTRunner(args, zip_func)
+            results, failed_repo = runner.run(accs, listings, records, report)
+        runner.close()
+        failed.update(failed_repo)
+        claimed.update(runner.claimed_elsewhere)
+
+    results = []
+    for t in tasks:
+        loc = kwargs.get("outdir", "")
+        files = [os.path.join(loc, t.acc+s+".fastq.gz") for s in FASTQ_SUFFIXES]
+        files = [f for f in files if os.path.isfile(f)]
+        if t.acc in failed:
+            results.append(TaskResult(t, False, str(failed[t.acc]), files))
+        else:
+            results.append(TaskResult(t, True, "", files, t.acc in claimed))
+    return results
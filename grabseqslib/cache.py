@@ -0,0 +1,161 @@
+import os, sys, time, sqlite3, threading, zlib
+from grabseqslib.net import get_session
+
+_cache = None
+
+class CacheMiss(LookupError):
+    """
+    Raised for metadata that isn't cached when running with --offline.
+    """
+
+def default_cache_dir():
+    """
+    Returns the default cache location, `$XDG_CACHE_HOME/grabseqs`
+    (usually `~/.cache/grabseqs`).
+    """
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "grabseqs")
+
+class MetadataCache:
+    """
+    Persistent SQLite cache of repository metadata responses, keyed by
+    accession. Entries expire after `ttl` seconds, and once the cache
+    grows past `max_mb` the least-recently-used entries are evicted.
+    With `refresh`, cached entries are ignored (and overwritten); with
+    `offline`, misses raise instead of going to the network. Hits are
+    counted in `hits`, and missed keys in `missed` (each once, however
+    many times it was looked up; see `misses`).
+    """
+    def __init__(self, path = None, ttl = 7*24*3600, max_mb = 512, offline = False, refresh = False):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "metadata.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_mb * 1024 * 1024
+        self.offline = offline
+        self.refresh = refresh
+        self.hits = 0
+        self.missed = set()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, "
+                        "size INTEGER, created REAL, last_used REAL)")
+        self.db.commit()
+
+    def get(self, key):
+        """
+        Returns the cached text for `key`, or None if missing or expired.
+        """
+        with self.lock:
+            row = None
+            if not self.refresh:
+                row = self.db.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                self.missed.add(key)
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            return zlib.decompress(row[0]).decode("utf-8")
+
+    @property
+    def misses(self):
+        """
+        Number of keys that had to be fetched (or, offline, couldn't be).
+        """
+        return len(self.missed)
+
+    def put(self, key, text):
+        """
+        Stores `text` under `key`, evicting least-recently-used entries
+        if the cache is over its size limit.
+        """
+        value = zlib.compress(text.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                            (key, value, len(value), now, now))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                for k, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+                    if total <= self.max_bytes or k == key:
+                        break
+                    self.db.execute("DELETE FROM entries WHERE key = ?", (k,))
+                    total -= size
+            self.db.commit()
+
+    def close(self):
+        """
+        Closes the underlying database.
+        """
+        with self.lock:
+            self.db.close()
+
+def add_cache_args(parser):
+    """
+    Adds metadata cache options to a repository `parser`.
+    """
+    parser.add_argument('--offline', dest="offline", action="store_true",
+                help="only use cached metadata, never query the repository")
+    parser.add_argument('--refresh-cache', dest="refresh_cache", action="store_true",
+                help="ignore (and overwrite) cached metadata")
+    parser.add_argument('--no-cache', dest="no_cache", action="store_true",
+                help="don't read or write the metadata cache")
+    parser.add_argument('--cache-dir', dest="cache_dir", type=str, default="",
+                help="metadata cache location (default: ~/.cache/grabseqs)")
+
+def configure_cache(args):
+    """
+    Sets up the process-wide metadata cache from command-line `args`.
+    """
+    global _cache
+    if args.no_cache:
+        if args.offline:
+            print("--offline requires the metadata cache, ignoring --no-cache")
+        else:
+            _cache = None
+            return None
+    path = None
+    if args.cache_dir != "":
+        path = os.path.join(args.cache_dir, "metadata.sqlite")
+    try:
+        _cache = MetadataCache(path, offline=args.offline, refresh=args.refresh_cache)
+    except (OSError, sqlite3.Error) as e:
+        print("could not open metadata cache ("+str(e)+"), continuing without it", file=sys.stderr)
+        _cache = None
+    return _cache
+
+def get_cache():
+    """
+    Returns the process-wide metadata cache (None if disabled).
+    """
+    return _cache
+
+def cached_get_text(url, key, validate = None):
+    """
+    Returns the body of `url`, served from the metadata cache under
+    `key` when possible. Responses are only cached if `validate(text)`
+    (when given) returns True, so failed lookups are retried next time.
+    """
+    cache = get_cache()
+    if cache is not None:
+        text = cache.get(key)
+        if text is not None:
+            return text
+        if cache.offline:
+            raise CacheMiss(key+": not in cache (offline)")
+    text = get_session().get(url, timeout=60).text
+    if cache is not None and (validate is None or validate(text)):
+        cache.put(key, text)
+    return text
+
+def print_cache_stats():
+    """
+    Prints metadata cache hit/miss counters to stderr (so listings
+    on stdout stay clean).
+    """
+    cache = get_cache()
+    if cache is not None and cache.hits + cache.misses > 0:
+        print("metadata cache: "+str(cache.hits)+" hits, "+str(cache.misses)+" misses", file=sys.stderr)
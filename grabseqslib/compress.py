@@ -0,0 +1,194 @@
+import os, gzip, zlib, shutil
+from collections import deque
+from subprocess import call, Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+# input per gzip member written by the in-process parallel compressor
+BLOCK_SIZE = 1 << 20
+
+# compression level used when none is given (set from --compress-level)
+_level = 6
+
+def add_compress_args(parser):
+    """
+    Adds compression options to a repository `parser`.
+    """
+    parser.add_argument('--compressor', dest="compressor", type=str, default="auto",
+                choices=["auto", "pigz", "gzip", "python"],
+                help="how to compress reads: pigz, gzip, or built-in multithreaded gzip ('python'). default: pigz if installed, otherwise built-in")
+    parser.add_argument('--compress-level', dest="compress_level", type=int, default=6,
+                choices=range(1, 10), metavar="{1-9}",
+                help="gzip compression level (default: 6)")
+
+def configure_compression(args):
+    """
+    Sets the compression level from command-line `args` and picks the
+    compression backend (the `zip_func` handed to download functions).
+    Missing external tools fall back to the built-in parallel writer,
+    so compression stays multithreaded without pigz.
+    """
+    global _level
+    _level = args.compress_level
+    tool = args.compressor
+    if tool == "auto":
+        tool = "pigz"
+    if tool in ("pigz", "gzip") and not shutil.which(tool):
+        print(tool+" not found, using built-in multithreaded gzip")
+        tool = "python"
+    return tool
+
+def _gzip_member(data, level):
+    """
+    Compresses `data` into one complete gzip member.
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+class ParallelGzipWriter:
+    """
+    Binary file-like writer producing multi-member gzip in `fp`: input
+    is cut into `block_size` blocks, each compressed into a gzip member
+    of its own on a pool of `threads` (zlib releases the GIL while it
+    works), and the members are written in order. gzip, zcat, pigz and
+    Python all read the result as a single stream.
+    """
+    def __init__(self, fp, threads = 1, level = None, block_size = BLOCK_SIZE):
+        self.f = open(fp, 'wb')
+        self.level = level if level is not None else _level
+        self.block_size = block_size
+        self.buf = []
+        self.buffered = 0
+        self.members = 0
+        self.pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.pending = deque()
+        self.max_pending = 2 * max(1, threads)
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(_gzip_member, data, self.level))
+        self.members += 1
+        while len(self.pending) >= self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, b):
+        self.buf.append(bytes(b))
+        self.buffered += len(b)
+        if self.buffered >= self.block_size:
+            data = b"".join(self.buf)
+            self.buf = []
+            self.buffered = 0
+            self._submit(data)
+        return len(b)
+
+    def close(self):
+        """
+        Flushes outstanding blocks. Returns 0, or 1 if writing failed.
+        """
+        retcode = 0
+        try:
+            if self.buffered > 0 or self.members == 0: # empty input still needs a valid file
+                self._submit(b"".join(self.buf))
+                self.buf = []
+            while len(self.pending) > 0:
+                self.f.write(self.pending.popleft().result())
+        except OSError as e:
+            print("compression failed: "+str(e))
+            retcode = 1
+        self.pool.shutdown()
+        try:
+            self.f.close()
+        except OSError:
+            retcode = 1
+        return retcode
+
+class CompressedWriter:
+    """
+    Binary file-like writer that compresses everything written to
+    it into `fp` with the given `tool`: a piped `pigz` process, the
+    built-in parallel gzip writer ("python") or an in-process gzip
+    stream ("gzip"), using `threads` where the tool can. `close()`
+    returns the compressor's return code, like `gzip_files`.
+    """
+    def __init__(self, fp, tool = "gzip", threads = 1, level = None):
+        self.fp = fp
+        self.proc = None
+        level = level if level is not None else _level
+        if tool == "pigz":
+            self.out = open(fp, 'wb')
+            self.proc = Popen(["pigz", "-c", "-"+str(level), "-p", str(threads)], stdin=PIPE, stdout=self.out)
+            self.f = self.proc.stdin
+        elif tool == "gzip":
+            self.out = None
+            self.f = gzip.open(fp, 'wb', compresslevel=level)
+        elif tool == "python":
+            self.f = ParallelGzipWriter(fp, threads, level)
+        else:
+            raise ValueError("Unrecognized tool "+tool+" specified: cannot compress "+fp)
+
+    def write(self, b):
+        return self.f.write(b)
+
+    def close(self):
+        try:
+            retcode = self.f.close()
+        except BrokenPipeError: # compressor died, reported via return code
+            retcode = 0
+        if self.proc is None:
+            return retcode if retcode is not None else 0
+        retcode = self.proc.wait()
+        self.out.close()
+        return retcode
+
+def compress_file(path, tool = "python", threads = 1, level = None, chunk_size = 1 << 20):
+    """
+    Compresses `path` in-process to `path`.gz and removes the
+    original, like `gzip -f`. Returns 0 on success.
+    """
+    out = path + ".gz"
+    writer = None
+    try:
+        writer = CompressedWriter(out, tool, threads, level)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, writer, chunk_size)
+        retcode = writer.close()
+        writer = None
+    except OSError as e:
+        print("compressing "+path+" failed: "+str(e))
+        retcode = 1
+    finally:
+        if writer is not None: # failed part-way: stop pigz/the writer's threads first
+            try:
+                writer.close()
+            except OSError:
+                pass
+    if retcode == 0:
+        os.remove(path)
+    elif os.path.isfile(out):
+        os.remove(out)
+    return retcode
+
+def gzip_files(paths, tool="gzip", threads=1, level=None):
+    """
+    Zips files at one or more `paths` using specified `tool` (pigz
+    or gzip on the command line, or the built-in "python" writer).
+    Returns the tool's return code.
+    """
+    if type(paths) != type(["list'o'strings"]):
+        paths = [paths]
+    validated_paths = []
+    for p in paths:
+        if os.path.isfile(p):
+            validated_paths.append(p)
+    if len(validated_paths) == 0:
+        return 0
+    level = level if level is not None else _level
+    if tool == "gzip":
+        retcode = call(["gzip", "-f", "-"+str(level)] + validated_paths)
+    elif tool == "pigz":
+        retcode = call(["pigz", "-f", "-"+str(level), "-p", str(threads)] + validated_paths)
+    elif tool == "python":
+        retcode = 0
+        for p in validated_paths:
+            retcode = max(retcode, compress_file(p, tool, threads, level))
+    else:
+        raise ValueError("Unrecognized tool "+tool+" specified: cannot compress "+" ".join(validated_paths))
+    return retcode
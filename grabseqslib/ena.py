@@ -0,0 +1,126 @@
+import os, time, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from grabseqslib.cache import cached_get_text
+from grabseqslib.net import download, backoff_delay
+from grabseqslib.journal import file_bytes
+from grabseqslib.metrics import timed
+from grabseqslib.utils import FASTQ_SUFFIXES
+
+# ENA mirrors most SRA runs as ready-made .fastq.gz files, listed (with
+# MD5s and sizes) in its filereport for each run
+ENA_FILEREPORT = "https://www.ebi.ac.uk/ena/portal/api/filereport?result=read_run&fields=run_accession,fastq_ftp,fastq_md5,fastq_bytes&accession="
+
+def _filereport_ok(text):
+    """
+    Checks that a filereport response is a table (i.e. ENA knows the run).
+    """
+    return text.split("\n")[0].split("\t")[0] == "run_accession"
+
+def _ena_url(path):
+    """
+    filereport paths are host/path without a scheme; fetch them over HTTPS.
+    """
+    return path if "://" in path else "https://"+path
+
+def get_ena_files(acc):
+    """
+    Looks up the FASTQ files ENA publishes for run `acc`, going through
+    the metadata cache. Returns a list of (url, md5, bytes) tuples,
+    empty if ENA has none.
+    """
+    text = cached_get_text(ENA_FILEREPORT+acc, "ena-filereport:"+acc, _filereport_ok)
+    if not _filereport_ok(text):
+        return []
+    lines = [l for l in text.split("\n") if l.strip() != ""]
+    header = lines[0].split("\t")
+    for line in lines[1:]:
+        row = dict(zip(header, line.split("\t")))
+        if row.get("run_accession") != acc:
+            continue
+        urls = [u for u in row.get("fastq_ftp", "").split(";") if u != ""]
+        md5s = row.get("fastq_md5", "").split(";")
+        sizes = row.get("fastq_bytes", "").split(";")
+        if len(urls) == 0 or len(md5s) != len(urls) or len(sizes) != len(urls):
+            return []
+        return [(_ena_url(u), m, int(b) if b.isdigit() else 0) for u, m, b in zip(urls, md5s, sizes)]
+    return []
+
+def file_md5(fp, chunk_size = 1 << 20):
+    """
+    MD5 hex digest of the file `fp`.
+    """
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _fetch_verified(url, md5, size, fp, retries, retry_base, retry_cap):
+    """
+    Downloads `url` to `fp`, checking it against the expected `md5` and
+    `size` (if known) before moving it into place. Interrupted
+    transfers are resumed (see `net.download`); a mismatch throws the
+    download away and tries again, up to `retries` times.
+    """
+    tmp = fp + ".ena"
+    attempt = 0
+    while True:
+        problem = ""
+        if download(url, tmp, retries, backoff_base=retry_base, backoff_cap=retry_cap) != 0:
+            raise Exception(os.path.basename(fp)+" from ENA: download failed") # already retried
+        if size > 0 and os.path.getsize(tmp) != size:
+            problem = "expected "+str(size)+" bytes, got "+str(os.path.getsize(tmp))
+        elif md5 != "" and file_md5(tmp) != md5:
+            problem = "MD5 mismatch"
+        if problem == "":
+            os.replace(tmp, fp)
+            return
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        if attempt >= retries:
+            raise Exception(os.path.basename(fp)+" from ENA: "+problem)
+        delay = backoff_delay(attempt, retry_base, retry_cap, jitter=True)
+        print(os.path.basename(fp)+" from ENA: "+problem+", retrying in "+str(round(delay, 1))+"s")
+        time.sleep(delay)
+        attempt += 1
+
+def download_ena_run(acc, files, loc = '', retries = 2, index = None, journal = None, retry_base = 5, retry_cap = 300):
+    """
+    Downloads run `acc`'s ready-made .fastq.gz `files` (from
+    `get_ena_files`) from ENA straight to the names fasterq-dump output
+    would be compressed to, in parallel, without dumping or
+    recompressing anything. Each file is checked against its MD5 before
+    it's put in place. Raises an Exception if any file can't be fetched
+    intact.
+    """
+    names = [acc+suffix+".fastq.gz" for suffix in FASTQ_SUFFIXES]
+    for url, md5, size in files:
+        if url.rsplit("/", 1)[-1] not in names:
+            raise Exception("unexpected file from ENA for "+acc+": "+url)
+    paths = [os.path.join(loc, url.rsplit("/", 1)[-1]) for url, md5, size in files]
+    if journal is not None:
+        journal.record(acc, "downloading", source="ena")
+    print("downloading "+acc+" from ENA: "+", ".join([url for url, md5, size in files]))
+    with timed(acc, "ena-download", files=len(files)) as m, ThreadPoolExecutor(max_workers=len(files)) as pool:
+        fetches = [pool.submit(_fetch_verified, url, md5, size, fp, retries, retry_base, retry_cap)
+                   for (url, md5, size), fp in zip(files, paths)]
+        errors = []
+        for f in fetches:
+            try:
+                f.result()
+            except Exception as e:
+                errors.append(str(e))
+        m["bytes_out"] = file_bytes(paths)
+        if len(errors) > 0:
+            m["error"] = "; ".join(errors)
+    if len(errors) > 0:
+        for fp in paths: # don't leave half a run looking finished
+            if os.path.isfile(fp):
+                os.remove(fp)
+        if journal is not None:
+            journal.record(acc, "failed", stage="ena", problems=errors)
+        raise Exception("download of "+acc+" from ENA failed: "+"; ".join(errors))
+    if index is not None:
+        index.refresh(acc)
+    if journal is not None:
+        journal.record(acc, "compressed", bytes=file_bytes(paths), source="ena")
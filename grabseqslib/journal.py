@@ -0,0 +1,165 @@
+import os, json, time, socket, threading
+
+# stages an accession moves through, in order
+STAGES = ["resolved", "downloading", "fetched", "dumped", "compressed", "verified"]
+
+class Journal:
+    """
+    Append-only JSONL record of each accession's progress through
+    download stages (see `STAGES`, plus "failed"), kept in the output
+    directory `loc`. Replayed on start-up so an interrupted batch can
+    pick up each accession at the stage where it stopped.
+    """
+    def __init__(self, loc = ''):
+        loc = loc if loc != '' else os.getcwd()
+        self.path = os.path.join(loc, ".grabseqs_journal.jsonl")
+        self.lock = threading.Lock()
+        self.states = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError: # partial last line from a crash
+                        continue
+                    self.states[event["acc"]] = event
+        self.f = open(self.path, 'a')
+
+    def record(self, acc, state, **info):
+        """
+        Records that `acc` reached `state` (one of `STAGES`, or
+        "failed"), with any extra `info` (e.g. byte counts), and
+        flushes it to disk immediately. Raises ValueError for an
+        unknown `state`.
+        """
+        if state not in STAGES and state != "failed":
+            raise ValueError("Unknown journal stage: "+str(state))
+        event = {"acc": acc, "state": state, "time": round(time.time(), 3)}
+        event.update(info)
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            self.states[acc] = event
+            self.f.write(line)
+            self.f.flush()
+
+    def state(self, acc):
+        """
+        Returns the last recorded state for `acc`, or None.
+        """
+        with self.lock:
+            event = self.states.get(acc)
+        return event["state"] if event is not None else None
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        with self.lock:
+            self.f.close()
+
+def file_bytes(paths):
+    """
+    Total size of whichever of `paths` exist.
+    """
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+class ClaimSet:
+    """
+    Claim files (in `loc`/.grabseqs_claims) that let several grabseqs
+    processes, on any machines sharing the filesystem, work through
+    the same runs without downloading any twice. A claim is created
+    atomically (O_EXCL) and refreshed in the background while held; one
+    left unrefreshed for `timeout` seconds is taken to belong to a dead
+    worker and can be taken over.
+    """
+    def __init__(self, loc = '', timeout = 600):
+        self.dir = os.path.join(loc, ".grabseqs_claims")
+        os.makedirs(self.dir, exist_ok=True)
+        self.timeout = timeout
+        self.owner = socket.gethostname()+"."+str(os.getpid())
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._refresh, daemon=True)
+        self.thread.start()
+
+    def _path(self, acc):
+        return os.path.join(self.dir, acc+".claim")
+
+    def claim(self, acc):
+        """
+        Tries to claim `acc`. Returns True if this process now holds it.
+        """
+        path = self._path(acc)
+        fd = self._create(path)
+        if fd is None:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError: # just released
+                st = None
+            if st is not None:
+                if time.time() - st.st_mtime < self.timeout:
+                    return False
+                # stale: remove it unless it was refreshed or replaced in the
+                # meantime, then make a single attempt at a claim of our own
+                # (of several workers doing this, only one create succeeds)
+                try:
+                    now = os.stat(path)
+                    if (now.st_ino, now.st_mtime) != (st.st_ino, st.st_mtime):
+                        return False
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            fd = self._create(path)
+            if fd is None:
+                return False
+            if st is not None:
+                print("took over stale claim on "+acc)
+        os.write(fd, (self.owner+"\n").encode())
+        os.close(fd)
+        with self.lock:
+            self.held.add(acc)
+        return True
+
+    def _create(self, path):
+        """
+        Atomically creates the claim file `path`. Returns its descriptor,
+        or None if it already exists.
+        """
+        try:
+            return os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+
+    def release(self, acc):
+        """
+        Gives up the claim on `acc`.
+        """
+        with self.lock:
+            if acc not in self.held:
+                return
+            self.held.discard(acc)
+        try:
+            os.remove(self._path(acc))
+        except FileNotFoundError:
+            pass
+
+    def _refresh(self):
+        while not self.stopped.wait(max(1, self.timeout / 4)):
+            with self.lock:
+                held = list(self.held)
+            for acc in held:
+                try:
+                    os.utime(self._path(acc))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """
+        Stops refreshing and releases every claim still held.
+        """
+        self.stopped.set()
+        with self.lock:
+            held = list(self.held)
+        for acc in held:
+            self.release(acc)
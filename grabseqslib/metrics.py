@@ -0,0 +1,131 @@
+import os, sys, json, time, threading
+from contextlib import contextmanager
+
+_metrics = None
+
+class Metrics:
+    """
+    Collects one event per stage of work on an accession (runinfo
+    lookup, dump, compression, download, ...): when it started, its
+    wall time, and whatever the stage reports (bytes in/out, exit
+    codes, retry attempt). Events are kept for `print_summary` and, if
+    `path` is given, appended to it as JSON lines as they happen.
+    """
+    def __init__(self, path = None):
+        self.lock = threading.Lock()
+        self.events = []
+        self.f = open(path, 'a') if path is not None else None
+
+    def record(self, acc, stage, start, seconds, **info):
+        """
+        Records that `stage` of `acc` ran for `seconds` from `start`
+        (epoch time), with any extra `info`. Adds the throughput in MB/s
+        when byte counts are given.
+        """
+        event = {"acc": acc, "stage": stage, "start": round(start, 3), "seconds": round(seconds, 3)}
+        event.update(info)
+        moved = max(info.get("bytes_in", 0) or 0, info.get("bytes_out", 0) or 0)
+        if moved > 0 and seconds > 0:
+            event["mb_s"] = round(moved / seconds / 1e6, 2)
+        with self.lock:
+            self.events.append(event)
+            if self.f is not None:
+                self.f.write(json.dumps(event) + "\n")
+                self.f.flush()
+
+    def print_summary(self, slowest = 5):
+        """
+        Prints a table of time, data and throughput per stage, and the
+        `slowest` accessions by wall time, to stderr (so listings on
+        stdout stay clean).
+        """
+        with self.lock:
+            events = list(self.events)
+        if len(events) == 0:
+            return
+        stages = {}
+        spans = {}
+        for e in events:
+            s = stages.setdefault(e["stage"], {"events": 0, "failed": 0, "retries": 0, "seconds": 0.0,
+                                              "bytes_in": 0, "bytes_out": 0})
+            s["events"] += 1
+            s["seconds"] += e["seconds"]
+            s["bytes_in"] += e.get("bytes_in", 0) or 0
+            s["bytes_out"] += e.get("bytes_out", 0) or 0
+            if "error" in e or (e.get("retcode") or 0) != 0:
+                s["failed"] += 1
+            if (e.get("attempt") or 0) > 0:
+                s["retries"] += 1
+            first, last = spans.get(e["acc"], (e["start"], e["start"] + e["seconds"]))
+            spans[e["acc"]] = (min(first, e["start"]), max(last, e["start"] + e["seconds"]))
+
+        print("{:<16}{:>8}{:>8}{:>9}{:>11}{:>11}{:>11}{:>9}".format("stage", "events", "failed", "retries",
+                                                                    "time (s)", "MB in", "MB out", "MB/s"), file=sys.stderr)
+        for name in stages:
+            s = stages[name]
+            moved = max(s["bytes_in"], s["bytes_out"])
+            rate = str(round(moved / s["seconds"] / 1e6, 1)) if (moved > 0 and s["seconds"] > 0) else "-"
+            print("{:<16}{:>8}{:>8}{:>9}{:>11}{:>11}{:>11}{:>9}".format(name, s["events"], s["failed"], s["retries"],
+                  round(s["seconds"], 1), _mb(s["bytes_in"]), _mb(s["bytes_out"]), rate), file=sys.stderr)
+        walls = sorted([(spans[acc][1] - spans[acc][0], acc) for acc in spans], reverse=True)[:slowest]
+        print("slowest: "+", ".join([acc+" ("+str(round(wall, 1))+"s)" for wall, acc in walls]), file=sys.stderr)
+
+    def close(self):
+        """
+        Closes the event file.
+        """
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+def _mb(nbytes):
+    return str(round(nbytes / 1e6, 1)) if nbytes > 0 else "-"
+
+def add_metrics_args(parser):
+    """
+    Adds instrumentation options to a repository `parser`.
+    """
+    parser.add_argument('--metrics', dest="metrics", action="store_true",
+                help="time each stage of each download and print a per-stage summary at the end")
+    parser.add_argument('--metrics-file', dest="metrics_file", type=str, default="",
+                help="also append each stage's timing, bytes, MB/s, retries and exit codes to this JSONL file (relative to OUTDIR); implies --metrics")
+
+def configure_metrics(args):
+    """
+    Sets up process-wide metrics collection from command-line `args`
+    (off unless asked for).
+    """
+    global _metrics
+    if _metrics is not None:
+        _metrics.close()
+    _metrics = None
+    if args.metrics or args.metrics_file != "":
+        path = os.path.join(args.outdir, args.metrics_file) if args.metrics_file != "" else None
+        _metrics = Metrics(path)
+    return _metrics
+
+def get_metrics():
+    """
+    Returns the process-wide metrics collector (None if disabled).
+    """
+    return _metrics
+
+@contextmanager
+def timed(acc, stage, **info):
+    """
+    Times the enclosed block as `stage` of `acc`. Yields a dict (starting
+    from `info`) for the block to add details to, e.g. `bytes_in`,
+    `bytes_out`, `retcode` or `attempt`; an exception is recorded as
+    the event's `error`. Costs next to nothing when metrics are off.
+    """
+    start = time.time()
+    began = time.monotonic()
+    try:
+        yield info
+    except Exception as e:
+        info["error"] = str(e)
+        raise
+    finally:
+        if _metrics is not None:
+            _metrics.record(acc, stage, start, time.monotonic() - began, **info)
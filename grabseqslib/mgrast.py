@@ -1,8 +1,23 @@
-import requests, os, json
-import pandas as pd
-from io import StringIO
-from subprocess import call
-from grabseqslib.utils import check_existing, fetch_file, check_filetype, fasta_to_fastq, gzip_files
+import os, json
+from concurrent.futures import ThreadPoolExecutor
+from grabseqslib.journal import Journal, ClaimSet, file_bytes
+from grabseqslib.verify import Manifest, verify_accession, MANIFEST_NAME
+from grabseqslib.compress import add_compress_args
+from grabseqslib.cache import add_cache_args, cached_get_text, CacheMiss
+from grabseqslib.net import lite_session, rate_limit
+from grabseqslib.metrics import add_metrics_args, timed
+from grabseqslib.utils import check_existing, fetch_file, check_filetype, fasta_to_fastq, gzip_files, stream_to_fastq_gz, split_threads, run_jobs, print_summary, \
+                              add_id_file_args, iter_ids, chunked, CSVAppender, MetadataAccumulator, DirectoryIndex, \
+                              add_shard_args, shard_items, hash_shard_items, positive_int
+
+# identifiers handled per batch in --stream mode
+STREAM_BATCH_SIZE = 100
+
+# MG-RAST API requests in flight at once while resolving identifiers,
+# if its host has no rate limit to size the pool by (see `resolve_mgrast_ids`)
+RESOLVE_CONCURRENCY = 16
+
+MGRAST_API = "http://api.metagenomics.anl.gov/"
 
 def add_mgrast_subparser(subparser):
     """
@@ -10,7 +25,7 @@ def add_mgrast_subparser(subparser):
     """
 
     parser_rast = subparser.add_parser('mgrast', help="download from MG-RAST")
-    parser_rast.add_argument('rastid', type=str, nargs='+', 
+    parser_rast.add_argument('rastid', type=str, nargs='*', 
                 help="One or more MG-RAST project or sample identifiers (mgp####/mgm######)")
 
     parser_rast.add_argument('-m', dest="metadata", type=str, default="",
@@ -20,32 +35,312 @@ def add_mgrast_subparser(subparser):
     parser_rast.add_argument('-r',dest="retries", type=int, default=0,
                 help="number of times to retry download")
     parser_rast.add_argument('-t',dest="threads", type=int, default=1,
-                help="threads to use (for pigz)")
+                help="threads to use (for pigz), split between concurrent jobs")
+    parser_rast.add_argument('-j', '--jobs', dest="jobs", type=positive_int, default=1,
+                help="number of samples to download concurrently")
 
     parser_rast.add_argument('-f', dest="force", action="store_true",
                 help = "force re-download of files")
     parser_rast.add_argument('-l', dest="list", action="store_true",
                 help="list (but do not download) samples to be grabbed")
+    parser_rast.add_argument('--resume', dest="resume", action="store_true",
+                help="pick up interrupted downloads at the stage they stopped (from the OUTDIR journal); existing .fastq.gz files must be gzip data to count as done")
+    parser_rast.add_argument('--verify', dest="verify", action="store_true",
+                help="check each sample's .fastq.gz files (gzip integrity, R1/R2 pairing) and record checksums in OUTDIR/"+MANIFEST_NAME)
+    parser_rast.add_argument('--pipe', dest="pipe", action="store_true",
+                help="stream downloads straight to .fastq.gz (no intermediate files)")
+    parser_rast.add_argument('--connections', dest="connections", type=int, default=1,
+                help="parallel connections (byte ranges) to use per file")
+    add_id_file_args(parser_rast)
+    add_shard_args(parser_rast)
+    add_metrics_args(parser_rast)
+    add_cache_args(parser_rast)
+    add_compress_args(parser_rast)
 
 def process_mgrast(args, zip_func):
     """
-    Top-level function to process MG-RAST download. Returns aggregated metadata.
+    Top-level function to process MG-RAST download. Returns aggregated metadata
+    and a dict of samples that failed to download.
+    """
+    if args.list: # API queries only, don't load requests
+        with lite_session():
+            return _process_mgrast_ids(args, zip_func)
+    return _process_mgrast_ids(args, zip_func)
+
+def _process_mgrast_ids(args, zip_func):
+    """
+    Resolves and downloads (or lists) the identifiers in `args`, for
+    `process_mgrast`.
     """
+    runner = MGRASTRunner(args, zip_func)
+
+    # In streaming mode, identifiers are handled a batch at a time and
+    # metadata goes straight to disk; otherwise everything is resolved first.
+    ids = iter_ids(args.rastid, args.from_file, args.column)
+    appender = None
+    if args.stream:
+        chunks = chunked(ids, STREAM_BATCH_SIZE)
+        if args.metadata != "":
+            appender = CSVAppender(os.path.join(args.outdir, args.metadata))
+    else:
+        chunks = [list(ids)]
+
+    target_all = []
+    target_seen = set()
+    failed = {}
     metadata_agg = None
-    for rast_proj in args.rastid:
-        # get targets
-        target_list = get_mgrast_acc_metadata(rast_proj)
-        for target in target_list:
-            # get samples and/or metadata
-            metadata_agg = download_mgrast_sample(target,
-                                                  args.retries,
-                                                  args.threads,
-                                                  args.outdir,
-                                                  args.force,
-                                                  args.list,
-                                                  not (args.metadata == ""),
-                                                  metadata_agg, zip_func)
-    return metadata_agg
+    for chunk in chunks:
+        # get targets, their file listings and (with -m) metadata, all at once
+        unresolved = {}
+        targets, listings, records = resolve_mgrast_ids(chunk, args.metadata != "", failed = unresolved)
+        # identifiers that didn't resolve fail on their own; the rest carry on
+        failed.update(unresolved)
+        target_all += list(unresolved)
+        target_list = []
+        for target in targets:
+            if target not in target_seen:
+                target_seen.add(target)
+                target_list.append(target)
+        if args.shard is not None and not args.list:
+            if args.stream: # batches are too small to balance by size
+                target_list = hash_shard_items(target_list, args.shard)
+            else:
+                sizes = dict((t, listing_size(listings.get(t))) for t in target_list)
+                target_list = shard_items(target_list, sizes, args.shard)
+
+        results, failed_chunk = runner.run(target_list, listings, records)
+        target_all += target_list
+        failed.update(failed_chunk)
+
+        # per-sample metadata, in input order
+        for t in results:
+            if type(results[t]) == type(None):
+                continue
+            if appender is not None:
+                appender.add_records(results[t].records)
+            elif type(metadata_agg) == type(None):
+                metadata_agg = results[t]
+            else:
+                metadata_agg.merge(results[t])
+
+    runner.close()
+    if not args.list:
+        print_summary(target_all, failed, runner.claimed_elsewhere)
+
+    if appender is not None:
+        print("Metadata saved to: " + appender.fp)
+    return metadata_agg, failed
+
+class MGRASTRunner:
+    """
+    Downloads (or, with -l, lists) MG-RAST samples with the options in
+    `args` (from the grabseqs argument parser), compressing with
+    `zip_func`. Holds what's shared between batches: the output
+    directory index, journal and verification manifest.
+    """
+    def __init__(self, args, zip_func):
+        self.args = args
+        self.zip_func = zip_func
+        self.stage_listings = {}
+        self.sample_records = {}
+
+        # split the CPU budget between concurrent jobs
+        self.threads = split_threads(args.threads, args.jobs)
+
+        # one scan of the output directory for all skip decisions; when
+        # resuming, files that aren't gzip data don't count as finished
+        self.index = DirectoryIndex(args.outdir, check_gzip = args.resume)
+        self.journal = Journal(args.outdir) if not args.list else None
+
+        # with --verify, each sample's files are checked once it's done
+        self.manifest = Manifest(args.outdir) if (args.verify and not args.list) else None
+
+        # with --claim, other processes sharing OUTDIR skip samples we're on
+        self.claims = ClaimSet(args.outdir, args.claim_timeout) if (args.claim and not args.list) else None
+        self.claimed_elsewhere = set()
+
+    def run(self, targets, listings = {}, records = {}, progress = None):
+        """
+        Downloads the samples in `targets`, using their already resolved
+        stage `listings` and metadata `records` where available. Calls
+        `progress(acc, state, error)` as each sample is "started", and
+        when it's "done", has "failed" (with the exception) or was
+        skipped because another process "claimed" it. Returns dicts of
+        results (per-sample metadata) and of failures.
+        """
+        self.stage_listings.update(listings)
+        self.sample_records.update(records)
+        if self.journal is not None:
+            for target in targets:
+                if self.journal.state(target) is None:
+                    self.journal.record(target, "resolved")
+
+        def job(target):
+            if progress is not None:
+                progress(target, "started", None)
+            try:
+                result = self.download(target)
+            except Exception as e:
+                if progress is not None:
+                    progress(target, "failed", e)
+                raise
+            if progress is not None:
+                progress(target, "claimed" if target in self.claimed_elsewhere else "done", None)
+            return result
+
+        return run_jobs(job, targets, self.args.jobs)
+
+    def download(self, target):
+        """
+        Downloads (and with --verify, verifies) sample `target`.
+        Returns its metadata, if asked for. Skips samples claimed by
+        another process.
+        """
+        if self.claims is not None:
+            if not self.claims.claim(target):
+                print(target+" is claimed by another worker, skipping")
+                self.claimed_elsewhere.add(target)
+                return None
+            self.index.refresh(target) # may have been finished elsewhere since we started
+        try:
+            return self._download(target)
+        finally:
+            if self.claims is not None:
+                self.claims.release(target)
+
+    def _download(self, target):
+        args = self.args
+        result = download_mgrast_sample(target,
+                                        args.retries,
+                                        self.threads,
+                                        args.outdir,
+                                        args.force,
+                                        args.list,
+                                        not (args.metadata == ""),
+                                        None, self.zip_func,
+                                        args.pipe,
+                                        args.connections,
+                                        self.index,
+                                        self.journal,
+                                        args.resume,
+                                        self.stage_listings.get(target),
+                                        self.sample_records.get(target))
+        if self.manifest is not None and self.journal.state(target) != "verified":
+            verify_accession(target, args.outdir, 0, self.manifest, self.journal)
+        return result
+
+    def close(self):
+        """
+        Releases any claims and closes the journal.
+        """
+        if self.claims is not None:
+            self.claims.close()
+        if self.journal is not None:
+            self.journal.close()
+
+def _is_json(text):
+    """
+    Checks that an API response is valid JSON without an error
+    message (i.e. worth caching).
+    """
+    try:
+        return "ERROR" not in json.loads(text)
+    except ValueError:
+        return False
+
+def _check_prefix(pacc):
+    """
+    Raises if `pacc` isn't an MG-RAST project (mgp) or sample (mgm) identifier.
+    """
+    if pacc[:3] not in ("mgm", "mgp"):
+        raise NameError("Unknown prefix: " + pacc[:3] + ". Should be 'mgm' or 'mgp'.")
+
+def _flatten_fields(data):
+    """
+    Values of an MG-RAST metadata export section (`data`, a dict of
+    field -> {"value": ...}) as a dict of field -> string.
+    """
+    fields = {}
+    for k in data:
+        v = data[k]
+        fields[k] = str(v["value"] if isinstance(v, dict) and "value" in v else v)
+    return fields
+
+# Where each field of a sample's MIxS summary (the "mixs" block of
+# /metadata/export/mgm..., which -m has always written) lives in its
+# project's export: (section, field) candidates, first one present wins.
+# Project exports are mapped onto these so the -m columns are the same
+# however a sample was requested.
+MIXS_FROM_EXPORT = {
+    "project_id": [("project", "id")],
+    "project_name": [("project", "name"), ("project", "project_name")],
+    "PI_firstname": [("project", "PI_firstname")],
+    "PI_lastname": [("project", "PI_lastname")],
+    "sample_id": [("sample", "id")],
+    "sample_name": [("sample", "sample_name"), ("sample", "name")],
+    "latitude": [("sample", "latitude")],
+    "longitude": [("sample", "longitude")],
+    "country": [("sample", "country")],
+    "location": [("sample", "location")],
+    "collection_date": [("sample", "collection_date")],
+    "biome": [("sample", "biome")],
+    "feature": [("sample", "feature")],
+    "material": [("sample", "material")],
+    "env_package_type": [("envPackage", "type"), ("sample", "env_package")],
+    "seq_method": [("library", "seq_meth")],
+    "sequence_type": [("library", "sequence_type"), ("library", "type")],
+}
+
+def _mixs_record(acc, sections):
+    """
+    Metadata record for sample `acc` with the keys of its MIxS summary
+    (see `MIXS_FROM_EXPORT`), filled from its project export `sections`
+    (section -> dict of field -> string). Missing fields are empty.
+    """
+    record = {"mgm_id": acc}
+    for key in sorted(MIXS_FROM_EXPORT.keys()):
+        value = ""
+        for section, field in MIXS_FROM_EXPORT[key]:
+            if sections[section].get(field, "") != "":
+                value = sections[section][field]
+                break
+        record[key] = value
+    return record
+
+def _named_section(section):
+    """
+    Fields of an export `section` (a sample, library, ...) as
+    `_flatten_fields` gives them, plus its own id, name and type.
+    """
+    fields = _flatten_fields(section.get("data", {}))
+    for k in ["id", "name", "type"]:
+        if section.get(k) is not None:
+            fields[k] = str(section[k])
+    return fields
+
+def get_mgrast_project(pacc):
+    """
+    Fetches the metadata export of MG-RAST project `pacc` (one request).
+    Returns the list of its mgm accession numbers, and a dict of mgm ->
+    metadata record built from the same export (with the same keys as
+    `get_mgrast_sample_record`), so samples don't need metadata
+    requests of their own. Raises ValueError if no samples are listed.
+    """
+    metadata_json = json.loads(cached_get_text(MGRAST_API+"metadata/export/"+pacc,
+                                               "mgrast-export:"+pacc, _is_json))
+    if "samples" not in metadata_json: # e.g. {"ERROR": ...} for an unknown project
+        raise ValueError("Could not find samples for project: "+pacc+" ("+str(metadata_json.get("ERROR", "no samples listed"))+")")
+    project = _named_section(metadata_json)
+    sample_list = []
+    records = {}
+    for sample in metadata_json["samples"]:
+        library = _named_section(sample["libraries"][0]) #metadata: ["data"]
+        acc = library["metagenome_id"]
+        sample_list.append(acc)
+        sections = {"project": project, "sample": _named_section(sample),
+                    "envPackage": _named_section(sample.get("envPackage", {})), "library": library}
+        records[acc] = _mixs_record(acc, sections)
+    return sample_list, records
 
 def get_mgrast_acc_metadata(pacc):
     """
@@ -53,26 +348,138 @@ def get_mgrast_acc_metadata(pacc):
     project. Takes project accession number `pacc` and returns a list of mgm
     accession numbers.
     """
+    _check_prefix(pacc)
     if pacc[:3] == "mgm":
         return [pacc]
-    elif pacc[:3] != "mgp":
-        raise NameError("Unknown prefix: " + pacc[:3] + ". Should be 'mgm' or 'mgp'.")
-    metadata_json = json.loads(requests.get("http://api.metagenomics.anl.gov/metadata/export/"+pacc).text)
-    sample_list = []
-    for sample in metadata_json["samples"]:
-        sample_list.append(sample["libraries"][0]["data"]["metagenome_id"]["value"]) #metadata: ["data"]
-    return sample_list
+    return get_mgrast_project(pacc)[0]
+
+def get_mgrast_stages(acc):
+    """
+    Fetches the listing of processing stages (files) available for
+    MG-RAST sample `acc`.
+    """
+    return json.loads(cached_get_text(MGRAST_API+"download/"+acc,
+                                      "mgrast-download:"+acc, _is_json))
 
-def download_mgrast_sample(acc, retries = 0, threads = 1, loc='', force=False, list_only=False, download_metadata=False, metadata_agg = None, zip_func = "gzip"):
+def listing_size(stage_json):
+    """
+    Total size in bytes of the read files (stages 050.1/050.2) in a
+    sample's stage listing, or 0 if unknown.
+    """
+    if stage_json is None:
+        return 0
+    sizes = [s.get("file_size") or 0 for s in stage_json.get("data", []) if s.get("file_id") in ("050.1", "050.2")]
+    try:
+        return sum([int(x) for x in sizes])
+    except ValueError:
+        return 0
+
+def get_mgrast_sample_record(acc):
+    """
+    Fetches the MIxS metadata of MG-RAST sample `acc` as a record.
+    """
+    metadata_json = json.loads(cached_get_text(MGRAST_API+"metadata/export/"+acc,
+                                               "mgrast-export:"+acc, _is_json))
+    sample_info = metadata_json["mixs"]
+    record = {"mgm_id": acc}
+    for x in sorted(sample_info.keys()):
+        record[x] = str(sample_info[x])
+    return record
+
+def _quietly(func, arg):
+    """
+    `func(arg)`, or None if it fails (the caller retries on its own later).
+    """
+    try:
+        return func(arg)
+    except Exception:
+        return None
+
+def _outcome(func, arg):
+    """
+    `func(arg)`, or the exception it raised.
+    """
+    try:
+        return func(arg)
+    except CacheMiss: # --offline stops the batch, as elsewhere
+        raise
+    except Exception as e:
+        return e
+
+def resolve_mgrast_ids(ids, download_metadata = False, concurrency = None, failed = None):
+    """
+    Resolves many MG-RAST identifiers (`ids`) concurrently, with up to
+    `concurrency` requests in flight over the shared (rate-limited)
+    session, by default as many as the API's rate limit allows per
+    second: all project exports first, then every sample's stage
+    listing and, with `download_metadata`, the metadata of samples not
+    already covered by their project's export. Returns the sample list
+    (in input order), and dicts of sample -> stage listing and sample
+    -> metadata record. Samples whose lookups failed are left out of
+    the dicts (and looked up again when downloaded). If a `failed` dict
+    is passed, identifiers that can't be resolved (bad prefixes, project
+    exports that fail) are recorded in it and the rest carry on;
+    otherwise they raise.
+    """
+    ids = [i.strip() for i in ids]
+    bad = {}
+    for pacc in ids:
+        try:
+            _check_prefix(pacc)
+        except NameError as e:
+            bad[pacc] = e
+    projects = list(dict.fromkeys(i for i in ids if i[:3] == "mgp"))
+    if concurrency is None:
+        # more in flight than the limiter lets through would only queue on it
+        concurrency = int(rate_limit(MGRAST_API) or RESOLVE_CONCURRENCY)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        exports = dict(zip(projects, pool.map(lambda pacc: _outcome(get_mgrast_project, pacc), projects)))
+        for pacc in projects:
+            if isinstance(exports[pacc], Exception):
+                bad[pacc] = exports[pacc]
+        if len(bad) > 0 and failed is None:
+            raise bad[[i for i in ids if i in bad][0]]
+        samples = []
+        records = {}
+        for pacc in ids:
+            if pacc in bad:
+                continue
+            if pacc[:3] == "mgm":
+                samples.append(pacc)
+            else:
+                samples += exports[pacc][0]
+                records.update(exports[pacc][1])
+        unique = list(dict.fromkeys(samples))
+        listings = dict(zip(unique, pool.map(lambda acc: _quietly(get_mgrast_stages, acc), unique)))
+        if download_metadata:
+            todo = [acc for acc in unique if acc not in records]
+            records.update(zip(todo, pool.map(lambda acc: _quietly(get_mgrast_sample_record, acc), todo)))
+    listings = dict((k, v) for k, v in listings.items() if v is not None)
+    records = dict((k, v) for k, v in records.items() if v is not None)
+    for pacc in bad:
+        print("Could not resolve "+pacc+": "+str(bad[pacc]))
+        failed[pacc] = bad[pacc]
+    return samples, listings, records
+
+def download_mgrast_sample(acc, retries = 0, threads = 1, loc='', force=False, list_only=False, download_metadata=False, metadata_agg = None, zip_func = "gzip", pipe=False, connections=1, index=None, journal=None, resume=False,
+                           stage_json = None, record = None):
     """
     Helper function to download original (uploaded) MG-RAST `acc`ession,
     with support for a particular number of `retries`. Can use multiple
     `threads` with pigz (if data are not already compressed on arrival).
-    Also will optionally `download_metadata`.
+    Also will optionally `download_metadata`. If `pipe`, each file is
+    converted and compressed as it streams in, with no intermediate files.
+    Otherwise files are fetched over up to `connections` parallel ranges.
+    Existing files are looked up in `index` (a `DirectoryIndex`), if given.
+    Progress is recorded in `journal`; with `resume`, files left over from
+    an interrupted attempt are picked up where they stopped. The sample's
+    stage listing (`stage_json`) and metadata `record` are fetched unless
+    already resolved (see `resolve_mgrast_ids`).
     """
     read_stages = ["050.1", "050.2"] # R1 and R2 (if paired)
 
-    stage_json = json.loads(requests.get("http://api.metagenomics.anl.gov/download/"+acc).text)
+    if stage_json is None:
+        stage_json = get_mgrast_stages(acc)
     stages_to_grab = []
     for stage in stage_json["data"]:
         if stage["file_id"] in read_stages:
@@ -87,48 +494,117 @@ def download_mgrast_sample(acc, retries = 0, threads = 1, loc='', force=False, l
         else:
             fext = ["_"+str(i+1) for i in range(len(stages_to_grab))] # paired
     if download_metadata:
-        metadata_json = json.loads(requests.get("http://api.metagenomics.anl.gov/metadata/export/"+acc).text)
-        sample_info = metadata_json["mixs"]
-        colnames = ["mgm_id"]+list(sorted(list(sample_info.keys())))
-        colvals = [acc]+[str(sample_info[x]) for x in colnames[1:]]
-        formatted_table = ','.join(colnames)+'\n'+','.join(colvals)
+        if record is None:
+            record = get_mgrast_sample_record(acc)
         if type(metadata_agg) == type(None):
-            metadata_agg = pd.read_csv(StringIO(formatted_table))
-        else:
-            metadata_agg = pd.concat([metadata_agg,pd.read_csv(StringIO(formatted_table))],sort=True)
+            metadata_agg = MetadataAccumulator()
+        metadata_agg.add_records([record])
     if list_only:
         print(','.join([acc+ext+".fastq.gz" for ext in fext]))
     else:
-        if not force:
-            found = check_existing(loc, acc)
+        stage = journal.state(acc) if (journal is not None and resume) else None
+        interrupted = stage in ("downloading", "dumped")
+        if not force and not interrupted:
+            found = check_existing(loc, acc, index, "PAIRED" if len(fext) == 2 else "SINGLE")
             if found != False:
                 print("found existing file matching acc:" + acc + ", skipping download. Pass -f to force download")
                 return metadata_agg
 
         fa_paths = [os.path.join(loc,acc+ext+".fasta") for ext in fext]
         fq_paths = [os.path.join(loc,acc+ext+".fastq") for ext in fext]
+        if journal is not None:
+            journal.record(acc, "downloading")
 
+        unrecognized = [] # stage files that weren't reads, so weren't compressed
         for i in range(len(fa_paths)):
             fa_path = fa_paths[i]
             fq_path = fq_paths[i]
-            file_url = "http://api.metagenomics.anl.gov/download/"+acc+"?file="+stages_to_grab[i]
-            retcode = fetch_file(file_url,fa_path,retries)
+            file_url = MGRAST_API+"download/"+acc+"?file="+stages_to_grab[i]
+            if interrupted:
+                # work out how far this file got last time
+                leftovers = [p for p in [fa_path, fa_path+".part", fq_path] if os.path.isfile(p)]
+                if os.path.isfile(fq_path+".gz") and len(leftovers) == 0:
+                    print("resuming "+acc+": "+fq_path+".gz already complete")
+                    continue
+                if os.path.isfile(fq_path):
+                    print("resuming "+acc+": compressing "+fq_path)
+                    with timed(acc, "compress", tool=zip_func, threads=threads) as m:
+                        m["bytes_in"] = file_bytes([fq_path])
+                        rzip = gzip_files(fq_path, zip_func, threads)
+                        m["retcode"] = rzip
+                        m["bytes_out"] = file_bytes([fq_path+".gz"])
+                    if rzip != 0:
+                        raise Exception("compression for "+acc+" failed.")
+                    continue
+            if pipe:
+                print("Streaming "+acc+" to "+fq_path+".gz")
+                with timed(acc, "stream", file=stages_to_grab[i], tool=zip_func, threads=threads) as m:
+                    ftype, retcode = stream_to_fastq_gz(file_url, fq_path+".gz", zip_func, threads, retries)
+                    m["retcode"] = retcode
+                    m["bytes_out"] = file_bytes([fq_path+".gz"])
+                if retcode != 0:
+                    if journal is not None:
+                        journal.record(acc, "failed", file=os.path.basename(fq_path+".gz"))
+                    raise Exception("streaming download for "+acc+" failed.")
+                if ftype == "":
+                    print("requested sample "+acc+" does not appear to be in .fasta or .fastq format. This may be because it is not publically accessible from MG-RAST.")
+                    unrecognized.append(stages_to_grab[i])
+                continue
+            if interrupted and os.path.isfile(fa_path):
+                print("resuming "+acc+": "+fa_path+" already downloaded")
+            else:
+                # resumes from fa_path.part if a previous attempt was cut off
+                with timed(acc, "download", file=stages_to_grab[i], connections=connections) as m:
+                    retcode = fetch_file(file_url,fa_path,retries,connections)
+                    m["retcode"] = retcode
+                    m["bytes_out"] = file_bytes([fa_path])
+                if retcode != 0:
+                    if journal is not None:
+                        journal.record(acc, "failed", file=os.path.basename(fa_path))
+                    raise Exception("download for "+acc+" failed.")
+            if journal is not None:
+                journal.record(acc, "dumped", file=os.path.basename(fa_path), bytes=file_bytes([fa_path]))
             ftype = check_filetype(fa_path)
             gzipped = ftype.endswith('.gz')
             if ftype.startswith("fasta"):
                 print("Converting .fasta to .fastq (adding dummy quality scores), compressing")
-                fasta_to_fastq(fa_path, fq_path, gzipped)
-                retcode = call(["rm "+fa_path], shell=True) # get rid of old fasta
-                rzip = gzip_files(fq_path, zip_func, threads)
-                #rzip = call(["pigz -f -p "+ str(threads) + ' ' + fq_path], shell=True)
+                # written to a .part so a cut-off conversion never looks finished
+                part = fq_path+".gz.part"
+                try:
+                    with timed(acc, "convert", file=stages_to_grab[i], tool=zip_func, threads=threads) as m:
+                        m["bytes_in"] = file_bytes([fa_path])
+                        rzip = fasta_to_fastq(fa_path, part, gzipped, zip_func=zip_func, threads=threads)
+                        m["retcode"] = rzip
+                        m["bytes_out"] = file_bytes([part])
+                    if rzip != 0:
+                        raise Exception("compression for "+acc+" failed.")
+                    os.replace(part, fq_path+".gz")
+                finally:
+                    if os.path.isfile(part):
+                        os.remove(part)
+                os.remove(fa_path) # get rid of old fasta
             elif ftype.startswith("fastq"):
                 if gzipped:
                     print("downloaded file in .fastq.gz format already!")
-                    call(["mv", fa_path, fq_path+".gz"])
+                    os.replace(fa_path, fq_path+".gz")
                 else:
                     print("downloaded file in .fastq format already, compressing .fastq")
-                    call(["mv", fa_path, fq_path])
-                    rzip = gzip_files(fq_path, zip_func, threads)
+                    os.replace(fa_path, fq_path)
+                    with timed(acc, "compress", file=stages_to_grab[i], tool=zip_func, threads=threads) as m:
+                        m["bytes_in"] = file_bytes([fq_path])
+                        rzip = gzip_files(fq_path, zip_func, threads)
+                        m["retcode"] = rzip
+                        m["bytes_out"] = file_bytes([fq_path+".gz"])
+                    if rzip != 0:
+                        raise Exception("compression for "+acc+" failed.")
             else:
                 print("requested sample "+acc+" does not appear to be in .fasta or .fastq format. This may be because it is not publically accessible from MG-RAST.")
+                unrecognized.append(stages_to_grab[i])
+        if index is not None:
+            index.refresh(acc)
+        if journal is not None:
+            if len(unrecognized) > 0:
+                journal.record(acc, "failed", failure="format", files=unrecognized)
+            else:
+                journal.record(acc, "compressed", bytes=file_bytes([p+".gz" for p in fq_paths]))
     return metadata_agg
@@ -0,0 +1,404 @@
+import os, time, random, threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlencode
+
+# requests (and urllib3, certifi...) take longer to import than a whole
+# listing run's API calls, so it's only loaded by PoliteSession, and
+# the modules imported here are kept light; see `lite_session`.
+_session = None
+_session_lock = threading.Lock()
+
+# requests/second allowed per API host (suffix match). NCBI allows 3/s,
+# or 10/s with an API key. MG-RAST doesn't publish a limit, so its API
+# (api.metagenomics.anl.gov, also reachable as api.mg-rast.org) gets no
+# more than NCBI grants keyed users. ENA's portal API asks for at most
+# 50/s; we stay well under that.
+RATE_LIMITS = {"ncbi.nlm.nih.gov": 3, "metagenomics.anl.gov": 10, "mg-rast.org": 10, "www.ebi.ac.uk": 20}
+NCBI_KEYED_RATE = 10
+
+# how many times to wait out a 429 (Too Many Requests) before giving up
+MAX_THROTTLE_RETRIES = 5
+
+_ncbi_api_key = ""
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter allowing `rate` calls per second (with
+    bursts of up to `burst`). Thread-safe; `acquire` blocks until a
+    call is allowed, and `pause` holds everyone off for a while (e.g.
+    when the server asks us to back off).
+    """
+    def __init__(self, rate, burst = 1):
+        self.rate = float(rate)
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.not_before = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Waits until a call is allowed, and takes a token for it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.not_before and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.not_before - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Allows no calls for the next `seconds`.
+        """
+        with self.lock:
+            self.not_before = max(self.not_before, time.monotonic() + seconds)
+            self.tokens = 0
+
+def _host_limit(host):
+    """
+    The `RATE_LIMITS` entry matching `host` as (suffix, rate), or None.
+    """
+    for suffix, rate in RATE_LIMITS.items():
+        if host == suffix or host.endswith("."+suffix):
+            if suffix == "ncbi.nlm.nih.gov" and _ncbi_api_key != "":
+                rate = NCBI_KEYED_RATE
+            return suffix, rate
+    return None
+
+def rate_limit(url):
+    """
+    Requests/second allowed to the host of `url` (see `RATE_LIMITS`),
+    or None if it isn't limited.
+    """
+    limit = _host_limit(urlsplit(url).hostname or "")
+    return limit[1] if limit is not None else None
+
+def get_bucket(host):
+    """
+    Returns the shared rate limiter for `host` (one per `RATE_LIMITS`
+    entry), or None if requests to `host` aren't limited.
+    """
+    limit = _host_limit(host)
+    if limit is None:
+        return None
+    with _buckets_lock:
+        if limit[0] not in _buckets:
+            _buckets[limit[0]] = TokenBucket(limit[1])
+        return _buckets[limit[0]]
+
+def set_ncbi_api_key(key):
+    """
+    Uses `key` (falling back to the NCBI_API_KEY environment variable)
+    for NCBI requests, which raises NCBI's rate limit.
+    """
+    global _ncbi_api_key
+    key = key if key else os.environ.get("NCBI_API_KEY", "")
+    with _buckets_lock:
+        _ncbi_api_key = key
+        _buckets.pop("ncbi.nlm.nih.gov", None) # rebuilt at the new rate
+    return key
+
+def retry_after(r, default):
+    """
+    Seconds to wait according to a response's Retry-After header
+    (either seconds or an HTTP date), or `default` if absent.
+    """
+    value = r.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+class PoliteSession:
+    """
+    HTTP session (a pooled `requests.Session`) that keeps to each API
+    host's rate limit (see `RATE_LIMITS`), adds the NCBI API key to NCBI
+    requests, and waits out 429 responses (honoring Retry-After) before
+    retrying them.
+    """
+    def __init__(self, pool_size = 16):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    def send(self, method, url, **kwargs):
+        return self.http.request(method, url, **kwargs)
+
+    def request(self, method, url, params = None, **kwargs):
+        host = urlsplit(url).hostname or ""
+        bucket = get_bucket(host)
+        if _ncbi_api_key != "" and (host == "ncbi.nlm.nih.gov" or host.endswith(".ncbi.nlm.nih.gov")):
+            params = dict(params or {})
+            params.setdefault("api_key", _ncbi_api_key)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            r = self.send(method, url, params=params, **kwargs)
+            if r.status_code != 429 or attempt >= MAX_THROTTLE_RETRIES:
+                return r
+            wait = retry_after(r, backoff_delay(attempt, 1, 60, jitter=True))
+            r.close()
+            print("rate limited by "+host+", waiting "+str(round(wait, 1))+"s")
+            if bucket is not None:
+                bucket.pause(wait)
+            else:
+                time.sleep(wait)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+class LiteResponse:
+    """
+    The parts of a `requests.Response` the API calls use, for
+    `LiteSession`: `status_code`, `headers`, `content` and `text`.
+    """
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode(self.headers.get_content_charset() or "utf-8", errors="replace")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError("HTTP "+str(self.status_code))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class LiteSession(PoliteSession):
+    """
+    `PoliteSession` over urllib rather than requests: no connection
+    pooling or streaming, but nothing slow to import. Used by runs that
+    only make a few API calls and download nothing (e.g. listing).
+    """
+    def __init__(self):
+        pass
+
+    def send(self, method, url, params = None, headers = None, timeout = 60, stream = False):
+        import urllib.request, urllib.error, http.client
+        if stream:
+            raise ValueError("LiteSession can't stream responses; downloads need a PoliteSession")
+        if params:
+            url += ("&" if "?" in url else "?") + urlencode(params)
+        req = urllib.request.Request(url, headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as r:
+                return LiteResponse(r.status, r.headers, r.read())
+        except urllib.error.HTTPError as e:
+            return LiteResponse(e.code, e.headers, e.read())
+        except http.client.HTTPException as e: # raised as OSError, like requests' errors
+            raise ConnectionError("request to "+url+" failed: "+repr(e))
+
+@contextmanager
+def lite_session():
+    """
+    Within the block, `get_session` hands out a `LiteSession`, for runs
+    that only query the APIs, so they never pay for importing requests.
+    The previous session is put back afterwards.
+    """
+    global _session
+    with _session_lock:
+        previous = _session
+        _session = LiteSession()
+    try:
+        yield _session
+    finally:
+        with _session_lock:
+            _session = previous
+
+def get_session(pool_size = 16):
+    """
+    Returns the process-wide `PoliteSession`, creating it on first
+    use. Connections are pooled (up to `pool_size` per host) and reused
+    by every download and API call, including from worker threads, and
+    requests are rate limited per host. Inside a `lite_session` block,
+    a `LiteSession` is returned instead.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = PoliteSession(pool_size)
+        return _session
+
+def backoff_delay(attempt, base = 1, cap = 60, jitter = False):
+    """
+    Capped exponential backoff: seconds to wait before retry number
+    `attempt` (0-based), starting at `base` and never above `cap`.
+    With `jitter`, a random delay between half and all of that is
+    returned instead, so parallel jobs don't retry in lockstep.
+    """
+    delay = min(cap, base * (2 ** attempt))
+    if jitter:
+        delay = random.uniform(delay / 2, delay)
+    return delay
+
+def _content_range_total(r):
+    """
+    Total file size from a response's Content-Range header
+    (`bytes a-b/total`), or None if absent or unknown.
+    """
+    cr = r.headers.get("Content-Range", "")
+    if "/" in cr and not cr.endswith("*"):
+        return int(cr.rsplit("/", 1)[1])
+    return None
+
+def _fetch_stream(session, url, part, chunk_size, timeout):
+    """
+    One attempt at downloading `url` into `part`, resuming from its
+    current size with an HTTP Range request. Returns True if the file
+    is complete (and matches the advertised length).
+    """
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    headers = {}
+    if offset > 0:
+        headers["Range"] = "bytes="+str(offset)+"-"
+    with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        if r.status_code == 416 and offset > 0:
+            # nothing left to fetch, check the .part against the server's size
+            if _content_range_total(r) in (None, offset):
+                return True
+            os.remove(part) # stale or oversized .part, start over next time
+            return False
+        r.raise_for_status()
+        if r.status_code == 206:
+            total = _content_range_total(r)
+            mode = 'ab'
+        else: # server ignored the Range header, start over
+            total = r.headers.get("Content-Length")
+            total = int(total) if total is not None else None
+            offset = 0
+            mode = 'wb'
+        if r.headers.get("Content-Encoding", "identity") != "identity":
+            total = None # length is of the encoded stream, can't verify
+        with open(part, mode) as f:
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+    if total is None:
+        return True
+    size = os.path.getsize(part)
+    if size > total:
+        os.remove(part)
+    return size == total
+
+def _probe(session, url, timeout):
+    """
+    Asks the server for the size of `url` and whether it accepts byte
+    ranges. Returns the total size, or None if ranges aren't supported.
+    """
+    with session.get(url, stream=True, headers={"Range": "bytes=0-0"}, timeout=timeout) as r:
+        if r.status_code != 206:
+            return None
+        if r.headers.get("Content-Encoding", "identity") != "identity":
+            return None
+        return _content_range_total(r)
+
+def _fetch_range(session, url, part, start, end, retries, chunk_size, timeout, backoff_base, backoff_cap):
+    """
+    Downloads bytes `start`-`end` (inclusive) of `url` into the same
+    offsets of `part`, retrying (and resuming) up to `retries` times.
+    """
+    pos = start
+    attempt = 0
+    while True:
+        try:
+            headers = {"Range": "bytes="+str(pos)+"-"+str(end)}
+            with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+                if r.status_code != 206:
+                    raise IOError("server did not honor range request ("+str(r.status_code)+")")
+                with open(part, 'r+b') as f:
+                    f.seek(pos)
+                    for chunk in r.iter_content(chunk_size):
+                        f.write(chunk[:end + 1 - pos])
+                        pos += len(chunk)
+            if pos >= end + 1:
+                return True
+            raise IOError("range "+str(start)+"-"+str(end)+" ended early")
+        except IOError as e: # requests' exceptions included
+            if attempt >= retries:
+                print("download of "+url+" failed: "+str(e))
+                return False
+            time.sleep(backoff_delay(attempt, backoff_base, backoff_cap))
+            attempt += 1
+
+def download(url, outfile, retries = 0, parts = 1, session = None, chunk_size = 1 << 16, timeout = 60, backoff_base = 1, backoff_cap = 60):
+    """
+    Downloads `url` to `outfile` over a pooled HTTP session. Data is
+    written to `outfile`.part, which is resumed with a Range request if
+    it already exists (e.g. after a dropped connection or an earlier
+    run), and renamed once its size matches the server's
+    Content-Length. Failed attempts are retried up to `retries` times
+    with capped exponential backoff. If `parts` > 1 and the server
+    supports ranges, the file is fetched as that many parallel byte
+    ranges. Returns 0 on success and 1 on failure.
+    """
+    from requests.exceptions import HTTPError
+    if session is None:
+        session = get_session()
+    part = outfile + ".part"
+
+    if parts > 1 and not os.path.isfile(part):
+        try:
+            total = _probe(session, url, timeout)
+        except IOError:
+            total = None
+        if total is not None and total >= parts:
+            with open(part, 'wb') as f:
+                f.truncate(total)
+            step = total // parts
+            bounds = [(i * step, (i + 1) * step - 1 if i < parts - 1 else total - 1) for i in range(parts)]
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=parts) as pool:
+                done = list(pool.map(lambda b: _fetch_range(session, url, part, b[0], b[1], retries,
+                                                               chunk_size, timeout, backoff_base, backoff_cap), bounds))
+            if all(done) and os.path.getsize(part) == total:
+                os.replace(part, outfile)
+                return 0
+            # ranged .part files can't be resumed sequentially
+            os.remove(part)
+            return 1
+
+    attempt = 0
+    while True:
+        try:
+            if _fetch_stream(session, url, part, chunk_size, timeout):
+                os.replace(part, outfile)
+                return 0
+            print("download of "+url+" incomplete (size mismatch)")
+        except HTTPError as e:
+            print("download of "+url+" failed: "+str(e))
+            if e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                return 1 # not going to get better by retrying
+        except IOError as e: # requests' exceptions included
+            print("download of "+url+" interrupted: "+str(e))
+        if attempt >= retries:
+            return 1
+        time.sleep(backoff_delay(attempt, backoff_base, backoff_cap))
+        attempt += 1
@@ -1,46 +1,511 @@
-import requests, time, shutil, sys
-import pandas as pd
+import time, shutil, os, csv
 from io import StringIO
-from subprocess import call
-from grabseqslib.utils import check_existing, build_paths, gzip_files
+from subprocess import PIPE
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from grabseqslib.compress import add_compress_args
+from grabseqslib.cache import add_cache_args, cached_get_text, get_cache
+from grabseqslib.net import get_session, lite_session, backoff_delay, set_ncbi_api_key
+from grabseqslib.journal import Journal, ClaimSet, file_bytes
+from grabseqslib.verify import Manifest, verify_accession, MANIFEST_NAME
+from grabseqslib.ena import get_ena_files, download_ena_run
+from grabseqslib.metrics import add_metrics_args, timed
+from grabseqslib.utils import check_existing, build_paths, gzip_files, split_threads, run_jobs, print_summary, \
+                              add_id_file_args, iter_ids, chunked, CSVAppender, MetadataAccumulator, DirectoryIndex, CompressedWriter, \
+                              DiskBudget, order_by_size, allocate_threads, popen_captured, call_captured, \
+                              add_shard_args, shard_items, hash_shard_items, run_pipeline, positive_int
+
+# runinfo columns kept per run for scheduling decisions
+RUN_INFO_FIELDS = ["LibraryLayout", "size_MB", "spots", "bases"]
+
+# fallback footprint of a run (uncompressed output and scratch) as a
+# multiple of its compressed size, when runinfo has no base/spot counts
+SIZE_EXPANSION = 10
+
+# fast(er)q-dump stderr fragments (lowercase) that mean retrying won't help,
+# or that the disk filled up; anything else is assumed to be transient
+PERMANENT_ERRORS = ["invalid accession", "not a valid", "item not found", "no data for",
+                    "access denied", "permission denied", "protected", "dbgap", "authorization", "forbidden",
+                    "unknown option", "cannot resolve accession"]
+DISK_FULL_ERRORS = ["no space left", "disk-limit exceeded", "storage exhausted", "not enough space",
+                    "enospc", "disk quota exceeded", "insufficient disk space"]
+
+# free bytes below which a failure is put down to a full disk
+DISK_FULL_FREE = 64 * 1024 * 1024
+
+RUNINFO_URL = "https://trace.ncbi.nlm.nih.gov/Traces/sra-db-be/sra-db-be.cgi?rettype=runinfo&term="
+
+def find_sra_tools(fastqdump = False, prefetch = False):
+    """
+    Checks that sra-tools is installed. Returns whether to use legacy
+    fastq-dump (if asked to with `fastqdump`, or if fasterq-dump is
+    missing); raises RuntimeError if neither is available, or if
+    `prefetch` is wanted but missing.
+    """
+    if prefetch and not shutil.which("prefetch"):
+        raise RuntimeError("prefetch not found; it is required for --prefetch. Please install sra-tools")
+    if not shutil.which("fasterq-dump"):
+        if not shutil.which("fastq-dump"): # no sra-tools
+            raise RuntimeError("Neither fastq-dump nor fasterq-dump found; one is required. Please install sra-tools")
+        return True
+    return fastqdump
 
 def process_sra(args, zip_func):
     """
     High-level logic for SRA download processing. Takes
-    `args` from grabseqslib argument parser and `zip_func`
+    `args` from grabseqslib argument parser and `zip_func`.
+    Returns aggregated metadata and a dict of runs that failed.
+    Raises RuntimeError if the sra-tools needed are missing.
     """
     # check deps
-    dep_list = ["fastq-dump", "fasterq-dump"]
-    deps_have = [shutil.which(dep) for dep in dep_list]
-    if (not deps_have[0]) and (not deps_have[1]): # no sra-tools
-        print("Neither fastq-dump nor fasterq-dump found; one is required. Please install sra-tools")
-        sys.exit(1)
-    elif not deps_have[1]:
-        use_fastq_dump = True
-    else:
+    try:
+        use_fastq_dump = find_sra_tools(args.fastqdump, args.prefetch and not args.list)
+    except RuntimeError:
+        if args.source != "ena" and not args.list: # listing and ENA-only downloads don't need sra-tools
+            raise
         use_fastq_dump = args.fastqdump
 
+    # a key raises NCBI's request rate limit
+    set_ncbi_api_key(args.ncbi_api_key)
+    if args.list: # runinfo queries only, don't load requests
+        with lite_session():
+            return _process_sra_ids(args, zip_func, use_fastq_dump)
+    return _process_sra_ids(args, zip_func, use_fastq_dump)
+
+def _process_sra_ids(args, zip_func, use_fastq_dump):
+    """
+    Resolves and downloads (or lists) the identifiers in `args`, for
+    `process_sra`.
+    """
     metadata_agg = None
+    acclist_all = []
+    acclist_seen = set()
+    failed = {}
+    runner = SRARunner(args, zip_func, use_fastq_dump) if not args.list else None
+
+    # In streaming mode, identifiers are resolved (and their runs downloaded)
+    # one batch at a time and metadata goes straight to disk; otherwise all
+    # identifiers are looked up up front.
+    ids = iter_ids(args.id, args.from_file, args.column)
+    appender = None
+    if args.stream:
+        chunks = chunked(ids, args.batch_size)
+        if args.metadata != "":
+            appender = CSVAppender(os.path.join(args.outdir, args.metadata))
+    else:
+        chunks = [list(ids)]
 
-    for sra_identifier in args.id:
+    for chunk in chunks:
+        unresolved = {}
+        acclist, run_info, metadata_agg = resolve_sra_runs(chunk,
+                                                           args.batch_size,
+                                                           args.outdir,
+                                                           args.list,
+                                                           not args.SRR_parsing,
+                                                           None if appender is not None else metadata_agg,
+                                                           appender,
+                                                           unresolved)
+        # identifiers that didn't resolve fail on their own; the rest carry on
+        failed.update(unresolved)
+        acclist_all += list(unresolved)
+        acclist_chunk = [acc for acc in acclist if acc not in acclist_seen]
+        acclist_seen.update(acclist_chunk)
+        if args.shard is not None and not args.list:
+            if args.stream: # batches are too small to balance by size
+                acclist_chunk = hash_shard_items(acclist_chunk, args.shard)
+            else:
+                sizes = dict((acc, run_size(run_info.get(acc, {}))) for acc in acclist_chunk)
+                acclist_chunk = shard_items(acclist_chunk, sizes, args.shard)
+
+        # get samples
+        if runner is not None:
+            results, failed_chunk = runner.run(acclist_chunk, run_info)
+            failed.update(failed_chunk)
+        acclist_all += acclist_chunk
+
+    if runner is not None:
+        runner.close()
+        if len(acclist_all) > 0:
+            print_summary(acclist_all, failed, runner.claimed_elsewhere)
+
+    if appender is not None:
+        print("Metadata saved to: " + appender.fp)
+        metadata_agg = None
+
+    return metadata_agg, failed
+
+def resolve_sra_runs(ids, batch_size = 100, loc = '', list_only = False, no_SRR_parsing = True, metadata_agg = None, appender = None,
+                     failed = None):
+    """
+    Resolves SRA identifiers (`ids`) to the runs to download, looking
+    runinfo up in batches of `batch_size` (see `resolve_sra_ids`) and
+    passing the remaining arguments on to `get_sra_acc_metadata`.
+    Runinfo is added to `metadata_agg` or, if given, written straight
+    to `appender`. Returns the run list (without duplicates), a dict of
+    run -> scheduling fields (`RUN_INFO_FIELDS`), and the metadata.
+    If a `failed` dict is passed, identifiers that can't be resolved
+    are recorded in it and the rest carry on; otherwise they raise.
+    """
+    runinfo = resolve_sra_ids(ids, batch_size)
+    acclist_all = []
+    run_info = {}
+    for sra_identifier in ids:
         # get targets and metadata
-        acclist, metadata_agg = get_sra_acc_metadata(sra_identifier,
-                                                     args.outdir,
-                                                     args.list,
-                                                     not args.SRR_parsing,
-                                                     metadata_agg)
+        n_known = len(metadata_agg) if (metadata_agg is not None and appender is None) else 0
+        try:
+            acclist, found_agg = get_sra_acc_metadata(sra_identifier,
+                                                      loc,
+                                                      list_only,
+                                                      no_SRR_parsing,
+                                                      None if appender is not None else metadata_agg,
+                                                      runinfo.get(sra_identifier.strip()))
+        except ValueError as e:
+            if failed is None:
+                raise
+            print(str(e))
+            failed[sra_identifier.strip()] = e
+            continue
+        metadata_agg = found_agg
+        if appender is not None:
+            appender.add_records(metadata_agg.records)
+        for record in (metadata_agg.records[n_known:] if metadata_agg is not None else []):
+            run_info[record.get("Run")] = dict((k, record.get(k)) for k in RUN_INFO_FIELDS)
+        acclist_all += acclist
+    return list(dict.fromkeys(acclist_all)), run_info, metadata_agg
+
+class SRARunner:
+    """
+    Downloads SRA runs with the options in `args` (from the grabseqs
+    argument parser), compressing with `zip_func` and using legacy
+    fastq-dump if `use_fastq_dump`. Holds what's shared between
+    batches: the output directory index and journal, background
+    compression/verification pools, and the disk-space budget.
+    With --prefetch, .sra files are fetched on a pool of their own and
+    converted locally, so transfers and conversion overlap. With
+    --source ena/auto, runs are copied from ENA's .fastq.gz files
+    where possible instead of being dumped.
+    """
+    def __init__(self, args, zip_func, use_fastq_dump = False):
+        self.args = args
+        self.zip_func = zip_func
+        self.use_fastq_dump = use_fastq_dump
+        self.run_info = {} # acc -> runinfo fields used for scheduling
+
+        # split the CPU budget between concurrent jobs; with sizes known,
+        # bigger runs get a bigger share (see allocate_threads below)
+        self.threads = split_threads(args.threads, args.jobs)
+        self.thread_alloc = {}
+        self.order = args.order
+        if self.order == "":
+            self.order = "largest-first" if args.jobs > 1 else "input"
+
+        # one scan of the output directory for all skip decisions; when
+        # resuming, files that aren't gzip data don't count as finished
+        self.index = DirectoryIndex(args.outdir, check_gzip = args.resume)
+        self.journal = Journal(args.outdir)
+
+        # with --pipe, compression of one run overlaps with dumping the next
+        self.compressor = ThreadPoolExecutor(max_workers=args.jobs) if args.pipe else None
+
+        # fasterq-dump scratch space, and admission control on free disk
+        if args.tmpdir != "" and not os.path.exists(args.tmpdir):
+            os.makedirs(args.tmpdir)
+        self.budget = DiskBudget(int(args.min_free * (1 << 30)))
+
+        # with --verify, each run's files are checked once it's done
+        self.manifest = Manifest(args.outdir) if args.verify else None
+        self.verifier = ThreadPoolExecutor(max_workers=args.jobs) if (args.verify and args.pipe) else None
+
+        # with --claim, other processes sharing OUTDIR skip runs we're on
+        self.claims = ClaimSet(args.outdir, args.claim_timeout) if args.claim else None
+        self.claimed_elsewhere = set()
+
+        # with --prefetch, where .sra files wait for conversion, and
+        # the disk reserved for each run from fetch until it's converted
+        self.sra_dir = args.tmpdir if args.tmpdir != "" else args.outdir
+        self.reservations = {}
+
+        # runs fetched from ENA (with --prefetch, in the fetch stage)
+        self.from_ena_done = set()
+
+    def run(self, acclist, run_info = {}, progress = None):
+        """
+        Downloads the runs in `acclist`, scheduled using their runinfo
+        fields (`run_info`). Calls `progress(acc, state, error)` as each
+        run is "started", and when it's "done", has "failed" (with the
+        exception) or was skipped because another process "claimed" it.
+        Returns dicts of results and of failures (acc -> exception), in
+        the order of `acclist`.
+        """
+        args = self.args
+        self.run_info.update(run_info)
         for acc in acclist:
-            # get samples
-            run_fasterq_dump(acc,
-                             args.retries,
-                             args.threads,
-                             args.outdir,
-                             args.force,
-                             use_fastq_dump,
-                             args.custom_fqd_args,
-                             zip_func)
+            if self.journal.state(acc) is None:
+                self.journal.record(acc, "resolved")
+
+        # schedule big runs first so they don't leave the other slots idle at the end
+        sizes = dict((acc, run_size(self.run_info.get(acc, {}))) for acc in acclist)
+        scheduled = order_by_size(acclist, sizes, self.order)
+        self.thread_alloc.update(allocate_threads(scheduled, sizes, args.threads, args.jobs))
+
+        def reported(acc, func, *func_args, finishes = True):
+            # reports each run as it finishes, including in the background
+            try:
+                result = func(*func_args)
+            except Exception as e:
+                if progress is not None:
+                    progress(acc, "failed", e)
+                raise
+            if progress is None or not finishes:
+                return result
+            if result is None:
+                progress(acc, "claimed" if acc in self.claimed_elsewhere else "done", None)
+            else:
+                result.add_done_callback(lambda f: progress(acc, "failed" if f.exception() else "done", f.exception()))
+            return result
+
+        def job(acc):
+            if progress is not None:
+                progress(acc, "started", None)
+            return reported(acc, self.download, acc)
 
-    return metadata_agg
+        if args.prefetch:
+            # network-bound fetches feed CPU-bound conversions through a bounded queue
+            def fetch(acc):
+                if progress is not None:
+                    progress(acc, "started", None)
+                return reported(acc, self.fetch, acc, finishes=False)
+            def convert(acc, sra):
+                return reported(acc, self.convert, acc, sra)
+            results, failed = run_pipeline(fetch, convert, scheduled, args.prefetch_jobs,
+                                           args.jobs, args.prefetch_queue)
+        else:
+            results, failed = run_jobs(job, scheduled, args.jobs)
+
+        # wait for any compression handed off to the background
+        for acc in results:
+            if results[acc] is not None:
+                try:
+                    results[acc].result()
+                except Exception as e:
+                    print("processing "+acc+" failed: "+str(e))
+                    failed[acc] = e
+        results = dict((acc, results.get(acc)) for acc in acclist if acc not in failed)
+        failed = dict((acc, failed[acc]) for acc in acclist if acc in failed)
+        return results, failed
+
+    def verify(self, acc):
+        """
+        Verifies the files of run `acc` (unless already verified).
+        """
+        if self.journal.state(acc) == "verified":
+            return # checked on an earlier run
+        spots = _runinfo_int(self.run_info.get(acc, {}), "spots") if self.args.custom_fqd_args == "" else 0
+        verify_accession(acc, self.args.outdir, spots, self.manifest, self.journal)
+
+    def _verify_after(self, compressing, acc):
+        compressing.result()
+        self.verify(acc)
+
+    def _claim(self, acc):
+        """
+        Claims `acc` (with --claim). Returns False if another process has.
+        """
+        if self.claims is None:
+            return True
+        if not self.claims.claim(acc):
+            print(acc+" is claimed by another worker, skipping")
+            self.claimed_elsewhere.add(acc)
+            return False
+        self.index.refresh(acc) # may have been finished elsewhere since we started
+        return True
+
+    def _unclaim_after(self, acc, func, *func_args):
+        """
+        Returns `func(*func_args)`, releasing the claim on `acc` once it
+        (or the Future it returns) is done.
+        """
+        if self.claims is None:
+            return func(*func_args)
+        try:
+            result = func(*func_args)
+        except Exception:
+            self.claims.release(acc)
+            raise
+        if result is None:
+            self.claims.release(acc)
+        else:
+            result.add_done_callback(lambda f: self.claims.release(acc))
+        return result
+
+    def download(self, acc):
+        """
+        Downloads run `acc` once there's disk space for it, unless another
+        process has claimed it. Returns None, or a Future if it's still
+        being compressed/verified.
+        """
+        if not self._claim(acc):
+            return None
+        return self._unclaim_after(acc, self._download, acc)
+
+    def fetch(self, acc):
+        """
+        First stage with --prefetch: reserves disk space for run `acc`
+        and fetches its .sra file. Returns the .sra path, None if the
+        run doesn't need one (already downloaded, or dumped and being
+        resumed), or False if another process has claimed it.
+        """
+        args = self.args
+        if not self._claim(acc):
+            return False
+        stage = self.journal.state(acc) if args.resume else None
+        if stage == "dumped":
+            return None
+        if not args.force and stage not in ("downloading", "fetched"):
+            if check_existing(args.outdir, acc, self.index, self.run_info.get(acc, {}).get("LibraryLayout")) != False:
+                return None
+        try:
+            if self.from_ena(acc):
+                return None # nothing to convert
+        except Exception:
+            if self.claims is not None:
+                self.claims.release(acc)
+            raise
+        needs = self.footprint(acc)
+        needs[self.sra_dir] = needs.get(self.sra_dir, 0) + run_size(self.run_info.get(acc, {}))
+        reservation = self.budget.acquire(needs, acc)
+        try:
+            # prefetch renames a .sra into place once it's complete, so one left over is usable
+            sra = find_sra_file(acc, self.sra_dir) if args.resume else None
+            if sra is not None:
+                print("resuming "+acc+" from "+sra)
+            else:
+                sra = run_prefetch(acc, args.retries, self.sra_dir, self.journal, args.retry_base, args.retry_cap)
+        except Exception:
+            self.budget.release(reservation)
+            if self.claims is not None:
+                self.claims.release(acc)
+            raise
+        self.reservations[acc] = reservation
+        return sra
+
+    def convert(self, acc, sra):
+        """
+        Second stage with --prefetch: dumps and compresses run `acc` from
+        its fetched .sra file `sra` (see `fetch`), then removes the .sra.
+        If conversion fails the .sra is kept, so a retry (--resume)
+        doesn't fetch it again.
+        """
+        if sra is False:
+            return None
+        return self._unclaim_after(acc, self._convert, acc, sra)
+
+    def _convert(self, acc, sra):
+        result = self._download(acc, sra, self.reservations.pop(acc, None))
+        if sra is not None:
+            remove_sra_file(acc, sra)
+        return result
+
+    def footprint(self, acc):
+        """
+        Estimated disk usage of run `acc` (see `estimate_footprint`).
+        """
+        args = self.args
+        return estimate_footprint(self.run_info.get(acc, {}), args.outdir, args.tmpdir,
+                                  self.use_fastq_dump, args.pipe)
+
+    def _download(self, acc, sra = None, reservation = None):
+        if reservation is None:
+            reservation = self.budget.acquire(self.footprint(acc), acc)
+        try:
+            result = self.dump(acc, sra)
+        except Exception:
+            self.budget.release(reservation)
+            raise
+        if result is None:
+            self.budget.release(reservation)
+            if self.manifest is not None:
+                self.verify(acc)
+        else: # still compressing in the background
+            result.add_done_callback(lambda f: self.budget.release(reservation))
+            if self.verifier is not None:
+                result = self.verifier.submit(self._verify_after, result, acc)
+        return result
+
+    def from_ena(self, acc):
+        """
+        With --source ena/auto, downloads run `acc`'s .fastq.gz files
+        from ENA. Returns True if that's done (or already was), and
+        False to use sra-tools instead: for runs already downloaded
+        (left to `run_fasterq_dump` to report), part-way through
+        sra-tools, or, with auto, not (intact) at ENA.
+        """
+        args = self.args
+        if args.source == "sra":
+            return False
+        if acc in self.from_ena_done:
+            return True
+        stage = self.journal.state(acc) if args.resume else None
+        if stage in ("fetched", "dumped"):
+            return False
+        layout = self.run_info.get(acc, {}).get("LibraryLayout")
+        if not args.force and stage != "downloading" and check_existing(args.outdir, acc, self.index, layout) != False:
+            return False
+        try:
+            files = get_ena_files(acc)
+        except (OSError, LookupError) as e: # requests' exceptions are OSErrors
+            print("ENA lookup for "+acc+" failed: "+str(e))
+            files = []
+        if len(files) == 0:
+            if args.source == "ena":
+                raise Exception(acc+" has no FASTQ files at ENA")
+            print(acc+" has no FASTQ files at ENA, using sra-tools")
+            return False
+        try:
+            download_ena_run(acc, files, args.outdir, args.retries, self.index, self.journal,
+                             args.retry_base, args.retry_cap)
+        except Exception as e:
+            if args.source == "ena":
+                raise
+            print(str(e)+", using sra-tools")
+            return False
+        self.from_ena_done.add(acc)
+        return True
+
+    def dump(self, acc, sra = None):
+        args = self.args
+        if sra is None and self.from_ena(acc):
+            return None
+        return run_fasterq_dump(acc,
+                                args.retries,
+                                self.thread_alloc.get(acc, self.threads),
+                                args.outdir,
+                                args.force,
+                                self.use_fastq_dump,
+                                args.custom_fqd_args,
+                                self.zip_func,
+                                self.index,
+                                self.journal,
+                                args.resume,
+                                self.run_info.get(acc, {}).get("LibraryLayout"),
+                                args.pipe,
+                                self.compressor,
+                                args.tmpdir,
+                                args.retry_base,
+                                args.retry_cap,
+                                sra)
+
+    def close(self):
+        """
+        Waits for background work and closes the journal.
+        """
+        if self.compressor is not None:
+            self.compressor.shutdown()
+        if self.verifier is not None:
+            self.verifier.shutdown()
+        if self.claims is not None:
+            self.claims.close()
+        self.journal.close()
 
 
 def add_sra_subparser(subparser):
@@ -49,7 +514,7 @@ def add_sra_subparser(subparser):
     """
     # Parser
     parser_sra = subparser.add_parser('sra', help="download from SRA")
-    parser_sra.add_argument('id', type=str, nargs='+', 
+    parser_sra.add_argument('id', type=str, nargs='*', 
                 help="One or more BioProject, ERR/SRR or ERP/SRP number(s)")
 
     # Options
@@ -59,14 +524,42 @@ def add_sra_subparser(subparser):
                 help="directory in which to save output. created if it doesn't exist")
     parser_sra.add_argument('-r',dest="retries", type=int, default=2,
                 help="number of times to retry download")
+    parser_sra.add_argument('--retry-base', dest="retry_base", type=float, default=5,
+                help="seconds to wait before the first retry; doubles (with jitter) on each further retry")
+    parser_sra.add_argument('--retry-cap', dest="retry_cap", type=float, default=300,
+                help="longest wait between retries, in seconds")
     parser_sra.add_argument('-t',dest="threads", type=int, default=1,
-                help="threads to use (for fasterq-dump/pigz)")
+                help="threads to use (for fasterq-dump/pigz), split between concurrent jobs")
+    parser_sra.add_argument('-j', '--jobs', dest="jobs", type=positive_int, default=1,
+                help="number of accessions to download concurrently")
 
     # General flags
     parser_sra.add_argument('-f', dest="force", action="store_true",
                 help = "force re-download of files")
     parser_sra.add_argument('-l', dest="list", action="store_true",
                 help="list (but do not download) samples to be grabbed")
+    parser_sra.add_argument('--pipe', dest="pipe", action="store_true",
+                help="stream single-end runs straight into the compressor, and compress paired runs while the next run dumps")
+    parser_sra.add_argument('--order', dest="order", type=str, default="",
+                choices=["input", "largest-first", "smallest-first"],
+                help="order in which to download runs (default: largest-first with -j > 1, otherwise input)")
+    parser_sra.add_argument('--source', dest="source", type=str, default="sra",
+                choices=["sra", "ena", "auto"],
+                help="where to get reads: dump them with sra-tools (sra), copy ENA's .fastq.gz files (ena), or ENA where available, otherwise sra-tools (auto). default: sra")
+    parser_sra.add_argument('--prefetch', dest="prefetch", action="store_true",
+                help="fetch .sra files with prefetch on a pool of their own, converting them locally (on -j workers) while later runs download")
+    parser_sra.add_argument('--prefetch-jobs', dest="prefetch_jobs", type=positive_int, default=2,
+                help="number of .sra files to fetch concurrently with --prefetch (default: 2)")
+    parser_sra.add_argument('--prefetch-queue', dest="prefetch_queue", type=positive_int, default=2,
+                help="number of fetched .sra files that may wait for conversion before fetching pauses (default: 2)")
+    parser_sra.add_argument('--tmpdir', dest="tmpdir", type=str, default="",
+                help="scratch directory for fasterq-dump temporary files (e.g. local SSD)")
+    parser_sra.add_argument('--min-free', dest="min_free", type=float, default=1,
+                help="GB of disk space to leave free when deciding whether a download can start")
+    parser_sra.add_argument('--verify', dest="verify", action="store_true",
+                help="check each run's .fastq.gz files (gzip integrity, read counts, R1/R2 pairing) and record checksums in OUTDIR/"+MANIFEST_NAME)
+    parser_sra.add_argument('--resume', dest="resume", action="store_true",
+                help="pick up interrupted downloads at the stage they stopped (from the OUTDIR journal); existing .fastq.gz files must be gzip data to count as done")
 
     # SRA-specific flags
     parser_sra.add_argument('--parse_run_ids', dest="SRR_parsing", action="store_true", 
@@ -76,26 +569,114 @@ def add_sra_subparser(subparser):
     parser_sra.add_argument("--custom_fqdump_args", dest="custom_fqd_args", type=str, default="",
                 help="'string' containing args to pass to fast(er)q-dump")
 
+    add_id_file_args(parser_sra)
+    add_shard_args(parser_sra)
+    parser_sra.add_argument('--batch-size', dest="batch_size", type=int, default=100,
+                help="number of identifiers to look up per runinfo query")
+    add_cache_args(parser_sra)
+    add_compress_args(parser_sra)
+    add_metrics_args(parser_sra)
+    parser_sra.add_argument('--ncbi-api-key', dest="ncbi_api_key", type=str, default="",
+                help="NCBI API key, allowing more requests per second (default: $NCBI_API_KEY)")
+
     # LEGACY: this will be removed in the next major version as this is now default.
     parser_sra.add_argument('--no_parsing', dest="no_SRR_parsing", action="store_true", 
                 help="Legacy option to not parse SRR IDs (now default)")
 
 
-def get_sra_acc_metadata(pacc, loc = '', list_only = False, no_SRR_parsing = True, metadata_agg = None):
+def _runinfo_ok(text):
+    """
+    Checks that a runinfo response has a header (i.e. the search worked).
+    """
+    return "Run" in text.split("\n")[0].split(',')
+
+def get_runinfo_text(pacc):
+    """
+    Fetches the runinfo table (.csv text) for a single SRA identifier
+    `pacc`, going through the metadata cache.
+    """
+    return cached_get_text(RUNINFO_URL+pacc, "sra-runinfo:"+pacc, _runinfo_ok)
+
+def _fetch_runinfo_batch(batch):
+    """
+    Runs one OR-joined runinfo query for the identifiers in `batch`
+    and splits the combined table back out per identifier. Returns a
+    dict of identifier -> runinfo text for identifiers with any runs.
+    """
+    try:
+        with timed(batch[0], "runinfo", ids=len(batch)) as m:
+            r = get_session().get(RUNINFO_URL+quote(" OR ".join(batch)), timeout=120)
+            m["bytes_in"] = len(r.content)
+    except OSError:
+        return {}
+    if not _runinfo_ok(r.text):
+        return {}
+    lines = r.text.split("\n")
+    header = lines[0]
+    wanted = set(batch)
+    matched = {acc: [] for acc in batch}
+    for line in lines[1:]:
+        if len(line.strip()) == 0 or line == header:
+            continue
+        # a row belongs to every requested identifier that appears in it
+        # (run, experiment, study, BioProject, sample, ...)
+        for cell in wanted.intersection(next(csv.reader([line]))):
+            matched[cell].append(line)
+    return {acc: "\n".join([header] + matched[acc]) + "\n" for acc in batch if len(matched[acc]) > 0}
+
+def resolve_sra_ids(ids, batch_size = 100, jobs = 3):
+    """
+    Looks up runinfo for many SRA identifiers (`ids`) with as few
+    requests as possible: cached identifiers are served from the
+    metadata cache, the rest are OR-joined into queries of up to
+    `batch_size` identifiers run `jobs` at a time over the shared
+    session. Returns a dict of identifier -> runinfo text. Identifiers
+    that couldn't be resolved in a batch are left out (and are looked
+    up individually by `get_sra_acc_metadata`).
+    """
+    ids = list(dict.fromkeys(i.strip() for i in ids))
+    resolved = {}
+    cache = get_cache()
+    todo = []
+    for acc in ids:
+        text = cache.get("sra-runinfo:"+acc) if cache is not None else None
+        if text is not None:
+            resolved[acc] = text
+        else:
+            todo.append(acc)
+    if len(todo) == 0 or (cache is not None and cache.offline):
+        return resolved
+
+    batch_size = max(1, batch_size)
+    batches = [todo[i:i+batch_size] for i in range(0, len(todo), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(batches)))) as pool:
+        for found in pool.map(_fetch_runinfo_batch, batches):
+            for acc in found:
+                resolved[acc] = found[acc]
+                if cache is not None:
+                    cache.put("sra-runinfo:"+acc, found[acc])
+    return resolved
+
+def get_sra_acc_metadata(pacc, loc = '', list_only = False, no_SRR_parsing = True, metadata_agg = None, metadata_text = None):
     """
     Function to get list of SRA accession numbers from a particular project.
     Takes project accession number `pacc` and returns a list of SRA 
-    accession numbers. Optional arguments to `save` metadata .csv in a specified
-    `loc`ation.
+    accession numbers, with its runinfo added to `metadata_agg` (a
+    `MetadataAccumulator`, created if None). Optional arguments to `save` metadata .csv in a specified
+    `loc`ation. Runinfo already fetched (e.g. by `resolve_sra_ids`) can be
+    passed as `metadata_text`.
     Originally featured in: https://github.com/louiejtaylor/hisss
     """
     # Grab metadata for given accession number    
     pacc = pacc.strip()
-    metadata = requests.get("https://trace.ncbi.nlm.nih.gov/Traces/sra-db-be/sra-db-be.cgi?rettype=runinfo&term="+pacc)
-    lines = [l.split(',') for l in metadata.text.split("\n")]
+    if metadata_text is None:
+        with timed(pacc, "runinfo", ids=1) as m:
+            metadata_text = get_runinfo_text(pacc)
+            m["bytes_in"] = len(metadata_text)
+    lines = [l for l in csv.reader(StringIO(metadata_text)) if len(l) > 0]
     try:
         run_col = lines[0].index("Run")
-    except ValueError: # "Run" column always present unless search failed
+    except (ValueError, IndexError): # "Run" column always present unless search failed
         raise ValueError("Could not find samples for accession: "+pacc+". If this accession number is valid, try re-running.")
 
     # Generate list of runs to download
@@ -103,9 +684,8 @@ def get_sra_acc_metadata(pacc, loc = '', list_only = False, no_SRR_parsing = Tru
 
     # Aggregate metadata if multiple samples/projects are being asked for
     if type(metadata_agg) == type(None):
-        metadata_agg = pd.read_csv(StringIO(metadata.text))
-    else:
-        metadata_agg = metadata_agg.append(pd.read_csv(StringIO(metadata.text)),sort=True)
+        metadata_agg = MetadataAccumulator()
+    metadata_agg.add_table(lines[0], lines[1:])
 
     if list_only: 
         # Do not download but read metadata and say what will be downloaded
@@ -135,55 +715,347 @@ def get_sra_acc_metadata(pacc, loc = '', list_only = False, no_SRR_parsing = Tru
         # otherwise, return all the Run accessions associated with whatever identifier was passed.
         return run_list, metadata_agg
 
-def run_fasterq_dump(acc, retries = 2, threads = 1, loc='', force=False, fastqdump=False, custom_args="", zip_func="gzip"):
+def _runinfo_int(info, key):
     """
-    Helper function to run fast(er)q-dump to grab a particular `acc`ession,
-    with support for a particular number of `retries`. Can use multiple
-    `threads`.
+    Integer value of runinfo column `key` from `info`, or 0.
     """
-    skip = False
-    retcode = 1
-    while retries >= 0:
-        if not force:
-            found = check_existing(loc, acc)
-            if found != False:
-                print("found existing file matching acc:" + acc + ", skipping download. Pass -f to force download")
-                skip = True
-                break
-        if not skip:
-            if len(custom_args) == 0:
-                if fastqdump: # use legacy fastq-dump
-                    cmd = ["fastq-dump", "--gzip", "--split-3", "--skip-technical"]
-                else:
-                    cmd = ["fasterq-dump", "-e", str(threads), "-f", "-3"]
+    try:
+        return int(float(info.get(key) or 0))
+    except ValueError:
+        return 0
+
+def run_size(info):
+    """
+    Relative size of a run from its runinfo fields (`info`), for
+    scheduling: compressed size_MB if known, otherwise bases.
+    """
+    size = _runinfo_int(info, "size_MB") * 1000000
+    if size <= 0:
+        size = _runinfo_int(info, "bases")
+    return size
+
+def estimate_footprint(info, loc = '', tmpdir = '', fastqdump = False, pipe = False):
+    """
+    Estimates the peak disk usage of downloading a run, from its
+    runinfo fields (`info`: size_MB, bases, spots, LibraryLayout).
+    Returns a dict of path -> bytes covering the output directory
+    `loc` and, for fasterq-dump, its scratch directory `tmpdir`.
+    """
+    compressed = _runinfo_int(info, "size_MB") * 1000000
+    bases = _runinfo_int(info, "bases")
+    if bases > 0:
+        # sequence + quality, plus headers for each spot
+        uncompressed = 2 * bases + 60 * _runinfo_int(info, "spots")
+    else:
+        uncompressed = SIZE_EXPANSION * compressed
+    streamed = pipe and info.get("LibraryLayout") == "SINGLE"
+    if fastqdump: # writes .fastq.gz directly
+        needs = {loc: 2 * compressed}
+    elif streamed: # no uncompressed copy in `loc`
+        needs = {loc: compressed}
+    else:
+        needs = {loc: uncompressed + compressed}
+    if not fastqdump: # fasterq-dump's temporary files
+        scratch = tmpdir if tmpdir != '' else loc
+        needs[scratch] = needs.get(scratch, 0) + uncompressed
+    return needs
+
+def build_dump_cmd(acc, threads = 1, loc = '', fastqdump = False, custom_args = "", stdout = False, tmpdir = ''):
+    """
+    Builds the fast(er)q-dump command line for `acc`. With `stdout`,
+    reads are written to standard output instead of files in `loc`.
+    fasterq-dump keeps its temporary files in `tmpdir`, if given.
+    """
+    if len(custom_args) == 0:
+        if fastqdump: # use legacy fastq-dump
+            if stdout:
+                cmd = ["fastq-dump", "--skip-technical", "-Z"]
             else:
-                suffix = "er"
-                if fastqdump:
-                    suffix = ""
-                prog_to_run = "fast" + suffix + "q-dump"
-                cmd = [prog_to_run] + custom_args.split(' ')
-            if loc != "":
-                cmd = cmd + ['-O', loc]
-            cmd = cmd + [acc]
-            print("running: "+" ".join(cmd))
-            retcode = call(cmd)
-            rgzip = 0
-            if retcode == 0:
-                if not fastqdump:
-                    # zip all possible output files for that acc
-                    fnames = build_paths(acc, loc, False) + build_paths(acc, loc, True)
-                    rgzip = gzip_files(fnames, zip_func, threads)
-                if rgzip == 0:
-                    if check_existing(loc, acc) != False:
-                        break
-
-            # only here if downloading and zipping failed
-            print("SRA download for acc "+acc+" failed, retrying "+str(retries)+" more times.")
-            if retries > 0:
-                time.sleep(100) #TODO?: user-modifiable
-                retries -= 1
+                cmd = ["fastq-dump", "--gzip", "--split-3", "--skip-technical"]
+        else:
+            if stdout:
+                cmd = ["fasterq-dump", "-e", str(threads), "-Z"]
             else:
-                raise Exception("download for "+acc+" failed. fast(er)q-dump returned "+str(retcode)+", pigz returned "+str(rgzip)+".")
+                cmd = ["fasterq-dump", "-e", str(threads), "-f", "-3"]
+    else:
+        suffix = "er"
+        if fastqdump:
+            suffix = ""
+        prog_to_run = "fast" + suffix + "q-dump"
+        cmd = [prog_to_run] + custom_args.split(' ')
+    if loc != "" and not stdout:
+        cmd = cmd + ['-O', loc]
+    if tmpdir != "" and not fastqdump:
+        cmd = cmd + ['-t', tmpdir]
+    return cmd + [acc]
+
+def find_sra_file(acc, loc = ''):
+    """
+    Path of the .sra (or .sralite) file prefetch fetched for `acc` into
+    `loc`, or None.
+    """
+    for d in (os.path.join(loc, acc), loc):
+        for ext in (".sra", ".sralite"):
+            fp = os.path.join(d, acc+ext)
+            if os.path.isfile(fp):
+                return fp
+    return None
+
+def remove_sra_file(acc, sra):
+    """
+    Removes a converted .sra file `sra`, and the directory prefetch
+    made for `acc` if that's now empty.
+    """
+    if os.path.isfile(sra):
+        os.remove(sra)
+    d = os.path.dirname(sra)
+    if os.path.basename(d) == acc:
+        try:
+            os.rmdir(d)
+        except OSError: # not empty
+            pass
+
+def run_prefetch(acc, retries = 2, loc = '', journal = None, retry_base = 5, retry_cap = 300):
+    """
+    Fetches the .sra file for `acc` into `loc` with prefetch, with
+    failures classified and retried like dumps (see `run_fasterq_dump`).
+    Returns the path of the .sra file.
+    """
+    attempt = 0
+    while True:
+        cmd = ["prefetch", "--max-size", "u", "-O", loc if loc != '' else ".", acc]
+        if journal is not None:
+            journal.record(acc, "downloading")
+        print("running: "+" ".join(cmd))
+        with timed(acc, "prefetch", attempt=attempt) as m:
+            retcode, err = call_captured(cmd)
+            sra = find_sra_file(acc, loc)
+            m["retcode"] = retcode
+            m["bytes_out"] = file_bytes([sra]) if sra is not None else 0
+        if retcode == 0 and sra is not None:
+            if journal is not None:
+                journal.record(acc, "fetched", bytes=file_bytes([sra]))
+            return sra
+        kind = classify_failure(retcode, err, loc)
+        if kind == "permanent" or attempt >= retries:
+            if journal is not None:
+                journal.record(acc, "failed", stage="prefetch", failure=kind, retcode=retcode)
+            last = err.strip().split("\n")[-1] if err.strip() != "" else ""
+            raise Exception("prefetch for "+acc+" failed ("+kind+"). prefetch returned "+str(retcode)+"."+
+                            (" "+last if last != "" else ""))
+        delay = backoff_delay(attempt, retry_base, retry_cap, jitter=True)
+        print("prefetch for acc "+acc+" failed ("+kind+"), retrying in "+str(round(delay, 1))+"s ("+str(retries - attempt)+" more times).")
+        with timed(acc, "retry-wait", retry=attempt+1, after="prefetch"):
+            time.sleep(delay)
+        attempt += 1
+
+def classify_failure(retcode, stderr = "", loc = ''):
+    """
+    Sorts a failed fast(er)q-dump/pigz run into "permanent" (bad or
+    protected accession, bad arguments: don't retry), "disk-full", or
+    "transient" (network hiccups and anything unrecognized), from its
+    return code and `stderr`. Otherwise, a nearly-full output directory
+    `loc` also counts as disk-full.
+    """
+    err = stderr.lower()
+    if any([e in err for e in DISK_FULL_ERRORS]):
+        return "disk-full"
+    killed = retcode is not None and retcode < 0 # by a signal: its stderr is cut short
+    if not killed and any([e in err for e in PERMANENT_ERRORS]):
+        return "permanent"
+    try:
+        if shutil.disk_usage(loc if loc != '' else os.getcwd()).free < DISK_FULL_FREE:
+            return "disk-full"
+    except OSError:
+        pass
+    return "transient"
+
+def _file_stamps(paths):
+    """
+    Identity (inode, mtime, size) of each of `paths` that exists, to
+    tell files written since apart from ones that were already there.
+    """
+    stamps = {}
+    for fp in paths:
+        try:
+            st = os.stat(fp)
+        except OSError:
+            continue
+        stamps[fp] = (st.st_ino, st.st_mtime_ns, st.st_size)
+    return stamps
+
+def dump_to_gzip(cmd, fp_gz, zip_func = "gzip", threads = 1):
+    """
+    Runs the dumper `cmd` with its standard output piped straight into
+    the compressor, writing `fp_gz` (via a .part file) without an
+    uncompressed copy on disk. Returns the dumper's and compressor's
+    return codes, and the tail of the dumper's stderr.
+    """
+    part = fp_gz + ".part"
+    print("running: "+" ".join(cmd)+" | "+zip_func+" > "+fp_gz)
+    dumper, wait = popen_captured(cmd, stdout=PIPE)
+    out = None
+    try:
+        out = CompressedWriter(part, zip_func, threads)
+        shutil.copyfileobj(dumper.stdout, out, 1 << 20)
+    except OSError as e: # e.g. disk full or the compressor died
+        print("writing "+fp_gz+" failed: "+str(e))
+        dumper.kill() # don't leave it blocked on a full pipe
+        dumper.stdout.close()
+        retcode, err = wait()
+        if out is not None:
+            try:
+                out.close()
+            except OSError:
+                pass
+        if os.path.isfile(part):
+            os.remove(part)
+        return retcode if retcode != 0 else 1, 1, err + str(e) + "\n"
+    dumper.stdout.close()
+    rgzip = out.close()
+    retcode, err = wait()
+    if retcode == 0 and rgzip == 0:
+        os.replace(part, fp_gz)
+    elif os.path.isfile(part):
+        os.remove(part)
+    return retcode, rgzip, err
+
+def compress_run(acc, fnames, retries = 2, threads = 1, loc = '', zip_func = "gzip", index = None, journal = None,
+                 retry_base = 5, retry_cap = 300):
+    """
+    Compresses the dumped files (`fnames`) of `acc`, retrying only the
+    compression (not the dump) up to `retries` times with jittered
+    exponential backoff between `retry_base` and `retry_cap` seconds,
+    and records the result.
+    """
+    attempt = 0
+    while True:
+        with timed(acc, "compress", attempt=attempt, tool=zip_func, threads=threads) as m:
+            m["bytes_in"] = file_bytes(fnames)
+            rgzip = gzip_files(fnames, zip_func, threads)
+            m["retcode"] = rgzip
+            m["bytes_out"] = file_bytes([f+".gz" for f in fnames])
+        if rgzip == 0:
+            found = index.refresh(acc) if index is not None else check_existing(loc, acc)
+            if found != False:
+                if journal is not None:
+                    journal.record(acc, "compressed", bytes=file_bytes([f+".gz" for f in fnames]))
+                return
+        kind = classify_failure(rgzip, "", loc)
+        if attempt >= retries:
+            if journal is not None:
+                journal.record(acc, "failed", stage="compress", failure=kind, pigz_retcode=rgzip)
+            raise Exception("compression for "+acc+" failed ("+kind+"). pigz returned "+str(rgzip)+".")
+        delay = backoff_delay(attempt, retry_base, retry_cap, jitter=True)
+        print("compressing "+acc+" failed ("+kind+"), retrying in "+str(round(delay, 1))+"s ("+str(retries - attempt)+" more times).")
+        with timed(acc, "retry-wait", retry=attempt+1, after="compress"):
+            time.sleep(delay)
+        attempt += 1
+
+def run_fasterq_dump(acc, retries = 2, threads = 1, loc='', force=False, fastqdump=False, custom_args="", zip_func="gzip", index=None, journal=None, resume=False,
+                     layout=None, pipe=False, compressor=None, tmpdir='', retry_base=5, retry_cap=300, sra_file=None):
+    """
+    Helper function to run fast(er)q-dump to grab a particular `acc`ession,
+    with support for a particular number of `retries`. Can use multiple
+    `threads`. Existing files are looked up in `index` (a `DirectoryIndex`
+    of `loc`), if given. Progress is recorded in `journal`; with `resume`,
+    an accession interrupted after dumping is only re-compressed, and
+    .fastq.gz files from an unfinished accession aren't trusted.
+    With `pipe`, runs with a SINGLE `layout` are streamed straight into
+    the compressor; other runs are dumped to disk and, if a `compressor`
+    executor is given, compressed there so the next dump can start.
+    In that case the compression Future is returned. fasterq-dump's
+    temporary files go to `tmpdir`, if given. With `sra_file` (from
+    prefetch), reads are converted from that local file instead of
+    being fetched from the network.
+    Failures are classified (see `classify_failure`): permanent ones
+    fail straight away, others are retried with jittered exponential
+    backoff between `retry_base` and `retry_cap` seconds. Only the stage
+    that failed is retried, e.g. a failed compression isn't re-dumped.
+    """
+    stage = journal.state(acc) if (journal is not None and resume) else None
+    if not force and stage not in ("downloading", "fetched", "dumped"):
+        found = check_existing(loc, acc, index, layout)
+        if found != False:
+            print("found existing file matching acc:" + acc + ", skipping download. Pass -f to force download")
+            return
+
+    # all possible output files for that acc
+    fnames = build_paths(acc, loc, False) + build_paths(acc, loc, True)
+    dumped = stage == "dumped" and any([os.path.isfile(f) for f in fnames])
+    if dumped:
+        print("resuming "+acc+" from its dumped .fastq files")
+
+    stream = pipe and layout == "SINGLE" and len(custom_args) == 0
+    attempt = 0
+    while True:
+        retcode = 0
+        rgzip = 0
+        err = ""
+        before = _file_stamps(fnames + [f+".gz" for f in fnames])
+        if stream:
+            if journal is not None:
+                journal.record(acc, "downloading")
+            fp_gz = build_paths(acc, loc, False, ".fastq.gz")[0]
+            cmd = build_dump_cmd(sra_file or acc, threads, loc, fastqdump, stdout=True, tmpdir=tmpdir)
+            with timed(acc, "dump+compress", attempt=attempt, tool=zip_func, threads=threads) as m:
+                retcode, rgzip, err = dump_to_gzip(cmd, fp_gz, zip_func, threads)
+                m["retcode"] = retcode
+                m["compress_retcode"] = rgzip
+                m["bytes_out"] = file_bytes([fp_gz])
+            if retcode == 0 and rgzip == 0:
+                if index is not None:
+                    index.refresh(acc)
+                if journal is not None:
+                    journal.record(acc, "compressed", bytes=file_bytes([fp_gz]))
+                return
         else:
-            break
+            if not dumped:
+                cmd = build_dump_cmd(sra_file or acc, threads, loc, fastqdump, custom_args, tmpdir=tmpdir)
+                if journal is not None:
+                    journal.record(acc, "downloading")
+                print("running: "+" ".join(cmd))
+                with timed(acc, "dump", attempt=attempt, threads=threads, local=sra_file is not None) as m:
+                    retcode, err = call_captured(cmd)
+                    m["retcode"] = retcode
+                    m["bytes_out"] = file_bytes(fnames + [f+".gz" for f in fnames] if fastqdump else fnames)
+                if retcode == 0:
+                    dumped = True
+                    if journal is not None:
+                        journal.record(acc, "dumped", bytes=file_bytes(fnames))
+            if dumped:
+                if fastqdump: # fastq-dump already compressed
+                    found = index.refresh(acc) if index is not None else check_existing(loc, acc)
+                    if found != False:
+                        if journal is not None:
+                            journal.record(acc, "compressed", bytes=file_bytes([f+".gz" for f in fnames]))
+                        return
+                    dumped = False # nothing usable came out, dump again
+                else:
+                    # compression has its own retries from here on
+                    compress_args = (acc, fnames, retries, threads, loc, zip_func, index, journal, retry_base, retry_cap)
+                    if compressor is not None:
+                        return compressor.submit(compress_run, *compress_args)
+                    compress_run(*compress_args)
+                    return
 
+        # only here if the dump failed
+        kind = classify_failure(retcode, err, loc)
+        if kind == "disk-full":
+            # don't leave this attempt's half-written reads around to make it
+            # worse, but keep files that were there before it (e.g. with -f)
+            after = _file_stamps(fnames + [f+".gz" for f in fnames])
+            for f in after:
+                if before.get(f) != after[f]:
+                    os.remove(f)
+        if kind == "permanent" or attempt >= retries:
+            if journal is not None:
+                journal.record(acc, "failed", stage="dump", failure=kind, retcode=retcode, pigz_retcode=rgzip)
+            last = err.strip().split("\n")[-1] if err.strip() != "" else ""
+            raise Exception("download for "+acc+" failed ("+kind+"). fast(er)q-dump returned "+str(retcode)+
+                            ", pigz returned "+str(rgzip)+"."+(" "+last if last != "" else ""))
+        delay = backoff_delay(attempt, retry_base, retry_cap, jitter=True)
+        print("SRA download for acc "+acc+" failed ("+kind+"), retrying in "+str(round(delay, 1))+"s ("+str(retries - attempt)+" more times).")
+        with timed(acc, "retry-wait", retry=attempt+1, after="dump"):
+            time.sleep(delay)
+        attempt += 1
@@ -1,68 +1,176 @@
-import os, glob, gzip, sys
-from subprocess import call
+import os, gzip, sys, time, zlib, shutil, csv, queue, threading, argparse
+from collections import deque
+from grabseqslib.net import get_session, download, backoff_delay
+from grabseqslib.compress import gzip_files, CompressedWriter
+from io import StringIO
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def check_existing(save_loc, acc):
+FASTQ_SUFFIXES = ["", "_1", "_2"]
+
+def _existing_status(found, layout = None):
+    """
+    Summarizes which of the `found` suffixes ("", "_1", "_2") exist
+    for an accession, in the format returned by `check_existing`. For
+    a PAIRED `layout`, a lone mate counts as nothing found.
+    """
+    if layout == "PAIRED" and ("_1" in found) != ("_2" in found):
+        return False # interrupted between mates
+    unpaired = "" in found
+    paired = "_1" in found or "_2" in found
+    if unpaired and paired:
+        return "both"
+    elif paired:
+        return "paired"
+    elif unpaired:
+        return "unpaired"
+    else:
+        return False
+
+def check_existing(save_loc, acc, index = None, layout = None):
     """
     Function to check for single- or paired-end reads
     in a given `save_loc` for a particular `acc`ession.
-    Returns "paired" if paired reads found, "single" if
+    Returns "paired" if paired reads found, "unpaired" if
     unpaired reads found, "both" if single- and paired-
     end reads found, and False if nothing matching that 
-    accession was found.
+    accession was found. Filenames must match the accession
+    exactly (SRR1 doesn't match SRR11.fastq.gz). Uses a
+    `DirectoryIndex` of `save_loc` if one is passed, and
+    otherwise stats the candidate paths directly. If the run's
+    `layout` is known to be PAIRED, both mates must be there.
     """
+    if index is not None:
+        return index.status(acc, layout)
     if save_loc == '':
         loc_to_search = os.getcwd()
     else:
         loc_to_search = save_loc
-    try:
-        existing = [f for f in os.listdir(loc_to_search) if f.endswith('fastq.gz')]
-    except FileNotFoundError:
-        return False
-    paired = False
-    unpaired = False
-    for f in existing:
-        if acc + '.fastq.gz' in f:
-            unpaired = True
-        if (acc + '_1.fastq.gz' in f) or (acc + '_2.fastq.gz' in f):
-            paired = True
-    if unpaired == True and paired == True:
-        return "both"
-    elif paired == True:
-        return "paired"
-    elif unpaired == True:
-        return "unpaired"
-    else:
-        return False
+    found = set()
+    for suffix in FASTQ_SUFFIXES:
+        fp = os.path.join(loc_to_search, acc + suffix + ".fastq.gz")
+        if os.path.isfile(fp) and os.path.getsize(fp) > 0:
+            found.add(suffix)
+    return _existing_status(found, layout)
 
-def gzip_files(paths, tool="gzip", threads=1):
-    """
-    Zips files at one or more `paths` using specified `tool`.
-    Returns the command-line tool's return code.
-    """
-    if type(paths) != type(["list'o'strings"]):
-        paths = [paths]
-    validated_paths = []
-    for p in paths:
-        if os.path.isfile(p):
-            validated_paths.append(p)
-    if tool == "gzip":
-        retcode = call(["gzip -f " + ' '.join(validated_paths)], shell=True)
-    elif tool == "pigz":
-        retcode = call(["pigz -f -p "+ str(threads) + ' ' + ' '.join(validated_paths)], shell=True)
-    else:
-        print("Unrecognized tool "+tool+" specified: cannot compress ", validated_paths)
-        sys.exit(1)
-    return retcode
+class DirectoryIndex:
+    """
+    Index of the finished .fastq.gz files in the directory `loc`,
+    built with a single scan and kept up to date as downloads
+    complete (via `refresh`). Lookups are exact accession matches
+    and O(1). Empty files (e.g. from an interrupted compression)
+    aren't counted; with `check_gzip`, files must also start with
+    the gzip magic bytes.
+    """
+    def __init__(self, loc = '', check_gzip = False):
+        self.loc = loc if loc != '' else os.getcwd()
+        self.check_gzip = check_gzip
+        self.lock = threading.Lock()
+        self.files = {} # acc -> {suffix: size}
+        try:
+            entries = list(os.scandir(self.loc))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if entry.name.endswith(".fastq.gz") and entry.is_file():
+                acc, suffix = self._split_name(entry.name)
+                self.files.setdefault(acc, {})[suffix] = entry.stat().st_size
+
+    @staticmethod
+    def _split_name(name):
+        """
+        Splits a .fastq.gz filename into accession and suffix.
+        """
+        stem = name[:-len(".fastq.gz")]
+        if stem[-2:] in FASTQ_SUFFIXES[1:]:
+            return stem[:-2], stem[-2:]
+        return stem, ""
+
+    def _valid(self, acc, suffix, size):
+        """
+        Checks that an indexed file looks like a finished download.
+        """
+        if size == 0:
+            return False
+        if self.check_gzip:
+            try:
+                with open(os.path.join(self.loc, acc + suffix + ".fastq.gz"), 'rb') as f:
+                    return f.read(2) == b'\x1f\x8b'
+            except OSError:
+                return False
+        return True
+
+    def status(self, acc, layout = None):
+        """
+        Returns the same values as `check_existing` for `acc`.
+        """
+        with self.lock:
+            found = dict(self.files.get(acc, {}))
+        return _existing_status(set(sfx for sfx in found if self._valid(acc, sfx, found[sfx])), layout)
+
+    def refresh(self, acc):
+        """
+        Re-checks the files for `acc` on disk (after a download
+        finishes or files are removed) and updates the index.
+        """
+        found = {}
+        for suffix in FASTQ_SUFFIXES:
+            fp = os.path.join(self.loc, acc + suffix + ".fastq.gz")
+            if os.path.isfile(fp):
+                found[suffix] = os.path.getsize(fp)
+        with self.lock:
+            if len(found) > 0:
+                self.files[acc] = found
+            else:
+                self.files.pop(acc, None)
+        return self.status(acc)
+
+def _tee_stderr(proc, lines):
+    """
+    Copies `proc`'s stderr to ours line by line, keeping the last
+    lines in `lines`.
+    """
+    for line in iter(proc.stderr.readline, b""):
+        text = line.decode("utf-8", "replace")
+        sys.stderr.write(text)
+        sys.stderr.flush()
+        lines.append(text)
+    proc.stderr.close()
+
+def popen_captured(cmd, stdout = None):
+    """
+    Starts `cmd` with its stderr passed through to ours, keeping a copy
+    of the tail so failures can be diagnosed. `stdout` is handed to
+    Popen as-is. Returns the process and a function that waits for it
+    and returns (return code, stderr text).
+    """
+    proc = Popen(cmd, stdout=stdout, stderr=PIPE)
+    lines = deque(maxlen=200)
+    t = threading.Thread(target=_tee_stderr, args=(proc, lines), daemon=True)
+    t.start()
+    def wait():
+        retcode = proc.wait()
+        t.join()
+        return retcode, "".join(lines)
+    return proc, wait
+
+def call_captured(cmd):
+    """
+    Like `subprocess.call`, but also returns the tail of `cmd`'s stderr:
+    (return code, stderr text).
+    """
+    proc, wait = popen_captured(cmd)
+    return wait()
 
-def fetch_file(url, outfile, retries = 0):
+def fetch_file(url, outfile, retries = 0, parts = 1):
     """
     Function to fetch a remote file from a `url`,
     writing to `outfile` with a particular number of
-    `retries`.
+    `retries`. Partial downloads are resumed, and the
+    file can be fetched as several parallel byte-range
+    `parts`. Returns 0 on success, like wget did.
     """
-    wget_cmd = ["wget", "-O", outfile, url]
-    retcode = call(wget_cmd)
-    return retcode
+    return download(url, outfile, retries, parts)
 
 def build_paths(acc, loc, paired, ext = ".fastq"):
     """
@@ -106,40 +214,636 @@ def check_filetype(fp):
     else:
         return ""
 
-def fasta_to_fastq(fp_fa, fp_fq, zipped, dummy_char = "I"):
+def fasta_to_fastq(fp_fa, fp_fq, zipped, dummy_char = "I", zip_func = None, threads = 1, chunk_size = 1 << 20):
     """
-    Function to convert fasta (at `fp_fa`) to fastq (at `fp_fq`)
-    possibly zipped, adding a `dummy_score`.
+    Function to convert fasta (at `fp_fa`, a path or binary file
+    object) to fastq (at `fp_fq`) possibly zipped, adding a
+    `dummy_char` quality score. Streams the input in `chunk_size`
+    pieces so memory use doesn't depend on file size. If `zip_func`
+    is given, output is compressed on the fly (with `threads`) and
+    `fp_fq` should end in .gz. Returns the compressor's return code.
     """
     if len(dummy_char) != 1:
         raise Exception("FASTQ dummy quality char must be only one char.")
+    qual = dummy_char.encode("ascii")
 
-    fq = open(fp_fq, 'w')
+    if zip_func is None:
+        fq = open(fp_fq, 'wb')
+    else:
+        fq = CompressedWriter(fp_fq, zip_func, threads)
 
-    seq = -1
-    if zipped:
-        f = gzip(fp_fa)
+    if hasattr(fp_fa, "read"):
+        f = fp_fa
+    elif zipped:
+        f = gzip.open(fp_fa, 'rb')
     else:
-        f = open(fp_fa)
-    for line in f.readlines():
-        if line[0] == '>':
-            if seq == -1:
-                fq.write('@'+line[1:])
-            else:
-                fq.write(seq+'\n')
-                fq.write('+\n')    
-                fq.write(dummy_char*len(seq)+'\n')
-                fq.write('@'+line[1:])
-            seq = ''
+        f = open(fp_fa, 'rb')
+
+    seq = None # sequence lines for the current record
+    out = []   # output waiting to be written
+    out_len = 0
+    tail = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if len(chunk) == 0:
+            lines = [tail] if len(tail) > 0 else []
+        else:
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop() # possibly incomplete last line
+        for line in lines:
+            if line[:1] == b'>':
+                if seq is not None:
+                    s = b''.join(seq)
+                    out += [s, b'\n+\n', qual*len(s), b'\n']
+                    out_len += 2*len(s)
+                out.append(b'@'+line[1:].rstrip(b'\r')+b'\n')
+                seq = []
+            elif seq is not None:
+                seq.append(line.strip())
+        if out_len >= chunk_size or len(chunk) == 0:
+            fq.write(b''.join(out))
+            out = []
+            out_len = 0
+        if len(chunk) == 0:
+            break
+
+    if seq is not None:
+        s = b''.join(seq)
+        fq.write(s+b'\n+\n'+qual*len(s)+b'\n')
+
+    if f is not fp_fa:
+        f.close()
+    retcode = fq.close()
+    return 0 if retcode is None else retcode
+
+def sniff_filetype(head):
+    """
+    Classifies the first bytes (`head`) of a file as gzipped or
+    not, and as FASTQ, FASTA or neither, without needing the whole
+    file. Returns an extension like `check_filetype` does.
+    """
+    gz = ""
+    if head[:2] == b'\x1f\x8b':
+        gz = ".gz"
+        try:
+            head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head)
+        except zlib.error:
+            return ""
+    if len(head) == 0:
+        return ""
+    if head[:1] == b">":
+        return "fasta"+gz
+    elif head[:1] == b"@":
+        return "fastq"+gz
+    else:
+        return ""
+
+class _PrefixedStream:
+    """
+    Read-only binary stream yielding `prefix` and then the rest of
+    `raw`, so sniffed bytes can be handed back to a consumer.
+    """
+    def __init__(self, prefix, raw):
+        self.prefix = prefix
+        self.raw = raw
+
+    def read(self, size = -1):
+        if len(self.prefix) > 0:
+            if size is None or size < 0:
+                b = self.prefix + self.raw.read()
+                self.prefix = b''
+                return b
+            b = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return b
+        return self.raw.read(size)
+
+def stream_to_fastq_gz(url, fp_fq_gz, zip_func = "gzip", threads = 1, retries = 0, chunk_size = 1 << 20,
+                       backoff_base = 1, backoff_cap = 60):
+    """
+    Downloads `url` straight into a compressed FASTQ at `fp_fq_gz`
+    in a single pass, sniffing the format from the first bytes of
+    the response. FASTA is converted on the fly (compressing with
+    `zip_func` and `threads`), plain FASTQ is compressed on the fly
+    and .fastq.gz is written to disk untouched. Output goes to a
+    .part file that is renamed when complete. Makes up to `retries`
+    additional attempts, waiting a capped, jittered exponential backoff
+    between them (client errors other than 429 aren't retried). Returns
+    the detected filetype and a return
+    code: nonzero if the transfer (or compression) failed, and 0 with
+    an empty filetype if the data isn't FASTA/FASTQ (nothing is
+    written then).
+    """
+    from urllib3.exceptions import HTTPError as TransferError # a cut-off r.raw raises these
+    part = fp_fq_gz + ".part"
+    ftype = ""
+    retcode = 1
+    attempt = 0
+    while True:
+        hopeless = False
+        try:
+            with get_session().get(url, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                raw = r.raw
+                raw.decode_content = True
+                head = raw.read(65536)
+                ftype = sniff_filetype(head)
+                stream = _PrefixedStream(head, raw)
+                if ftype == "fastq.gz":
+                    with open(part, 'wb') as out:
+                        shutil.copyfileobj(stream, out, chunk_size)
+                    retcode = 0
+                elif ftype == "fastq":
+                    out = CompressedWriter(part, zip_func, threads)
+                    shutil.copyfileobj(stream, out, chunk_size)
+                    retcode = out.close()
+                elif ftype.startswith("fasta"):
+                    if ftype.endswith(".gz"):
+                        stream = gzip.GzipFile(fileobj=stream)
+                    retcode = fasta_to_fastq(stream, part, False, zip_func=zip_func, threads=threads, chunk_size=chunk_size)
+                else: # not reads, retrying won't change that
+                    return ftype, 0
+        except (OSError, EOFError, TransferError) as e: # requests' exceptions are OSErrors
+            print("streaming "+url+" failed: "+str(e))
+            retcode = 1
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            hopeless = status is not None and 400 <= status < 500 and status != 429
+        if retcode == 0:
+            os.replace(part, fp_fq_gz)
+            break
+        if os.path.isfile(part):
+            os.remove(part)
+        if hopeless or attempt >= retries:
+            break
+        time.sleep(backoff_delay(attempt, backoff_base, backoff_cap, jitter=True))
+        attempt += 1
+    return ftype, retcode
+
+def split_threads(threads, jobs):
+    """
+    Splits a CPU budget of `threads` between a number of
+    concurrent `jobs`. Returns the number of threads each
+    job should hand to fasterq-dump/pigz (always at least 1).
+    """
+    return max(1, threads // max(1, jobs))
+
+def order_by_size(items, sizes, order = "input"):
+    """
+    Orders `items` for scheduling: as given ("input"), or by their
+    `sizes` (a dict, missing items count as unknown) with
+    "largest-first" or "smallest-first". Runs of unknown size keep
+    their input order, after the sized ones.
+    """
+    if order == "input":
+        return list(items)
+    known = [i for i in items if sizes.get(i, 0) > 0]
+    unknown = [i for i in items if sizes.get(i, 0) <= 0]
+    known.sort(key=lambda i: sizes[i], reverse=(order == "largest-first"))
+    return known + unknown
+
+def allocate_threads(items, sizes, threads, jobs):
+    """
+    Gives each of `items` a share of `threads` proportional to its size
+    (from the dict `sizes`). Shares are relative to the `jobs` largest
+    items together, so however the runs end up overlapping, concurrent
+    jobs never ask for more than `threads` between them (beyond the
+    minimum of 1 each). Items of unknown size get an even split.
+    Returns a dict of item -> threads.
+    """
+    even = split_threads(threads, jobs)
+    largest = sorted([sizes.get(i, 0) for i in items], reverse=True)[:jobs]
+    total = sum(largest)
+    alloc = {}
+    for item in items:
+        size = sizes.get(item, 0)
+        if size <= 0 or total <= 0 or jobs <= 1:
+            alloc[item] = even
+        else:
+            alloc[item] = max(1, int(threads * size // total))
+    return alloc
+
+class DiskBudget:
+    """
+    Disk-space admission control for concurrent downloads. Before
+    starting, each job reserves its estimated footprint (a dict of
+    path -> bytes, e.g. output and scratch locations); `acquire` blocks
+    until every filesystem involved has that much free space beyond
+    what running jobs have already reserved and a `margin` of bytes.
+    Reservations are conservative (space a running job has already
+    written is counted twice). A job that doesn't fit while nothing
+    else is running is let through alone rather than waiting forever.
+    """
+    def __init__(self, margin = 1 << 30, poll = 10):
+        self.margin = margin
+        self.poll = poll
+        self.reserved = {} # device -> reserved bytes
+        self.paths = {} # device -> a path on it, for disk_usage
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def _by_device(self, needs):
+        by_dev = {}
+        for path, nbytes in needs.items():
+            path = os.path.abspath(path if path != '' else os.getcwd())
+            dev = os.stat(path).st_dev
+            self.paths.setdefault(dev, path)
+            by_dev[dev] = by_dev.get(dev, 0) + nbytes
+        return by_dev
+
+    def _fits(self, by_dev):
+        for dev, nbytes in by_dev.items():
+            free = shutil.disk_usage(self.paths[dev]).free
+            if free - self.reserved.get(dev, 0) - self.margin < nbytes:
+                return False
+        return True
+
+    def acquire(self, needs, name = ""):
+        """
+        Blocks until the estimated `needs` of job `name` fit, then
+        reserves them. Returns the reservation, to pass to `release`.
+        """
+        with self.cond:
+            by_dev = self._by_device(needs)
+            waiting = False
+            while self.active > 0 and not self._fits(by_dev):
+                if not waiting:
+                    print("waiting for disk space to start "+name)
+                    waiting = True
+                self.cond.wait(self.poll)
+            if self.active == 0 and not self._fits(by_dev):
+                print("warning: "+name+" may need more disk space than is free, starting it anyway")
+            for dev, nbytes in by_dev.items():
+                self.reserved[dev] = self.reserved.get(dev, 0) + nbytes
+            self.active += 1
+            return by_dev
+
+    def release(self, by_dev):
+        """
+        Releases a reservation returned by `acquire`.
+        """
+        with self.cond:
+            for dev, nbytes in by_dev.items():
+                self.reserved[dev] -= nbytes
+            self.active -= 1
+            self.cond.notify_all()
+
+def run_jobs(func, items, jobs = 1):
+    """
+    Runs `func` on each of `items` using a bounded pool of
+    `jobs` concurrent workers. Failures are caught per item so
+    one bad accession doesn't end the whole batch. Returns a
+    dict of results and a dict of failures (item -> exception),
+    both keyed by item, in input order.
+    """
+    results = {}
+    failed = {}
+    if jobs <= 1:
+        for item in items:
+            try:
+                results[item] = func(item)
+            except Exception as e:
+                print("processing "+item+" failed: "+str(e))
+                failed[item] = e
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(func, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    results[item] = future.result()
+                except Exception as e:
+                    print("processing "+item+" failed: "+str(e))
+                    failed[item] = e
+    results = {i: results[i] for i in items if i in results}
+    failed = {i: failed[i] for i in items if i in failed}
+    return results, failed
+
+def run_pipeline(fetch, convert, items, fetch_jobs = 1, jobs = 1, queue_size = 1):
+    """
+    Runs each of `items` through two stages on separate pools, so
+    e.g. network transfers and CPU-bound work overlap: `fetch(item)`
+    on `fetch_jobs` workers, then `convert(item, fetched)` on `jobs`
+    workers. Fetched items wait for conversion in a queue of at most
+    `queue_size`, so fetching can't run arbitrarily far ahead. Items
+    are fetched in the order given. Failures in either stage are
+    caught per item. Returns dicts of results and failures like
+    `run_jobs`.
+    """
+    results = {}
+    failed = {}
+    fetched = queue.Queue(maxsize=max(1, queue_size))
+    pending = iter(items)
+    lock = threading.Lock()
+
+    def fetch_worker():
+        while True:
+            with lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            try:
+                got = fetch(item)
+            except Exception as e:
+                print("processing "+item+" failed: "+str(e))
+                failed[item] = e
+                continue
+            fetched.put((item, got)) # blocks while the queue is full
+
+    def convert_worker():
+        while True:
+            entry = fetched.get()
+            if entry is None: # no more to come
+                return
+            item, got = entry
+            try:
+                results[item] = convert(item, got)
+            except Exception as e:
+                print("processing "+item+" failed: "+str(e))
+                failed[item] = e
+
+    fetch_jobs = max(1, fetch_jobs)
+    jobs = max(1, jobs)
+    with ThreadPoolExecutor(max_workers=fetch_jobs) as fetchers, ThreadPoolExecutor(max_workers=jobs) as converters:
+        fetching = [fetchers.submit(fetch_worker) for i in range(fetch_jobs)]
+        converting = [converters.submit(convert_worker) for i in range(jobs)]
+        for f in fetching:
+            f.result()
+        for i in range(jobs):
+            fetched.put(None)
+        for f in converting:
+            f.result()
+    results = {i: results[i] for i in items if i in results}
+    failed = {i: failed[i] for i in items if i in failed}
+    return results, failed
+
+def print_summary(items, failed, claimed = ()):
+    """
+    Prints an end-of-batch summary of how many `items` were
+    processed and which of them `failed` (dict from `run_jobs`).
+    Items skipped because another worker had `claimed` them (with
+    --claim) are counted separately.
+    """
+    claimed = [x for x in items if x in claimed and x not in failed]
+    print("Processed "+str(len(items))+" accession(s): "+str(len(items)-len(failed)-len(claimed))+" succeeded, "+
+          (str(len(claimed))+" claimed elsewhere, " if len(claimed) > 0 else "")+str(len(failed))+" failed.")
+    for acc in failed:
+        print("  "+acc+": "+str(failed[acc]))
+
+def add_id_file_args(parser):
+    """
+    Adds options for reading identifiers from a file, and for
+    streaming their metadata to disk, to a repository `parser`.
+    """
+    parser.add_argument('--from-file', dest="from_file", type=str, default="",
+                help="read identifiers from a file (one per line, or a TSV/CSV column with --column)")
+    parser.add_argument('--column', dest="column", type=str, default="",
+                help="column of the --from-file table holding identifiers")
+    parser.add_argument('--stream', dest="stream", action="store_true",
+                help="resolve and download identifiers in batches, appending metadata to the -m file as they resolve")
+
+def positive_int(text):
+    """
+    argparse type for counts that must be at least 1 (e.g. -j).
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: "+repr(text))
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got "+text)
+    return value
+
+def parse_shard(text):
+    """
+    argparse type for --shard: "i/N" (i counting from 1) -> (i, N).
+    """
+    try:
+        i, n = [int(x) for x in text.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard should look like i/N, e.g. 1/4")
+    if n < 1 or i < 1 or i > n:
+        raise argparse.ArgumentTypeError("shard "+text+" out of range: need 1 <= i <= N")
+    return (i, n)
+
+def add_shard_args(parser):
+    """
+    Adds options for splitting work between several grabseqs
+    processes or machines to a repository `parser`.
+    """
+    parser.add_argument('--shard', dest="shard", type=parse_shard, default=None,
+                help="only download shard i of N (e.g. 2/4) of the resolved runs, balanced by size (with --stream, split by a hash of the accession)")
+    parser.add_argument('--claim', dest="claim", action="store_true",
+                help="coordinate through claim files in OUTDIR so several processes sharing it never download the same run")
+    parser.add_argument('--claim-timeout', dest="claim_timeout", type=float, default=600,
+                help="seconds after which a claim that isn't being refreshed is taken over (its worker presumably died)")
+
+def shard_items(items, sizes, shard = None):
+    """
+    Splits `items` deterministically between `shard` = (i, N) shards,
+    balanced by `sizes` (a dict; missing items count as 0): largest
+    first, each onto the shard with the least total size (then fewest
+    items). Every process given the same items makes the same split.
+    Returns shard i's items, in their original order.
+    """
+    if shard is None:
+        return list(items)
+    i, n = shard
+    loads = [(0, 0)] * n
+    owner = {}
+    for item in sorted(set(items), key=lambda x: (-sizes.get(x, 0), x)):
+        k = min(range(n), key=lambda j: (loads[j], j))
+        owner[item] = k
+        loads[k] = (loads[k][0] + sizes.get(item, 0), loads[k][1] + 1)
+    return [x for x in items if owner[x] == i - 1]
+
+def hash_shard_items(items, shard = None):
+    """
+    Like `shard_items`, but splits `items` by a stable hash of each
+    one, so a stream of small batches (--stream) still spreads evenly
+    across shards. Returns shard i's items, in their original order.
+    """
+    if shard is None:
+        return list(items)
+    i, n = shard
+    return [x for x in items if zlib.crc32(x.encode()) % n == i - 1]
+
+def read_id_file(fp, column = ""):
+    """
+    Lazily reads identifiers from the file at `fp`: one per line, or,
+    if a `column` name is given, that column of a TSV/CSV file with a
+    header row (delimiter guessed from the file extension). Blank lines
+    and lines starting with '#' are skipped.
+    """
+    with open(fp, newline='') as f:
+        if column == "":
+            for line in f:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith('#'):
+                    yield line
+        else:
+            delim = ',' if fp.endswith('.csv') else '\t'
+            reader = csv.DictReader(f, delimiter=delim)
+            if column not in (reader.fieldnames or []):
+                raise ValueError("Column "+column+" not found in "+fp)
+            for row in reader:
+                acc = (row[column] or "").strip()
+                if len(acc) > 0:
+                    yield acc
+
+def iter_ids(ids, from_file = "", column = ""):
+    """
+    Yields identifiers given on the command line (`ids`) followed by
+    any read from the file `from_file`.
+    """
+    for acc in ids:
+        yield acc
+    if from_file != "":
+        for acc in read_id_file(from_file, column):
+            yield acc
+
+def chunked(items, size):
+    """
+    Splits an iterable of `items` into lists of up to `size` items,
+    without reading more than one chunk ahead.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+class CSVAppender:
+    """
+    Appends metadata records (dicts) to the .csv at `fp` as they come
+    in, creating it if needed. Columns are the union of all records
+    seen (and of an existing file's header); if a record brings a new
+    column, the file is rewritten line by line with the wider header
+    so it is always a valid table, even if grabseqs is interrupted.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.columns = []
+        if os.path.isfile(fp) and os.path.getsize(fp) > 0:
+            with open(fp, newline='') as f:
+                self.columns = next(csv.reader(f), [])
+
+    def _widen(self, new_columns):
+        """
+        Rewrites the file with `new_columns` added to the header.
+        """
+        columns = self.columns + new_columns
+        if os.path.isfile(self.fp) and len(self.columns) > 0:
+            tmp = self.fp + ".tmp"
+            with open(self.fp, newline='') as f_in, open(tmp, 'w', newline='') as f_out:
+                reader = csv.reader(f_in)
+                writer = csv.writer(f_out)
+                next(reader)
+                writer.writerow(columns)
+                pad = [""] * len(new_columns)
+                for row in reader:
+                    writer.writerow(row + pad)
+            os.replace(tmp, self.fp)
         else:
-            seq += line.strip()
+            with open(self.fp, 'w', newline='') as f:
+                csv.writer(f).writerow(columns)
+        self.columns = columns
+
+    def add_records(self, records):
+        """
+        Appends `records` (a list of dicts) to the file.
+        """
+        if len(records) == 0:
+            return
+        known = set(self.columns)
+        new_columns = []
+        for record in records:
+            for col in record:
+                if col is not None and col not in known:
+                    known.add(col)
+                    new_columns.append(col)
+        if len(new_columns) > 0:
+            self._widen(new_columns)
+        with open(self.fp, 'a', newline='') as f:
+            writer = csv.writer(f)
+            for record in records:
+                writer.writerow([record.get(col, "") for col in self.columns])
+
+    def add_csv_text(self, text):
+        """
+        Appends every row of the .csv-formatted `text` to the file.
+        """
+        self.add_records(list(csv.DictReader(StringIO(text))))
+
+class MetadataAccumulator:
+    """
+    Collects metadata records (dicts keyed by column name) from any
+    number of samples or projects, and builds a single table once at
+    the end. Columns are kept in order of first appearance. Adding
+    records is O(1) per record, unlike growing a DataFrame in a loop,
+    and .csv output doesn't need pandas at all.
+    """
+    def __init__(self):
+        self.columns = []
+        self.records = []
+        self._known = set()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add_records(self, records):
+        """
+        Adds `records` (an iterable of dicts).
+        """
+        for record in records:
+            for col in record:
+                if col is not None and col not in self._known:
+                    self._known.add(col)
+                    self.columns.append(col)
+            self.records.append(record)
+
+    def add_table(self, header, rows):
+        """
+        Adds `rows` (lists of values) of a table with the given `header`.
+        """
+        self.add_records(dict(zip(header, row)) for row in rows)
 
-    f.close()
+    def add_csv_text(self, text):
+        """
+        Adds every row of the .csv-formatted `text`.
+        """
+        self.add_records(csv.DictReader(StringIO(text)))
 
-    if len(seq) > 0:
-        fq.write(seq+'\n')
-        fq.write('+\n')
-        fq.write(dummy_char*len(seq)+'\n')
+    def merge(self, other):
+        """
+        Adds all records from another accumulator (`other`).
+        """
+        self.add_records(other.records)
 
-    fq.close()
+    def to_frame(self):
+        """
+        Returns the accumulated metadata as a pandas DataFrame. pandas
+        is optional (`pip install grabseqs[pandas]`) and only needed here.
+        """
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError("to_frame needs pandas, which isn't installed: pip install grabseqs[pandas]")
+        return pd.DataFrame.from_records(self.records, columns=self.columns)
 
+    def to_csv(self, fp, append = False):
+        """
+        Writes the accumulated metadata to a .csv at `fp`. With `append`,
+        rows are added to an existing file, merging columns in a single
+        streaming pass rather than re-reading it into memory.
+        """
+        if append:
+            CSVAppender(fp).add_records(self.records)
+            return
+        with open(fp, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            for record in self.records:
+                writer.writerow([record.get(col, "") for col in self.columns])
@@ -0,0 +1,155 @@
+import os, zlib, fcntl, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+from grabseqslib.utils import FASTQ_SUFFIXES
+from grabseqslib.metrics import timed
+
+MANIFEST_NAME = "grabseqs_manifest.tsv"
+MANIFEST_COLUMNS = ["file", "bytes", "records", "md5", "sha256", "status"]
+
+def scan_fastq_gz(fp, chunk_size = 1 << 20):
+    """
+    Reads the .fastq.gz file `fp` once, checksumming the compressed
+    bytes (MD5 and SHA256) while decompressing every gzip member (which
+    checks each member's CRC and length trailer) and counting records.
+    Returns a dict of `MANIFEST_COLUMNS`, where status is "ok" or a
+    description of the problem (bad or truncated gzip stream, a
+    partial last record, or data that doesn't look like FASTQ).
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    d = zlib.decompressobj(31)
+    in_member = False
+    size = 0
+    lines = 0
+    first = b""
+    last = b"\n"
+    status = "ok"
+    try:
+        with open(fp, 'rb') as f:
+            while True:
+                raw = f.read(chunk_size)
+                if not raw:
+                    break
+                size += len(raw)
+                md5.update(raw)
+                sha256.update(raw)
+                while raw:
+                    in_member = True
+                    data = d.decompress(raw)
+                    if data:
+                        lines += data.count(b"\n")
+                        last = data[-1:]
+                        if first == b"":
+                            first = data[:1]
+                    if d.eof: # end of a gzip member, another may follow
+                        raw = d.unused_data
+                        d = zlib.decompressobj(31)
+                        in_member = False
+                    else:
+                        raw = b""
+    except zlib.error as e:
+        status = "corrupt gzip stream ("+str(e)+")"
+    if status == "ok":
+        if in_member:
+            status = "truncated gzip stream"
+        elif first not in (b"", b"@"):
+            status = "not in FASTQ format"
+        elif last != b"\n" or lines % 4 != 0:
+            status = "incomplete last record"
+    return {"file": os.path.basename(fp), "bytes": size, "records": lines // 4,
+            "md5": md5.hexdigest(), "sha256": sha256.hexdigest(), "status": status}
+
+class Manifest:
+    """
+    Sidecar manifest of verified files (`MANIFEST_NAME` in `loc`), one
+    tab-separated row per file with its size, record count, checksums
+    and verification status. Rows for re-verified files are replaced.
+    Updates are locked (flock) so processes sharing `loc` don't lose
+    each other's rows.
+    """
+    def __init__(self, loc = ''):
+        self.path = os.path.join(loc, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.rows = {}
+
+    def _load(self):
+        self.rows = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                header = f.readline().rstrip("\n").split("\t")
+                for line in f:
+                    row = dict(zip(header, line.rstrip("\n").split("\t")))
+                    if "file" in row:
+                        self.rows[row["file"]] = row
+
+    def _locked(self):
+        """
+        Opens and flocks the manifest itself (creating it if needed),
+        returning the open file; closing it releases the lock. Since
+        updates replace the file, a lock taken on a copy that has been
+        replaced in the meantime is dropped and taken again.
+        """
+        while True:
+            f = open(self.path, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def update(self, results):
+        """
+        Adds (or replaces) rows for the scan `results`, rewriting the file.
+        """
+        with self.lock, self._locked():
+            self._load()
+            for r in results:
+                self.rows[r["file"]] = r
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as f:
+                f.write("\t".join(MANIFEST_COLUMNS) + "\n")
+                for name in sorted(self.rows):
+                    f.write("\t".join([str(self.rows[name].get(c, "")) for c in MANIFEST_COLUMNS]) + "\n")
+            os.replace(tmp, self.path)
+
+def verify_accession(acc, loc = '', spots = 0, manifest = None, journal = None):
+    """
+    Verifies the .fastq.gz files downloaded for `acc` in `loc`, scanning
+    them in parallel (see `scan_fastq_gz`). Also checks that R1 and R2
+    have the same number of reads and, if `spots` (from runinfo) is
+    given, that the single-end or R1 reads add up to it. Results go to
+    `manifest` and the outcome to `journal`, if given. Returns the scan
+    results; raises an Exception describing any problems.
+    """
+    paths = [os.path.join(loc, acc+suffix+".fastq.gz") for suffix in FASTQ_SUFFIXES]
+    found = [p for p in paths if os.path.isfile(p)]
+    if len(found) == 0:
+        raise Exception("no .fastq.gz files to verify for "+acc)
+    with timed(acc, "verify", files=len(found)) as m, ThreadPoolExecutor(max_workers=len(found)) as pool:
+        results = list(pool.map(scan_fastq_gz, found))
+        m["bytes_in"] = sum([r["bytes"] for r in results])
+    if manifest is not None:
+        manifest.update(results)
+
+    problems = [r["file"]+": "+r["status"] for r in results if r["status"] != "ok"]
+    counts = dict((r["file"], r["records"]) for r in results)
+    single, r1, r2 = [os.path.basename(p) for p in paths]
+    if (r1 in counts) != (r2 in counts):
+        problems.append("only one of "+r1+" and "+r2+" present")
+    elif r1 in counts and counts[r1] != counts[r2]:
+        problems.append("R1 and R2 read counts differ ("+str(counts[r1])+" vs "+str(counts[r2])+")")
+    if spots > 0 and len(problems) == 0:
+        total = counts.get(single, 0) + counts.get(r1, 0)
+        if total != spots:
+            problems.append("expected "+str(spots)+" spots from runinfo, found "+str(total)+" reads")
+
+    if len(problems) > 0:
+        if journal is not None:
+            journal.record(acc, "failed", stage="verify", problems=problems)
+        raise Exception("verification of "+acc+" failed: "+"; ".join(problems))
+    if journal is not None:
+        journal.record(acc, "verified", records=sum(counts.values()))
+    print("verified "+acc+": "+", ".join([r["file"]+" ("+str(r["records"])+" reads)" for r in results]))
+    return results
@@ -14,14 +14,16 @@ setup(name='grabseqs',
 	]},
 	install_requires=[
 		'requests',
-		'argparse',
-		'pandas>=2'
+		'argparse'
 	],
+	extras_require={
+		'pandas': ['pandas>=2']
+	},
 	classifiers = ['Intended Audience :: Science/Research',
 				'Environment :: Console',
 				'Environment :: Web Environment',
 				'License :: OSI Approved :: MIT License',
 				'Programming Language :: Python :: 3',
 				'Topic :: Scientific/Engineering :: Bio-Informatics',],
-	py_modules = ['utils','sra','mgrast']
+	py_modules = ['utils','net','cache','compress','journal','verify','metrics','ena','sra','mgrast','api']
 )
@@ -4,7 +4,7 @@ import requests, argparse, sys, os, time, json, glob
 from subprocess import call
 import pandas as pd
 
-from grabseqslib.utils import check_existing, fetch_file
+from grabseqslib.utils import check_existing, fetch_file, MetadataAccumulator
 
 def add_newrepo_subparser(subparser):
     """
@@ -63,7 +63,7 @@ def map_newrepo_project_acc(pacc, metadata_agg = None):
     """
     Function to get list of newrepo sample accession numbers from a particular 
     project. Takes project accession number `pacc` and an optional `metadata_agg`
-    pandas dataframe and returns a list of newrepo accession numbers with any new
+    MetadataAccumulator and returns a list of newrepo accession numbers with any new
     metadata appended to `metadata_agg`.
     """
 
@@ -76,12 +76,11 @@ def map_newrepo_project_acc(pacc, metadata_agg = None):
     # processing). For an example of this, see the sra.py module
     
     
-    # This is example code from sra.py showing how one might append all metadata from 
-    # one run into the same dataframe
+    # This is example code from sra.py showing how one might collect all metadata from 
+    # one run into the same table (a MetadataAccumulator, see utils.py)
     if type(metadata_agg) == type(None):
-        metadata_agg = pd.read_csv(StringIO(metadata.text))
-    else:
-        metadata_agg = metadata_agg.append(pd.read_csv(StringIO(metadata.text)),sort=True)
+        metadata_agg = MetadataAccumulator()
+    metadata_agg.add_csv_text(metadata.text)
         
     return sample_list, metadata
 
@@ -0,0 +1,366 @@
+"""
+Offline benchmarks for grabseqs: throughput and peak RSS of the
+conversion/compression helpers, output-directory checks, metadata
+aggregation, end-to-end SRA and MG-RAST batches run against a local
+stand-in server (standin.py) and fake sra-tools (fake_sra_tools/),
+and CLI startup (time from launch to the first API request). Nothing
+touches the network.
+
+    python tests/bench/bench.py                   # all benchmarks, compared to baseline.json
+    python tests/bench/bench.py -k gzip -k fasta  # only matching benchmarks
+    python tests/bench/bench.py --scale 4096      # ~4 GB inputs
+    python tests/bench/bench.py --save-baseline   # record these results as the new baseline
+
+Each benchmark runs in a fresh process so its peak RSS is its own.
+Inputs are generated once per work directory (--workdir to keep them).
+A throughput drop or RSS growth beyond --tolerance against the
+baseline (recorded at the same scale) is reported and exits 1.
+"""
+import os, sys, csv, json, time, shutil, argparse, platform, resource, tempfile, subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.abspath(os.path.join(HERE, "..", ".."))
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+from synth import ensure_reads, fastq_records, is_paired, READ_LEN
+
+BASELINE = os.path.join(HERE, "baseline.json")
+FAKE_TOOLS = os.path.join(HERE, "fake_sra_tools")
+
+# RSS growth (MB) always tolerated, for interpreter/allocator noise
+RSS_SLACK_MB = 16
+
+# ---------------------------------------------------------------- benchmarks
+# Each is (prepare, run): prepare(work, scale) makes inputs in the parent
+# process, untimed; run(work, scale, threads, jobs) runs in a child and
+# returns (seconds, amount, unit), throughput being amount/seconds.
+
+def _prep_fasta(work, scale):
+    ensure_reads(os.path.join(work, "reads.fasta"), scale * 1000000, "fasta")
+
+def _run_fasta_to_fastq(work, scale, threads, jobs):
+    from grabseqslib.utils import fasta_to_fastq
+    src = os.path.join(work, "reads.fasta")
+    out = os.path.join(work, "fasta_to_fastq.fastq.gz")
+    start = time.monotonic()
+    if fasta_to_fastq(src, out, False, zip_func="python", threads=threads) != 0:
+        raise Exception("fasta_to_fastq failed")
+    seconds = time.monotonic() - start
+    os.remove(out)
+    return seconds, os.path.getsize(src) / 1e6, "MB/s"
+
+def _prep_fastq(work, scale):
+    ensure_reads(os.path.join(work, "reads.fastq"), scale * 1000000, "fastq")
+
+def _gzip_files_with(tool):
+    def run(work, scale, threads, jobs):
+        from grabseqslib.utils import gzip_files
+        if tool != "python" and not shutil.which(tool):
+            return None # not installed here
+        src = os.path.join(work, "reads.fastq")
+        fq = os.path.join(work, "gzip_files_"+tool+".fastq")
+        shutil.copyfile(src, fq) # gzip_files replaces its input
+        start = time.monotonic()
+        if gzip_files(fq, tool, threads) != 0:
+            raise Exception("gzip_files failed")
+        seconds = time.monotonic() - start
+        os.remove(fq+".gz")
+        return seconds, os.path.getsize(src) / 1e6, "MB/s"
+    return run
+
+def _n_files(scale):
+    return max(2000, scale * 300)
+
+def _prep_directory(work, scale):
+    d = os.path.join(work, "many_runs")
+    if os.path.isdir(d):
+        return
+    os.makedirs(d+".tmp")
+    for i in range(_n_files(scale)):
+        acc = "SRR"+str(5000000 + i)
+        names = [acc+"_1.fastq.gz", acc+"_2.fastq.gz"] if i % 2 == 0 else [acc+".fastq.gz"]
+        for name in names:
+            with open(os.path.join(d+".tmp", name), 'wb') as f:
+                f.write(b"\x1f")
+    os.rename(d+".tmp", d)
+
+def _check_existing_with(use_index):
+    def run(work, scale, threads, jobs):
+        from grabseqslib.utils import check_existing, DirectoryIndex
+        d = os.path.join(work, "many_runs")
+        n = _n_files(scale)
+        accs = ["SRR"+str(5000000 + i) for i in range(n)] + ["SRR"+str(6000000 + i) for i in range(n)] # hits and misses
+        start = time.monotonic()
+        index = DirectoryIndex(d) if use_index else None
+        found = sum([1 for acc in accs if check_existing(d, acc, index) != False])
+        seconds = time.monotonic() - start
+        if found != n:
+            raise Exception("expected "+str(n)+" runs, found "+str(found))
+        return seconds, len(accs), "lookups/s"
+    return run
+
+def _prep_nothing(work, scale):
+    pass
+
+def _run_metadata(work, scale, threads, jobs):
+    from grabseqslib.utils import MetadataAccumulator
+    from standin import RUNINFO_COLUMNS
+    rows = scale * 1000
+    per_table = 500
+    out = os.path.join(work, "metadata.csv")
+    start = time.monotonic()
+    agg = MetadataAccumulator()
+    for t in range(0, rows, per_table):
+        # projects don't all share columns
+        header = RUNINFO_COLUMNS + ["extra_"+str(t // per_table % 7)]
+        table = [[str(t + i)] + ["value"+str(j) for j in range(len(header) - 1)] for i in range(per_table)]
+        agg.add_table(header, table)
+    agg.to_csv(out)
+    seconds = time.monotonic() - start
+    with open(out) as f:
+        if sum(1 for _ in csv.reader(f)) != len(agg) + 1:
+            raise Exception("metadata .csv is missing rows")
+    os.remove(out)
+    return seconds, len(agg), "rows/s"
+
+N_RUNS = 8
+
+def _spots(scale):
+    record = len(fastq_records("SRR9000001", 0, 1))
+    return max(1000, int(scale * 1000000 / N_RUNS / record / 1.5)) # paired runs write twice
+
+def _grabseqs(argv):
+    """
+    Runs the grabseqs command line in this process.
+    """
+    import grabseqslib
+    sys.argv = ["grabseqs"] + argv
+    try:
+        grabseqslib.main()
+    except SystemExit as e:
+        if e.code not in (0, None):
+            raise Exception("grabseqs exited with "+str(e.code))
+
+def _run_e2e_sra(work, scale, threads, jobs):
+    import grabseqslib.sra as sra
+    from standin import StandIn
+    spots = _spots(scale)
+    runs = dict(("SRR"+str(9000001 + i), spots) for i in range(N_RUNS))
+    out = os.path.join(work, "e2e_sra")
+    shutil.rmtree(out, ignore_errors=True)
+    os.environ["PATH"] = FAKE_TOOLS + os.pathsep + os.environ["PATH"]
+    os.environ["BENCH_SPOTS"] = str(spots)
+    with StandIn(runs=runs) as standin:
+        sra.RUNINFO_URL = standin.runinfo_url
+        start = time.monotonic()
+        _grabseqs(["sra", "-o", out, "-t", str(threads), "-j", str(jobs), "--no-cache", "SRP000001"])
+        seconds = time.monotonic() - start
+    record = len(fastq_records("SRR9000001", 0, 1))
+    amount = sum([spots * record * (2 if is_paired(acc) else 1) for acc in runs]) / 1e6
+    if len([f for f in os.listdir(out) if f.endswith(".fastq.gz")]) != N_RUNS + N_RUNS // 2:
+        raise Exception("not every run was downloaded")
+    shutil.rmtree(out)
+    return seconds, amount, "MB/s"
+
+N_SAMPLES = 4
+
+def _prep_mgrast(work, scale):
+    size = max(1, scale // N_SAMPLES) * 1000000
+    ensure_reads(os.path.join(work, "mg_a.fasta"), size, "fasta")
+    ensure_reads(os.path.join(work, "mg_b_1.fasta"), size // 2, "fasta")
+    ensure_reads(os.path.join(work, "mg_b_2.fasta"), size // 2, "fasta")
+    ensure_reads(os.path.join(work, "mg_c.fastq"), size, "fastq")
+    ensure_reads(os.path.join(work, "mg_d.fastq.gz"), size, "fastq", compress=True)
+
+def _run_e2e_mgrast(work, scale, threads, jobs):
+    import grabseqslib.mgrast as mgrast
+    from standin import StandIn
+    samples = {"mgm4000001.3": [os.path.join(work, "mg_a.fasta")],
+               "mgm4000002.3": [os.path.join(work, "mg_b_1.fasta"), os.path.join(work, "mg_b_2.fasta")],
+               "mgm4000003.3": [os.path.join(work, "mg_c.fastq")],
+               "mgm4000004.3": [os.path.join(work, "mg_d.fastq.gz")]}
+    out = os.path.join(work, "e2e_mgrast")
+    shutil.rmtree(out, ignore_errors=True)
+    with StandIn(samples=samples) as standin:
+        mgrast.MGRAST_API = standin.mgrast_api
+        start = time.monotonic()
+        _grabseqs(["mgrast", "-o", out, "-t", str(threads), "-j", str(jobs), "--no-cache", "-m", "meta.csv", "mgp1"])
+        seconds = time.monotonic() - start
+    amount = sum([os.path.getsize(p) for files in samples.values() for p in files]) / 1e6
+    if len([f for f in os.listdir(out) if f.endswith(".fastq.gz")]) != 5:
+        raise Exception("not every sample was downloaded")
+    shutil.rmtree(out)
+    return seconds, amount, "MB/s"
+
+STARTUP_RUNS = 5
+
+# a fresh interpreter running `grabseqs sra -l` against the stand-in
+STARTUP_SCRIPT = """
+import sys
+sys.path.insert(0, {root!r})
+import grabseqslib, grabseqslib.sra as sra
+sra.RUNINFO_URL = {url!r}
+sys.argv = ["grabseqs", "sra", "-l", "-o", {out!r}, "--no-cache", "SRR9000001"]
+grabseqslib.main()
+"""
+
+def _run_startup(work, scale, threads, jobs):
+    from standin import StandIn
+    env = dict(os.environ, PATH=FAKE_TOOLS + os.pathsep + os.environ["PATH"])
+    latencies = []
+    for i in range(STARTUP_RUNS):
+        with StandIn(runs={"SRR9000001": 1000}) as standin:
+            code = STARTUP_SCRIPT.format(root=ROOT, url=standin.runinfo_url, out=work)
+            start = time.monotonic()
+            p = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, env=env)
+            if p.returncode != 0 or standin.first_request is None:
+                raise Exception("grabseqs sra -l failed")
+            latencies.append(standin.first_request - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], 1, "starts/s" # median
+
+BENCHMARKS = {
+    "fasta_to_fastq": (_prep_fasta, _run_fasta_to_fastq),
+    "gzip_files[python]": (_prep_fastq, _gzip_files_with("python")),
+    "gzip_files[pigz]": (_prep_fastq, _gzip_files_with("pigz")),
+    "gzip_files[gzip]": (_prep_fastq, _gzip_files_with("gzip")),
+    "check_existing[index]": (_prep_directory, _check_existing_with(True)),
+    "check_existing[stat]": (_prep_directory, _check_existing_with(False)),
+    "metadata_aggregation": (_prep_nothing, _run_metadata),
+    "e2e_sra": (_prep_nothing, _run_e2e_sra),
+    "e2e_mgrast": (_prep_mgrast, _run_e2e_mgrast),
+    "startup": (_prep_nothing, _run_startup),
+}
+
+# ---------------------------------------------------------------- running
+
+def run_child(name, work, scale, threads, jobs):
+    """
+    Runs benchmark `name` in this process and prints its result as JSON.
+    """
+    out = BENCHMARKS[name][1](work, scale, threads, jobs)
+    result = {"name": name}
+    if out is None:
+        result["skipped"] = True
+    else:
+        seconds, amount, unit = out
+        result.update({"seconds": round(seconds, 4), "throughput": round(amount / max(seconds, 1e-9), 2),
+                       "unit": unit, "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)})
+    # the benchmarked code prints progress; the result is the last line
+    sys.stdout.write("\n"+json.dumps(result)+"\n")
+
+def run_benchmark(name, work, scale, threads = 1, jobs = 2, quiet = True):
+    """
+    Prepares inputs for benchmark `name` in `work` and runs it in a
+    child process. Returns its result dict.
+    """
+    BENCHMARKS[name][0](work, scale)
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--workdir", work,
+           "--scale", str(scale), "--threads", str(threads), "--jobs", str(jobs)]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE if quiet else None, cwd=work)
+    lines = p.stdout.decode().strip().split("\n")
+    if p.returncode != 0:
+        raise Exception(name+" failed:\n"+p.stdout.decode()[-2000:]+(p.stderr.decode()[-2000:] if p.stderr else ""))
+    return json.loads(lines[-1])
+
+def compare(results, baseline, tolerance):
+    """
+    Adds each result's change against `baseline` and whether it's a
+    regression. Returns the names of regressed benchmarks.
+    """
+    regressed = []
+    for r in results:
+        base = baseline.get(r["name"])
+        if base is None or r.get("skipped") or base.get("skipped"):
+            continue
+        r["vs_baseline"] = round(r["throughput"] / base["throughput"] - 1, 3)
+        r["rss_vs_baseline"] = round(r["peak_rss_mb"] - base["peak_rss_mb"], 1)
+        slower = r["throughput"] < base["throughput"] * (1 - tolerance)
+        fatter = r["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance) + RSS_SLACK_MB
+        if slower or fatter:
+            r["regression"] = ("slower" if slower else "") + (" " if slower and fatter else "") + ("more memory" if fatter else "")
+            regressed.append(r["name"])
+    return regressed
+
+def print_table(results):
+    print("{:<24}{:>10}{:>16}{:>12}{:>12}{:>11}  {}".format("benchmark", "time (s)", "throughput", "",
+                                                           "peak RSS MB", "vs base", ""))
+    for r in results:
+        if r.get("skipped"):
+            print("{:<24}{:>10}".format(r["name"], "skipped"))
+            continue
+        change = "{:+.1%}".format(r["vs_baseline"]) if "vs_baseline" in r else "-"
+        print("{:<24}{:>10}{:>16}{:>12}{:>12}{:>11}  {}".format(r["name"], r["seconds"], r["throughput"], r["unit"],
+                                                               r["peak_rss_mb"], change, r.get("regression", "")))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Offline grabseqs benchmarks")
+    parser.add_argument('-k', dest="select", action="append", default=[],
+                help="only run benchmarks whose name contains this (repeatable)")
+    parser.add_argument('--scale', type=int, default=64,
+                help="input size in MB (default 64; thousands for multi-GB runs)")
+    parser.add_argument('--threads', type=int, default=1, help="threads (-t) for the code under test")
+    parser.add_argument('--jobs', type=int, default=2, help="concurrent jobs (-j) for end-to-end batches")
+    parser.add_argument('--workdir', type=str, default="", help="where to keep generated inputs (default: a temporary directory)")
+    parser.add_argument('--baseline', type=str, default=BASELINE, help="baseline results to compare against")
+    parser.add_argument('--save-baseline', dest="save", action="store_true", help="store these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                help="fractional throughput drop (or RSS growth) counted as a regression (default 0.25)")
+    parser.add_argument('--json', dest="json_out", type=str, default="", help="also write results to this file")
+    parser.add_argument('--child', type=str, default="", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child != "":
+        return run_child(args.child, args.workdir, args.scale, args.threads, args.jobs)
+
+    names = [n for n in BENCHMARKS if len(args.select) == 0 or any(k in n for k in args.select)]
+    work = args.workdir if args.workdir != "" else tempfile.mkdtemp(prefix="grabseqs_bench_")
+    os.makedirs(work, exist_ok=True)
+    work = os.path.abspath(work)
+    try:
+        results = []
+        for name in names:
+            print("running "+name+"...", file=sys.stderr)
+            results.append(run_benchmark(name, work, args.scale, args.threads, args.jobs))
+    finally:
+        if args.workdir == "":
+            shutil.rmtree(work, ignore_errors=True)
+
+    regressed = []
+    if os.path.isfile(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") == args.scale and baseline.get("threads") == args.threads:
+            regressed = compare(results, baseline["results"], args.tolerance)
+        else:
+            print("baseline was recorded with --scale "+str(baseline.get("scale"))+" --threads "+
+                  str(baseline.get("threads"))+"; not comparing", file=sys.stderr)
+    print_table(results)
+
+    record = {"scale": args.scale, "threads": args.threads, "jobs": args.jobs,
+              "machine": platform.platform()+", "+str(os.cpu_count())+" CPUs, Python "+platform.python_version(),
+              "results": dict((r["name"], r) for r in results)}
+    if args.json_out != "":
+        with open(args.json_out, 'w') as f:
+            json.dump(record, f, indent=2)
+    if args.save:
+        if os.path.isfile(args.baseline): # keep benchmarks that weren't re-run
+            with open(args.baseline) as f:
+                old = json.load(f)
+            if old.get("scale") == args.scale and old.get("threads") == args.threads:
+                old["results"].update(record["results"])
+                record["results"] = old["results"]
+        for r in record["results"].values():
+            for k in ("vs_baseline", "rss_vs_baseline", "regression"):
+                r.pop(k, None)
+        with open(args.baseline, 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        print("baseline saved to "+args.baseline, file=sys.stderr)
+    if len(regressed) > 0:
+        print("regressions: "+", ".join(regressed), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+Local HTTP stand-in for the repository APIs grabseqs talks to: the SRA
+runinfo CGI, and MG-RAST's /download (stage listings and files, with
+byte ranges) and /metadata/export endpoints. Runs in a background
+thread on a free port; point grabseqslib at `runinfo_url` and
+`mgrast_api`.
+"""
+import os, re, json, time, threading, http.server
+from urllib.parse import unquote
+from synth import is_paired
+
+RUNINFO_COLUMNS = ["Run", "LibraryLayout", "size_MB", "spots", "bases", "avgLength", "SRAStudy", "BioProject",
+                   "Sample", "ScientificName", "Platform", "Model", "download_path"]
+
+class StandIn:
+    """
+    Serves `runs` (SRA accession -> number of spots, grouped into study
+    "SRP000001") and `samples` (MG-RAST sample id -> list of file paths
+    on disk, grouped into project "mgp1").
+    """
+    def __init__(self, runs = {}, samples = {}, read_len = 150):
+        self.runs = dict(runs)
+        self.samples = dict(samples)
+        self.read_len = read_len
+        self.requests = 0
+        self.first_request = None # time.monotonic() of the first request
+        handler = self._handler()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.base = "http://127.0.0.1:"+str(self.port)+"/"
+        self.runinfo_url = self.base+"runinfo?term="
+        self.mgrast_api = self.base+"mgrast/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def runinfo_row(self, acc):
+        spots = self.runs[acc]
+        bases = spots * self.read_len * (2 if is_paired(acc) else 1)
+        size_mb = max(1, bases // 4000000)
+        values = {"Run": acc, "LibraryLayout": "PAIRED" if is_paired(acc) else "SINGLE", "size_MB": size_mb,
+                  "spots": spots, "bases": bases, "avgLength": self.read_len, "SRAStudy": "SRP000001",
+                  "BioProject": "PRJNA000001", "Sample": "SRS"+acc[3:], "ScientificName": "metagenome",
+                  "Platform": "ILLUMINA", "Model": "Illumina HiSeq 2500", "download_path": self.base+"sra/"+acc}
+        return ",".join([str(values[c]) for c in RUNINFO_COLUMNS])
+
+    def runinfo(self, term):
+        wanted = set(unquote(term).split(" OR "))
+        rows = [self.runinfo_row(acc) for acc in self.runs
+                if acc in wanted or "SRP000001" in wanted or "PRJNA000001" in wanted]
+        if len(rows) == 0:
+            return ""
+        return ",".join(RUNINFO_COLUMNS) + "\n" + "\n".join(rows) + "\n"
+
+    def project_export(self):
+        return {"id": "mgp1", "name": "benchmark project",
+                "samples": [{"id": "mgs"+acc, "data": {"sample_name": {"value": "sample "+acc},
+                                                      "biome": {"value": "soil"}},
+                             "envPackage": {"data": {"ph": {"value": 7}}},
+                             "libraries": [{"data": {"metagenome_id": {"value": acc},
+                                                     "seq_meth": {"value": "illumina"}}}]}
+                            for acc in self.samples]}
+
+    def _handler(self):
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, code, body, headers = {}):
+                self.send_response(code)
+                for k in headers:
+                    self.send_header(k, headers[k])
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_file(self, path):
+                size = os.path.getsize(path)
+                start, end = 0, size - 1
+                rng = self.headers.get("Range")
+                if rng is not None:
+                    a, b = re.match(r"bytes=(\d+)-(\d*)", rng).groups()
+                    start = int(a)
+                    end = min(int(b), size - 1) if b != "" else size - 1
+                    if start >= size:
+                        return self.send(416, b"", {"Content-Range": "bytes */"+str(size)})
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes "+str(start)+"-"+str(end)+"/"+str(size))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    left = end - start + 1
+                    while left > 0:
+                        chunk = f.read(min(1 << 20, left))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        left -= len(chunk)
+
+            def do_GET(self):
+                if standin.first_request is None:
+                    standin.first_request = time.monotonic()
+                standin.requests += 1
+                path = self.path
+                if path.startswith("/runinfo?term="):
+                    return self.send(200, standin.runinfo(path.split("term=", 1)[1]).encode())
+                m = re.match(r"/mgrast/download/([^?]+)\?file=050\.(\d)$", path)
+                if m and m.group(1) in standin.samples:
+                    return self.send_file(standin.samples[m.group(1)][int(m.group(2)) - 1])
+                m = re.match(r"/mgrast/download/([^?]+)$", path)
+                if m and m.group(1) in standin.samples:
+                    files = standin.samples[m.group(1)]
+                    data = [{"file_id": "050."+str(i+1), "file_size": os.path.getsize(p)} for i, p in enumerate(files)]
+                    return self.send(200, json.dumps({"data": data + [{"file_id": "100.1"}]}).encode())
+                if path == "/mgrast/metadata/export/mgp1":
+                    return self.send(200, json.dumps(standin.project_export()).encode())
+                m = re.match(r"/mgrast/metadata/export/(mgm[\d.]+)$", path)
+                if m and m.group(1) in standin.samples:
+                    return self.send(200, json.dumps({"mixs": {"project": "mgp1", "acc": m.group(1)}}).encode())
+                self.send(404, b'{"ERROR": "not found"}')
+
+        return Handler
@@ -0,0 +1,77 @@
+"""
+Synthetic sequence data for the benchmarks: FASTA/FASTQ files of any
+size (multi-GB included) written quickly from a fixed pool of random
+reads, and the fake runs the stand-in server and fake sra-tools agree on.
+"""
+import os, gzip, random
+
+READ_LEN = 150
+POOL_SIZE = 4096 # distinct reads, cycled; well over gzip's 32 KB window
+
+_pool = None
+
+def read_pool(read_len = READ_LEN):
+    global _pool
+    if _pool is None or len(_pool[0]) != read_len:
+        rng = random.Random(1234)
+        _pool = ["".join(rng.choice("ACGT") for _ in range(read_len)).encode() for _ in range(POOL_SIZE)]
+    return _pool
+
+def is_paired(acc):
+    """
+    Layout of a fake run: accessions ending in an even digit are paired.
+    """
+    return acc[-1].isdigit() and int(acc[-1]) % 2 == 0
+
+def fastq_records(name, start, count, read_len = READ_LEN, mate = ""):
+    """
+    `count` FASTQ records (bytes) for run `name`, numbered from `start`.
+    """
+    pool = read_pool(read_len)
+    qual = b"I" * read_len
+    out = []
+    for i in range(start, start + count):
+        out.append(b"@" + name.encode() + b"." + str(i).encode() + mate.encode() + b"\n" +
+                   pool[i % POOL_SIZE] + b"\n+\n" + qual + b"\n")
+    return b"".join(out)
+
+def fasta_records(name, start, count, read_len = READ_LEN):
+    """
+    `count` FASTA records (bytes), sequence wrapped at 60 columns like
+    MG-RAST uploads often are.
+    """
+    pool = read_pool(read_len)
+    out = []
+    for i in range(start, start + count):
+        seq = pool[i % POOL_SIZE]
+        out.append(b">" + name.encode() + b"." + str(i).encode() + b"\n" +
+                   b"\n".join(seq[j:j+60] for j in range(0, len(seq), 60)) + b"\n")
+    return b"".join(out)
+
+def write_reads(path, nbytes, kind = "fastq", name = "synth", compress = False, block = 2000):
+    """
+    Writes about `nbytes` (uncompressed) of synthetic `kind` ("fastq" or
+    "fasta") reads to `path`, gzipped if `compress`. Returns the number
+    of records.
+    """
+    records = fastq_records if kind == "fastq" else fasta_records
+    f = gzip.open(path, 'wb', compresslevel=1) if compress else open(path, 'wb')
+    written = 0
+    n = 0
+    with f:
+        while written < nbytes:
+            data = records(name, n, block)
+            f.write(data)
+            written += len(data)
+            n += block
+    return n
+
+def ensure_reads(path, nbytes, kind = "fastq", compress = False):
+    """
+    `write_reads`, unless `path` is already there (inputs are reused
+    between benchmark runs in the same work directory).
+    """
+    if not os.path.isfile(path):
+        write_reads(path + ".tmp", nbytes, kind, compress=compress)
+        os.replace(path + ".tmp", path)
+    return path
@@ -0,0 +1,41 @@
+"""
+Runs every benchmark at a tiny scale, so the suite itself (fake tools,
+stand-in server, synthetic data) keeps working. For real numbers run
+bench.py directly.
+"""
+import os, sys, json, subprocess
+import pytest
+from bench import BENCHMARKS, BASELINE, ROOT, FAKE_TOOLS, STARTUP_SCRIPT, run_benchmark, compare
+from standin import StandIn
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_benchmark_runs(name, tmp_path):
+    result = run_benchmark(name, str(tmp_path), 2)
+    if result.get("skipped"):
+        pytest.skip(name+": tool not installed")
+    assert result["throughput"] > 0
+    assert result["peak_rss_mb"] > 0
+
+def test_baseline_covers_benchmarks():
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    assert set(baseline["results"]) == set(BENCHMARKS)
+
+def test_compare_flags_regressions():
+    base = {"a": {"throughput": 100.0, "peak_rss_mb": 50.0}, "b": {"throughput": 100.0, "peak_rss_mb": 50.0}}
+    results = [{"name": "a", "throughput": 70.0, "peak_rss_mb": 50.0},
+               {"name": "b", "throughput": 95.0, "peak_rss_mb": 55.0}]
+    assert compare(results, base, 0.25) == ["a"]
+    assert results[0]["regression"] == "slower"
+
+def test_listing_skips_heavy_imports(tmp_path):
+    # startup time is mostly imports; listing must not pull in requests or pandas
+    env = dict(os.environ, PATH=FAKE_TOOLS + os.pathsep + os.environ["PATH"])
+    with StandIn(runs={"SRR9000001": 1000}) as standin:
+        code = STARTUP_SCRIPT.format(root=ROOT, url=standin.runinfo_url, out=str(tmp_path))
+        code += "print(sorted(m for m in ('requests', 'urllib3', 'pandas') if m in sys.modules))\n"
+        p = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, env=env)
+    lines = p.stdout.decode().strip().split("\n")
+    assert p.returncode == 0
+    assert "SRR9000001.fastq.gz" in lines
+    assert lines[-1] == "[]"
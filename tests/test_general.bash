@@ -21,7 +21,7 @@ function test_grabseqs_no_pigz {
         conda remove pigz -qy
         u=`grabseqs mgrast -o $TMPDIR/test_nopigz mgm4633450.3`
         echo $u
-        if [[ $u != *"pigz not found, using gzip"* ]] ; then
+        if [[ $u != *"pigz not found, using built-in multithreaded gzip"* ]] ; then
             exit 1
         fi
         conda install -c anaconda pigz -qy
@@ -50,3 +50,26 @@ function test_grabseqs_conda_newer_python {
     conda env remove -yqn grabseqs-unittest-py37
     conda activate grabseqs-unittest
 }
+
+# test native downloader against a local HTTP server
+function test_fetch_file_local {
+    mkdir -p $TMPDIR/test_fetch/srv
+    head -c 5000000 /dev/urandom > $TMPDIR/test_fetch/srv/blob.bin
+    python -m http.server 8765 --directory $TMPDIR/test_fetch/srv &
+    SRV_PID=$!
+    sleep 2
+    python -c "from grabseqslib.utils import fetch_file; import sys; sys.exit(fetch_file('http://127.0.0.1:8765/blob.bin', '$TMPDIR/test_fetch/blob.bin', 2))"
+    kill $SRV_PID
+    cmp $TMPDIR/test_fetch/srv/blob.bin $TMPDIR/test_fetch/blob.bin
+}
+
+# the Python API plans without downloading, then executes the plan
+function test_api_plan_execute {
+    python -c "
+from grabseqslib.api import plan, execute
+tasks = plan(['SRR1913936'])
+assert len(tasks) == 1 and tasks[0].layout == 'PAIRED', tasks
+results = execute(tasks, outdir='$TMPDIR/test_api')
+assert results[0].ok and len(results[0].files) == 2, results
+"
+}
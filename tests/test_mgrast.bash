@@ -13,6 +13,15 @@ function test_mgrast_metadata {
     fi
 }
 
+# metadata has the same columns whether samples come from a project or are named directly
+function test_mgrast_metadata_columns {
+    grabseqs mgrast -o $TMPDIR/test_md_mg_proj -m META.csv -l mgp85479
+    grabseqs mgrast -o $TMPDIR/test_md_mg_sample -m META.csv -l mgm4793571.3
+    if [ "`head -1 $TMPDIR/test_md_mg_proj/META.csv`" != "`head -1 $TMPDIR/test_md_mg_sample/META.csv`" ] ; then
+        exit 1
+    fi
+}
+
 # download a tiny sample, .fastq-formatted
 function test_mgrast_fastq {
     grabseqs mgrast -o $TMPDIR/test_tiny_mg mgm4793571.3
@@ -50,3 +59,20 @@ function test_mgrast_invalid_acc {
         exit 1
     fi
 }
+
+## stream a .fasta-formatted sample straight to .fastq.gz
+function test_mgrast_fasta_pipe {
+    grabseqs mgrast --pipe -o $TMPDIR/test_tiny_mg_pipe mgm4440055.3
+    ls $TMPDIR/test_tiny_mg_pipe/mgm4440055.3.fastq.gz
+    if ls $TMPDIR/test_tiny_mg_pipe/*.fasta; then
+        exit 1
+    fi
+}
+
+# an unresolvable project doesn't stop the samples after it
+function test_mgrast_bad_project_continues {
+    if grabseqs mgrast -o $TMPDIR/test_bad_mg mgp0fake mgm4793571.3; then
+        exit 1
+    fi
+    ls $TMPDIR/test_bad_mg/mgm4793571.3.fastq.gz
+}
@@ -0,0 +1,35 @@
+"""
+Offline checks that metadata built from an MG-RAST project export
+(see MIXS_FROM_EXPORT) matches the per-sample "mixs" block that -m
+writes for a sample requested directly. The API responses (project
+mgp85479 trimmed to one sample, and that sample's own export) are in
+tests/data; nothing touches the network.
+"""
+import os, sys
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DATA = os.path.join(ROOT, "tests", "data")
+sys.path.insert(0, ROOT)
+
+from grabseqslib import mgrast
+
+def _recorded(url, key, validate = None):
+    acc = url.rsplit("/", 1)[1]
+    with open(os.path.join(DATA, "mgrast_export_"+acc+".json")) as f:
+        return f.read()
+
+@pytest.fixture(autouse=True)
+def recorded_api(monkeypatch):
+    monkeypatch.setattr(mgrast, "cached_get_text", _recorded)
+
+def test_project_export_matches_sample_mixs():
+    samples, records = mgrast.get_mgrast_project("mgp85479")
+    assert samples == ["mgm4793571.3"]
+    assert records["mgm4793571.3"] == mgrast.get_mgrast_sample_record("mgm4793571.3")
+
+def test_every_mixs_key_is_filled():
+    samples, records = mgrast.get_mgrast_project("mgp85479")
+    record = records["mgm4793571.3"]
+    assert set(record) == set(mgrast.MIXS_FROM_EXPORT) | {"mgm_id"}
+    assert [k for k in record if record[k] == ""] == []
@@ -84,3 +84,127 @@ function test_sra_invalid_acc {
         exit 1
     fi
 }
+
+# concurrent downloads, one invalid run shouldn't stop the others
+function test_sra_parallel_jobs {
+    if grabseqs sra -t 2 -j 2 -r 0 -o $TMPDIR/test_parallel_sra ERR2279063 SRR1913936 SRRXXXXXXXX; then
+        exit 1
+    fi
+    ls $TMPDIR/test_parallel_sra/ERR2279063.fastq.gz
+    ls $TMPDIR/test_parallel_sra/SRR1913936_1.fastq.gz
+    ls $TMPDIR/test_parallel_sra/SRR1913936_2.fastq.gz
+}
+
+# --pipe streams single-end runs into pigz and compresses paired runs in the background
+function test_sra_pipe {
+    grabseqs sra -t 2 -j 2 --pipe -o $TMPDIR/test_pipe_sra ERR2279063 SRR1913936
+    ls $TMPDIR/test_pipe_sra/ERR2279063.fastq.gz
+    ls $TMPDIR/test_pipe_sra/SRR1913936_1.fastq.gz
+    ls $TMPDIR/test_pipe_sra/SRR1913936_2.fastq.gz
+    if ls $TMPDIR/test_pipe_sra/*.fastq $TMPDIR/test_pipe_sra/*.part; then
+        exit 1
+    fi
+}
+
+# fasterq-dump scratch goes to --tmpdir, which is left empty afterwards
+function test_sra_tmpdir {
+    grabseqs sra -t 2 --tmpdir $TMPDIR/test_sra_scratch -o $TMPDIR/test_tmpdir_sra ERR2279063
+    ls $TMPDIR/test_tmpdir_sra/ERR2279063.fastq.gz
+    if [ `ls -A $TMPDIR/test_sra_scratch | wc -l` -ne 0 ]; then
+        exit 1
+    fi
+}
+
+# an invalid accession is a permanent failure, so it shouldn't wait to retry
+function test_sra_invalid_fails_fast {
+    start=`date +%s`
+    if grabseqs sra -r 2 -o $TMPDIR/test_invalid_sra SRRXXXXXXXX; then
+        exit 1
+    fi
+    if [ $(( `date +%s` - start )) -gt 60 ]; then
+        exit 1
+    fi
+}
+
+# --verify writes a checksum manifest covering both mates
+function test_sra_verify {
+    grabseqs sra --verify -o $TMPDIR/test_verify_sra SRR1913936
+    grep "SRR1913936_1.fastq.gz" $TMPDIR/test_verify_sra/grabseqs_manifest.tsv | grep -q "ok$"
+    grep "SRR1913936_2.fastq.gz" $TMPDIR/test_verify_sra/grabseqs_manifest.tsv | grep -q "ok$"
+}
+
+# --metrics-file records each stage as JSON lines
+function test_sra_metrics {
+    grabseqs sra --metrics-file metrics.jsonl -o $TMPDIR/test_metrics_sra SRR1913936 2>&1 >/dev/null | grep -q "^compress"
+    grep '"stage": "dump"' $TMPDIR/test_metrics_sra/metrics.jsonl | grep -q '"retcode": 0'
+    grep -q '"stage": "compress"' $TMPDIR/test_metrics_sra/metrics.jsonl
+}
+
+# --source ena copies ENA's .fastq.gz files instead of dumping
+function test_sra_source_ena {
+    grabseqs sra --source ena -o $TMPDIR/test_ena_sra ERR2279063 | grep -q "from ENA"
+    ls $TMPDIR/test_ena_sra/ERR2279063.fastq.gz
+}
+
+# --prefetch fetches .sra files on their own pool, converts them locally and cleans up
+function test_sra_prefetch {
+    grabseqs sra -j 2 --prefetch --tmpdir $TMPDIR/test_prefetch_sra_tmp -o $TMPDIR/test_prefetch_sra ERR2279063 SRR1913936
+    ls $TMPDIR/test_prefetch_sra/ERR2279063.fastq.gz
+    ls $TMPDIR/test_prefetch_sra/SRR1913936_1.fastq.gz
+    ls $TMPDIR/test_prefetch_sra/SRR1913936_2.fastq.gz
+    if ls $TMPDIR/test_prefetch_sra_tmp/*/*.sra; then
+        exit 1
+    fi
+}
+
+# two workers claiming from one outdir, and two shards, each cover the batch once
+function test_sra_shard_claim {
+    grabseqs sra --claim -o $TMPDIR/test_claim_sra ERR2279063 SRR1913936 &
+    grabseqs sra --claim -o $TMPDIR/test_claim_sra ERR2279063 SRR1913936
+    wait
+    ls $TMPDIR/test_claim_sra/ERR2279063.fastq.gz
+    ls $TMPDIR/test_claim_sra/SRR1913936_1.fastq.gz
+    grabseqs sra --shard 1/2 -o $TMPDIR/test_shard_sra ERR2279063 SRR1913936
+    grabseqs sra --shard 2/2 -o $TMPDIR/test_shard_sra ERR2279063 SRR1913936
+    ls $TMPDIR/test_shard_sra/ERR2279063.fastq.gz
+    ls $TMPDIR/test_shard_sra/SRR1913936_1.fastq.gz
+}
+
+# listing twice should be answered from the metadata cache the second time
+function test_sra_listing_cached {
+    grabseqs sra -l --cache-dir $TMPDIR/test_cache SRP057027
+    if [ `grabseqs sra -l --offline --cache-dir $TMPDIR/test_cache SRP057027 | wc -l` -ne 369 ]; then
+        exit 1
+    fi
+}
+
+# existing files must match the accession exactly (SRR1 != SRR11)
+function test_sra_existing_exact_match {
+    mkdir -p $TMPDIR/test_exact_sra
+    echo "@r" | gzip > $TMPDIR/test_exact_sra/ERR22790631.fastq.gz
+    t=`grabseqs sra -r 0 -o $TMPDIR/test_exact_sra ERR2279063`
+    echo $t
+    if [[ $t == *"Pass -f to force download"* ]] ; then
+        exit 1
+    fi
+    ls $TMPDIR/test_exact_sra/ERR2279063.fastq.gz
+}
+
+# a permanent error at dump time (here from a stub fasterq-dump) isn't retried
+function test_sra_permanent_dump_error_not_retried {
+    mkdir -p $TMPDIR/stub_permanent_sra
+    cat > $TMPDIR/stub_permanent_sra/fasterq-dump <<'STUB'
+#!/bin/bash
+echo "$@" >> "$(dirname "$0")/calls"
+echo "err: item not found while resolving accession" >&2
+exit 3
+STUB
+    chmod +x $TMPDIR/stub_permanent_sra/fasterq-dump
+    if PATH=$TMPDIR/stub_permanent_sra:$PATH grabseqs sra -r 2 -o $TMPDIR/test_permanent_sra ERR2279063; then
+        exit 1
+    fi
+    if [ `cat $TMPDIR/stub_permanent_sra/calls | wc -l` -ne 1 ]; then
+        exit 1
+    fi
+    grep '"ERR2279063"' $TMPDIR/test_permanent_sra/.grabseqs_journal.jsonl | grep -q '"failure": "permanent"'
+}